@@ -0,0 +1,127 @@
+import json
+import time
+import threading
+from collections import deque
+
+
+# Events of web server for clients: console log lines, progress and status of jobs.
+# Events are kept in bounded ring buffer with increasing id, clients read new events by id
+# through Server-Sent Events, so nothing is polled by client and memory does not grow with uptime.
+
+
+class EventBus:
+    """Bounded ring buffer of typed events with blocking wait for new events"""
+    def __init__(self, max_events: int = 1000):
+        self.events = deque(maxlen=max_events)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event_type: str, **data) -> dict:
+        """
+        Add event and wake up waiting clients
+        :param event_type: type of event as log, progress or job
+        :param data: json serializable data of event
+        :return: event
+        """
+        with self.condition:
+            self.last_id += 1
+            event = {"id": self.last_id, "type": event_type, "time": data.pop("time", time.time()), **data}
+            self.events.append(event)
+            self.condition.notify_all()
+        return event
+
+    def since(self, last_id: int = 0, event_types: tuple = None) -> list:
+        """Events after id which are still in buffer"""
+        with self.condition:
+            return self._since(last_id, event_types)
+
+    def _since(self, last_id: int, event_types: tuple = None) -> list:
+        if not self.events or self.events[-1]["id"] <= last_id:
+            return []
+        # ids are consecutive, so start of new events is found without scan of buffer
+        start = max(0, len(self.events) - (self.events[-1]["id"] - last_id))
+        events = [self.events[i] for i in range(start, len(self.events))]
+        return [event for event in events if event["type"] in event_types] if event_types else events
+
+    def wait(self, last_id: int, timeout: float = 15, event_types: tuple = None) -> list:
+        """
+        Wait new events after id
+        :param last_id: id of last received event
+        :param timeout: seconds to wait
+        :param event_types: filter by types
+        :return: new events, empty list after timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_id > last_id, timeout=timeout)
+            return self._since(last_id, event_types)
+
+    def stream(self, last_id: int = 0, event_types: tuple = None, keepalive: float = 15):
+        """
+        Generator of Server-Sent Events text, comment is sent after keepalive seconds without events
+        :param last_id: id of last received event, client sends it in Last-Event-ID header after reconnect
+        :param event_types: filter by types
+        :param keepalive: seconds between keepalive comments
+        :return: generator of str
+        """
+        yield "retry: 3000\n\n"
+        while True:
+            events = self.wait(last_id, timeout=keepalive)
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            last_id = events[-1]["id"]
+            for event in events:
+                if not event_types or event["type"] in event_types:
+                    yield format_sse(event)
+
+
+def format_sse(event: dict) -> str:
+    """Event in Server-Sent Events format"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+class JobEventRelay:
+    """
+    Thread in web server which moves events of worker processes from job queue to event bus.
+    Workers can be terminated at any time, so events are passed through SQLite instead of pipe.
+    """
+    def __init__(self, queue, bus: EventBus, interval: float = 0.25, log_streams: dict = None):
+        """
+        Initialization
+        :param queue: JobQueue
+        :param bus: event bus of web server
+        :param interval: seconds between reads of new events
+        :param log_streams: streams by name (stdout, stderr) to write log events of workers in console of web server,
+        None to publish them in bus directly
+        """
+        self.queue = queue
+        self.bus = bus
+        self.interval = interval
+        self.log_streams = log_streams
+        self.last_id = queue.last_event_id()  # events before start of server are not sent
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="wunjo-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                events = self.queue.events(self.last_id)
+            except Exception as err:
+                print(f"Error during read job events {err}")
+                continue
+            for event in events:
+                self.last_id = event.pop("id")
+                event_type = event.pop("type")
+                if event_type == "log" and self.log_streams:
+                    # console stream of web server keeps log and publishes it in bus
+                    stream = self.log_streams.get(event.get("stream"), self.log_streams.get("stdout"))
+                    stream.write(event.get("text", ""))
+                    continue
+                self.bus.publish(event_type, **event)
@@ -0,0 +1,245 @@
+import os
+import re
+import time
+import subprocess
+import threading
+from collections import deque
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from backend.jobs import report_progress
+
+
+# All ffmpeg calls are run without shell by list of arguments. Frames and audio samples are sent through pipes,
+# audio is muxed in the same pass with encode of video, so job encodes video once.
+# Encoder can be set by WUNJO_FFMPEG_ENCODER: libx264 (default), h264_nvenc, h264_qsv, h264_videotoolbox or auto.
+# Threads of software encoder can be set by WUNJO_FFMPEG_THREADS, 0 is auto.
+
+
+def is_debug():
+    return os.environ.get('DEBUG', 'False') == 'True'
+
+
+@lru_cache(maxsize=1)
+def get_available_encoders() -> str:
+    """Output of ffmpeg -encoders"""
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return result.stdout.decode("utf-8", errors="ignore")
+    except OSError:
+        return ""
+
+
+def get_video_encoder() -> str:
+    """
+    Get video encoder from WUNJO_FFMPEG_ENCODER, auto will use hardware encoder if ffmpeg has it
+    :return: encoder name
+    """
+    encoder = os.environ.get("WUNJO_FFMPEG_ENCODER", "libx264")
+    if encoder != "auto":
+        return encoder
+    encoders = get_available_encoders()
+    if 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') and "h264_nvenc" in encoders:
+        return "h264_nvenc"
+    if "h264_videotoolbox" in encoders:
+        return "h264_videotoolbox"
+    return "libx264"
+
+
+def get_encoder_args(encoder: str = None, crf: int = 23, preset: str = "medium", threads: int = None) -> list:
+    """
+    Arguments of video encoder with comparable quality for software and hardware encoders
+    :param encoder: encoder name or None to get from environment
+    :param crf: quality, lower is better
+    :param preset: speed preset of x264
+    :param threads: threads of software encoder, 0 is auto
+    :return: list of arguments
+    """
+    encoder = encoder or get_video_encoder()
+    if encoder == "h264_nvenc":
+        return ["-c:v", encoder, "-preset", "p4", "-rc", "vbr", "-cq", str(crf), "-b:v", "0"]
+    if encoder == "h264_qsv":
+        return ["-c:v", encoder, "-preset", preset, "-global_quality", str(crf)]
+    if encoder == "h264_videotoolbox":
+        return ["-c:v", encoder, "-q:v", str(max(1, 100 - crf * 2))]
+    threads = int(os.environ.get("WUNJO_FFMPEG_THREADS", 0)) if threads is None else threads
+    return ["-c:v", encoder, "-preset", preset, "-crf", str(crf), "-threads", str(threads)]
+
+
+def hms_to_seconds(value: str) -> float:
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def probe_media(path: str) -> dict:
+    """
+    Get duration, video codec and audio presence of media by ffmpeg without ffprobe
+    :param path: path to media
+    :return: dict with duration, video_codec and has_audio
+    """
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-i", path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    info = result.stderr.decode("utf-8", errors="ignore")
+    duration = re.search(r"Duration: (\d+:\d+:\d+(?:\.\d+)?)", info)
+    video_codec = re.search(r"Stream #\S+.*?: Video: (\w+)", info)
+    return {
+        "duration": hms_to_seconds(duration.group(1)) if duration else None,
+        "video_codec": video_codec.group(1) if video_codec else None,
+        "has_audio": re.search(r"Stream #\S+.*?: Audio: ", info) is not None
+    }
+
+
+class StderrTail:
+    """Read stderr of process in thread and keep last lines for error message"""
+    def __init__(self, stream, max_lines: int = 20):
+        self.lines = deque(maxlen=max_lines)
+        self.thread = threading.Thread(target=self._read, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def _read(self, stream):
+        for line in iter(stream.readline, b""):
+            line = line.decode("utf-8", errors="ignore").rstrip()
+            if is_debug():
+                print(line)
+            self.lines.append(line)
+        stream.close()
+
+    def text(self) -> str:
+        self.thread.join(timeout=5)
+        return "\n".join(self.lines)
+
+
+def run_ffmpeg(args: list, duration: float = None, message: str = None, check: bool = True) -> int:
+    """
+    Run ffmpeg with progress report of current job
+    :param args: ffmpeg arguments without ffmpeg and global options
+    :param duration: duration of output in seconds to calculate progress
+    :param message: message of progress
+    :param check: raise RuntimeError if ffmpeg failed
+    :return: return code
+    """
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:1"] + [str(arg) for arg in args]
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = StderrTail(process.stderr)
+    for line in iter(process.stdout.readline, b""):
+        key, _, value = line.decode("utf-8", errors="ignore").strip().partition("=")
+        # out_time_ms is in microseconds as out_time_us
+        if duration and key == "out_time_ms" and value.isdigit():
+            report_progress(min(int(value) / 1e6 / duration, 1.0), message)
+    process.stdout.close()
+    return_code = process.wait()
+    if check and return_code != 0:
+        raise RuntimeError(f"Ffmpeg failed with code {return_code}: {stderr.text()}")
+    return return_code
+
+
+def read_audio(path: str, sample_rate: int = 16000, channels: int = 1) -> np.ndarray:
+    """
+    Decode audio of any media to float32 PCM through pipe, without temporary wav file
+    :param path: path to audio or video
+    :param sample_rate: sample rate of result
+    :param channels: number of channels
+    :return: array of samples, shape (samples,) for mono or (samples, channels)
+    """
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-vn", "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ac", str(channels), "-ar", str(sample_rate), "-"
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = StderrTail(process.stderr)
+    data = process.stdout.read()
+    process.stdout.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"Ffmpeg could not read audio {path}: {stderr.text()}")
+    samples = np.frombuffer(data, dtype=np.float32)
+    return samples if channels == 1 else samples.reshape(-1, channels)
+
+
+class VideoWriter:
+    """
+    Encode frames by ffmpeg through pipe, frames are not saved as images.
+    Audio of other media can be muxed in the same pass, so result is ready after release.
+    Has the same write and release methods as cv2.VideoWriter.
+    """
+    def __init__(self, save_file: str, fps: float, width: int, height: int, audio: str = None, audio_start: float = 0,
+                 crf: int = 23, preset: str = "medium", encoder: str = None, total: int = None, message: str = None):
+        """
+        Initialization
+        :param save_file: path to result video
+        :param fps: frames per second
+        :param width: frame width
+        :param height: frame height
+        :param audio: path to audio or video which audio will be muxed, video is shortened to the shortest stream
+        :param audio_start: start of audio in seconds, if video was trimmed
+        :param crf: quality, lower is better
+        :param preset: speed preset of x264
+        :param encoder: video encoder or None to get from environment
+        :param total: expected number of frames to report progress
+        :param message: message of progress
+        """
+        self.save_file = save_file
+        self.width = width
+        self.height = height
+        self.total = total
+        self.message = message or "Encode video"
+        self.frame_count = 0
+        self.is_stopped = False
+        self.report_every = max(int(fps), 1)
+        self.started_at = time.time()
+        cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}", "-r", str(fps), "-i", "-"
+        ]
+        if audio is not None and os.path.isfile(audio):
+            cmd += ["-ss", str(audio_start), "-i", audio, "-map", "0:v", "-map", "1:a?", "-c:a", "aac", "-shortest"]
+        cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+        cmd += get_encoder_args(encoder, crf, preset)
+        cmd += ["-movflags", "+faststart", save_file]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.stderr = StderrTail(self.process.stderr)
+
+    def write(self, frame):
+        if self.is_stopped:
+            return
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            frame = cv2.resize(frame, (self.width, self.height))
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            # ffmpeg stops to read frames when audio is shorter, error is checked in release
+            self.is_stopped = True
+            return
+        self.frame_count += 1
+        if self.total and self.frame_count % self.report_every == 0:
+            speed = self.frame_count / max(time.time() - self.started_at, 1e-6)
+            report_progress(
+                min(self.frame_count / self.total, 1.0), self.message, frame=self.frame_count, total=self.total,
+                fps=round(speed, 2), eta=round(max(self.total - self.frame_count, 0) / speed, 1)
+            )
+
+    def release(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        if self.process.wait() != 0:
+            raise RuntimeError(f"Ffmpeg could not encode video {self.save_file}: {self.stderr.text()}")
+
+    def abort(self):
+        """Stop encode after error of pipeline and remove incomplete video"""
+        self.process.kill()
+        self.process.wait()
+        if os.path.exists(self.save_file):
+            os.remove(self.save_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # truncated video of failed pipeline is not result
+            self.abort()
+        else:
+            self.release()
@@ -51,6 +51,14 @@ TMP_FOLDER = os.path.join(MEDIA_FOLDER, 'tmp')
 if not os.path.exists(TMP_FOLDER):
     os.makedirs(TMP_FOLDER)
 
+JOB_FOLDER = os.path.join(MEDIA_FOLDER, 'jobs')
+if not os.path.exists(JOB_FOLDER):
+    os.makedirs(JOB_FOLDER)
+
+FACE_CACHE_FOLDER = os.path.join(MEDIA_FOLDER, 'cache', 'face')
+if not os.path.exists(FACE_CACHE_FOLDER):
+    os.makedirs(FACE_CACHE_FOLDER)
+
 # CONTENT FOLDERS
 CONTENT_FOLDER = os.path.join(MEDIA_FOLDER, "content")
 if not os.path.exists(CONTENT_FOLDER):
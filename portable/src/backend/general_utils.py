@@ -7,8 +7,9 @@ import shutil
 import requests
 from time import strftime
 
-from backend.folders import SETTING_FOLDER
+from backend.folders import SETTING_FOLDER, TMP_FOLDER
 from backend.download import download_model, unzip, check_download_size
+from backend.uploads import get_pending_upload_time, UPLOAD_STALL_TIMEOUT
 
 
 def clean_text_by_language(text, lang, only_punct=False):
@@ -207,20 +208,68 @@ def format_dir_time(dir_time):
     return formatted_date
 
 
-def check_tmp_file_uploaded(file_path, retries=10, delay=30):
+def check_tmp_file_uploaded(file_path, timeout=300, delay=0.5):
     """
-    Check if a file exists, with a specified number of retries and delay between retries.
+    Wait file in tmp folder. Upload is committed by atomic rename, so file exists only after upload is finished.
+    Wait is continued while upload of file receives new chunks.
 
     :param file_path: Path to the file to check.
-    :param retries: Number of times to retry.
-    :param delay: Delay in seconds between retries.
+    :param timeout: Seconds to wait file which upload is not created.
+    :param delay: Delay in seconds between checks.
     :return: True if file exists, False otherwise.
     """
-    for _ in range(retries):
+    start_time = time.time()
+    while True:
         if os.path.exists(file_path):
             return True
+        now = time.time()
+        upload_time = get_pending_upload_time(os.path.dirname(file_path), os.path.basename(file_path))
+        if upload_time is None:
+            if now - start_time > timeout:
+                return False
+        elif now - max(upload_time, start_time) > UPLOAD_STALL_TIMEOUT:
+            print(f"Upload of {os.path.basename(file_path)} is stalled")
+            return False
         time.sleep(delay)
-    return False
+
+
+def remove_tmp_files(file_names: list):
+    """
+    Remove uploaded files of one job from tmp folder with files created near them, as _cut.mp4.
+    Other files are not touched, because they can be inputs of jobs in queue.
+
+    :param file_names: names of files in tmp folder
+    """
+    file_names = [os.path.basename(str(f)) for f in file_names if f]
+    if not file_names:
+        return
+    for f in os.listdir(TMP_FOLDER):
+        if any(f.startswith(file_name) for file_name in file_names):
+            file_path = os.path.join(TMP_FOLDER, f)
+            try:
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+            except OSError as err:
+                print(f"Error during remove tmp file {err}")
+
+
+def make_unique_dir(parent, name):
+    """
+    Create new directory, if name is already used by other job when add number in end.
+
+    :param parent: parent directory
+    :param name: preferred name
+    :return: path to created directory
+    """
+    path = os.path.join(parent, name)
+    num = 1
+    while True:
+        try:
+            os.makedirs(path)
+            return path
+        except FileExistsError:
+            path = os.path.join(parent, f"{name}_{num}")
+            num += 1
 
 
 def _create_localization():
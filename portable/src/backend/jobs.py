@@ -0,0 +1,598 @@
+import os
+import sys
+import json
+import uuid
+import time
+import sqlite3
+import importlib
+import threading
+import traceback
+import multiprocessing
+from io import TextIOBase
+from contextlib import contextmanager
+
+from tqdm import tqdm
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_CANCELLING = "cancelling"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+JOB_FINISHED_STATUSES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+# set inside worker process to report progress of current job from any pipeline
+_current_job = {"queue": None, "job_id": None, "stage": None, "reported_at": 0.0}
+# min seconds between progress events of the same stage
+PROGRESS_EVENT_INTERVAL = 0.25
+
+
+class JobQueue:
+    """
+    Persistent job queue in SQLite, shared between the web server and worker processes.
+    Every method open own connection, so the object can be used from any thread or process.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    task TEXT NOT NULL,
+                    device TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    meta TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT NOT NULL DEFAULT '',
+                    worker TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            # bounded log of events for web server, old events are removed by add_event
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    type TEXT NOT NULL,
+                    job_id TEXT,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)  # autocommit, transactions are explicit
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["meta"] = json.loads(job["meta"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def submit(self, task: str, params: dict, device: str = "cpu", meta: dict = None) -> str:
+        """
+        Put new job in queue
+        :param task: name of task registered in worker tasks
+        :param params: json serializable task parameters
+        :param device: processor requested for job, cpu or cuda
+        :param meta: json serializable data for frontend which not used by worker
+        :return: job id
+        """
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, task, device, status, params, meta, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, task, device, JOB_QUEUED, json.dumps(params), json.dumps(meta or {}), time.time())
+            )
+        return job_id
+
+    def claim(self, worker_id: str, devices: list = None):
+        """
+        Atomically take the oldest queued job
+        :param worker_id: worker name
+        :param devices: list of devices what worker can process or None for any
+        :return: job dict or None
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # lock database for write, so two workers will not take the same job
+            try:
+                if devices:
+                    placeholders = ",".join("?" for _ in devices)
+                    row = conn.execute(
+                        f"SELECT * FROM jobs WHERE status = ? AND device IN ({placeholders}) ORDER BY created_at LIMIT 1",
+                        (JOB_QUEUED, *devices)
+                    ).fetchone()
+                else:
+                    row = conn.execute(
+                        "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (JOB_QUEUED,)
+                    ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, started_at = ? WHERE id = ?",
+                        (JOB_RUNNING, worker_id, time.time(), row["id"])
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._to_dict(row)
+        job["status"] = JOB_RUNNING
+        job["worker"] = worker_id
+        return job
+
+    def add_event(self, event_type: str, job_id: str = None, max_events: int = 1000, **data):
+        """
+        Add event for web server, only last max_events are kept
+        :param event_type: progress or job
+        :param job_id: job id
+        :param max_events: size of events log
+        :param data: json serializable data of event
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO events (type, job_id, data, created_at) VALUES (?, ?, ?, ?)",
+                (event_type, job_id, json.dumps(data), time.time())
+            )
+            if cursor.lastrowid % 100 == 0:
+                conn.execute("DELETE FROM events WHERE id <= ?", (cursor.lastrowid - max_events,))
+
+    def events(self, since_id: int = 0, limit: int = 500) -> list:
+        """Events after id in order"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM events WHERE id > ? ORDER BY id LIMIT ?", (since_id, limit)
+            ).fetchall()
+        return [
+            {"id": row["id"], "type": row["type"], "job_id": row["job_id"], "time": row["created_at"], **json.loads(row["data"])}
+            for row in rows
+        ]
+
+    def last_event_id(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def set_progress(self, job_id: str, progress: float = None, message: str = None):
+        with self._connect() as conn:
+            if progress is not None:
+                conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (float(progress), job_id))
+            if message is not None:
+                conn.execute("UPDATE jobs SET message = ? WHERE id = ?", (str(message), job_id))
+
+    def finish(self, job_id: str, result) -> bool:
+        """Save result of running job, False if job was cancelled during work"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, progress = 1, finished_at = ? WHERE id = ? AND status = ?",
+                (JOB_DONE, json.dumps(result), time.time(), job_id, JOB_RUNNING)
+            )
+            return bool(cursor.rowcount)
+
+    def fail(self, job_id: str, error: str) -> bool:
+        """Save error of job, False if job was cancelled during work"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                (JOB_FAILED, str(error), time.time(), job_id, JOB_RUNNING, JOB_QUEUED)
+            )
+            return bool(cursor.rowcount)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel job. Queued job is cancelled at once, running job is marked and stopped by worker pool
+        :param job_id: job id
+        :return: True if job will be cancelled
+        """
+        with self._connect() as conn:
+            now = time.time()
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (JOB_CANCELLED, now, job_id, JOB_QUEUED)
+            )
+            if cursor.rowcount:
+                return True
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ? WHERE id = ? AND status = ?", (JOB_CANCELLING, job_id, JOB_RUNNING)
+            )
+            return bool(cursor.rowcount)
+
+    def mark_cancelled(self, job_id: str) -> bool:
+        """Finish cancellation of job, False if job is already finished"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (JOB_CANCELLED, time.time(), job_id, JOB_CANCELLING)
+            )
+            return bool(cursor.rowcount)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return job is None or job["status"] in (JOB_CANCELLING, JOB_CANCELLED)
+
+    def get(self, job_id: str):
+        with self._connect() as conn:
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def jobs(self, statuses: tuple = None, since: float = None, worker: str = None) -> list:
+        """
+        Get jobs ordered by creation time
+        :param statuses: filter by statuses
+        :param since: only jobs created after this timestamp
+        :param worker: filter by worker name
+        :return: list of job dicts
+        """
+        query, args = "SELECT * FROM jobs WHERE 1 = 1", []
+        if statuses:
+            query += f" AND status IN ({','.join('?' for _ in statuses)})"
+            args += list(statuses)
+        if since is not None:
+            query += " AND created_at >= ?"
+            args += [since]
+        if worker is not None:
+            query += " AND worker = ?"
+            args += [worker]
+        query += " ORDER BY created_at"
+        with self._connect() as conn:
+            return [self._to_dict(row) for row in conn.execute(query, args).fetchall()]
+
+    def finished_jobs(self, since: float = None) -> list:
+        """Finished jobs in order of finish, new jobs are always appended in the end"""
+        query, args = "SELECT * FROM jobs WHERE status IN (?, ?, ?)", list(JOB_FINISHED_STATUSES)
+        if since is not None:
+            query += " AND created_at >= ?"
+            args += [since]
+        query += " ORDER BY finished_at, id"
+        with self._connect() as conn:
+            return [self._to_dict(row) for row in conn.execute(query, args).fetchall()]
+
+    def count(self, status: str) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def recover(self):
+        """After restart of application return interrupted jobs in queue and finish interrupted cancellation"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE status = ?",
+                (JOB_CANCELLED, time.time(), JOB_CANCELLING)
+            )
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, started_at = NULL, progress = 0 WHERE status = ?",
+                (JOB_QUEUED, JOB_RUNNING)
+            )
+
+
+def report_progress(progress: float = None, message: str = None, frame: int = None, total: int = None,
+                    fps: float = None, eta: float = None):
+    """
+    Report progress of current job from pipeline, does nothing if code is run outside worker.
+    Progress event is sent to web server not more often than PROGRESS_EVENT_INTERVAL for the same stage.
+    :param progress: value from 0 to 1
+    :param message: short message about stage
+    :param frame: number of processed frames
+    :param total: number of frames
+    :param fps: processed frames per second
+    :param eta: seconds to finish stage
+    """
+    queue, job_id = _current_job["queue"], _current_job["job_id"]
+    if queue is None or job_id is None:
+        return
+    try:
+        queue.set_progress(job_id, progress, message)
+        now = time.time()
+        stage = message if message is not None else _current_job["stage"]
+        if stage != _current_job["stage"] or now - _current_job["reported_at"] >= PROGRESS_EVENT_INTERVAL or (progress or 0) >= 1:
+            _current_job["stage"], _current_job["reported_at"] = stage, now
+            data = {"progress": progress, "stage": stage, "frame": frame, "total": total, "fps": fps, "eta": eta}
+            queue.add_event("progress", job_id, **{key: value for key, value in data.items() if value is not None})
+    except sqlite3.Error as err:
+        print(f"Error during update job progress {err}")
+
+
+def report_job_status(queue: JobQueue, job_id: str, status: str, **data):
+    """Send event about new status of job to web server"""
+    try:
+        queue.add_event("job", job_id, status=status, **data)
+    except sqlite3.Error as err:
+        print(f"Error during send job event {err}")
+
+
+class ProgressTqdm(tqdm):
+    """
+    Progress bar of pipelines which also reports stage, frames, fps and eta of current job.
+    It is installed instead of tqdm in worker process, so each stage with progress bar sends progress events.
+    """
+    def __init__(self, *args, **kwargs):
+        self._reported_at = 0.0
+        self._reported_n = None
+        super().__init__(*args, **kwargs)
+
+    def update(self, n=1):
+        displayed = super().update(n)
+        if self.disable:
+            return displayed
+        now = time.time()
+        # set_progress writes in database, so progress is not reported on each frame
+        if now - self._reported_at >= PROGRESS_EVENT_INTERVAL or (self.total and self.n >= self.total):
+            self._reported_at = now
+            self.report()
+        return displayed
+
+    def close(self):
+        # iteration sets the last number of items on close without update
+        if not self.disable and self.n != self._reported_n:
+            self.report()
+        super().close()
+
+    def report(self):
+        self._reported_n = self.n
+        if _current_job["job_id"] is None:
+            return
+        elapsed = time.time() - self.start_t
+        rate = self.n / elapsed if self.n > 0 and elapsed >= PROGRESS_EVENT_INTERVAL else None  # average, first updates are noisy
+        total = int(self.total) if self.total else None
+        report_progress(
+            progress=min(self.n / total, 1.0) if total else None, message=(self.desc or "Processing").rstrip(": "),
+            frame=int(self.n), total=total, fps=round(rate, 2) if rate else None,
+            eta=round((total - self.n) / rate, 1) if total and rate else None
+        )
+
+
+def install_progress_tqdm():
+    """Replace tqdm for modules which are imported after this call"""
+    import tqdm as tqdm_module
+    tqdm_module.tqdm = ProgressTqdm
+
+
+class JobLogStream(TextIOBase):
+    """
+    Output of worker process which is also sent to web server as log events, because console of frontend
+    is in web server process. Lines are sent when finished, progress bars updated by carriage return
+    are sent not more often than PROGRESS_EVENT_INTERVAL.
+    """
+    def __init__(self, stream, queue: JobQueue, stream_name: str):
+        """
+        Initialization
+        :param stream: original stream of process, can be None for process without console
+        :param queue: job queue
+        :param stream_name: stdout or stderr
+        """
+        super().__init__()
+        self.stream = stream
+        self.queue = queue
+        self.stream_name = stream_name
+        self.buffer = ""
+        self.sent_at = 0.0
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, msg):
+        if isinstance(msg, bytes):
+            msg = msg.decode('utf-8', errors='ignore')
+        if self.stream is not None:
+            self.stream.write(msg)
+        with self.lock:
+            self.buffer += msg
+            while "\n" in self.buffer:
+                line, self.buffer = self.buffer.split("\n", 1)
+                # only last state of progress bar, carriage return is kept to replace sent state in frontend
+                self._send(line[line.rindex("\r"):] + "\n" if "\r" in line else line + "\n")
+            if "\r" in self.buffer:
+                self.buffer = self.buffer[self.buffer.rindex("\r"):]
+                now = time.time()
+                if now - self.sent_at >= PROGRESS_EVENT_INTERVAL:
+                    self.sent_at = now
+                    self._send(self.buffer)
+        return len(msg)
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+    def _send(self, text: str):
+        if not text.strip():
+            return
+        try:
+            self.queue.add_event("log", _current_job["job_id"], text=text, stream=self.stream_name)
+        except sqlite3.Error:
+            pass  # log is still in console of worker
+
+
+def _worker_devices(device: str):
+    """Which job devices can be processed by worker with this device"""
+    if device == "auto":
+        return None
+    if device.startswith("cuda"):
+        return ["cuda"]
+    return ["cpu"]
+
+
+def _worker_main(db_path: str, worker_id: str, device: str, tasks_module: str, poll_interval: float,
+                 current_job_id=None, job_lock=None):
+    """
+    Entry point of worker process
+    :param current_job_id: shared char array with id of job which is processed now, supervisor reads it before terminate
+    :param job_lock: shared lock for current_job_id, supervisor holds it while terminates worker
+    """
+    def set_current_job_id(job_id: str):
+        if current_job_id is not None:
+            with job_lock:
+                current_job_id.value = job_id.encode("ascii")
+
+    if device.startswith("cuda:"):
+        # worker own only one GPU, inside process it is visible as cuda
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":", 1)[1]
+    if device != "auto":
+        os.environ["WUNJO_TORCH_DEVICE"] = "cuda" if device.startswith("cuda") else "cpu"
+
+    install_progress_tqdm()  # before import of pipelines, they import tqdm on import
+    tasks = importlib.import_module(tasks_module).JOB_TASKS
+    queue = JobQueue(db_path)
+    _current_job["queue"] = queue
+    # prints, progress bars and errors of pipelines are shown in console of frontend
+    sys.stdout = JobLogStream(sys.stdout, queue, "stdout")
+    sys.stderr = JobLogStream(sys.stderr, queue, "stderr")
+    accept_devices = _worker_devices(device)
+
+    while True:
+        job = queue.claim(worker_id, accept_devices)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        set_current_job_id(job["id"])
+        if device == "auto":
+            os.environ["WUNJO_TORCH_DEVICE"] = job["device"]
+        _current_job["job_id"], _current_job["stage"] = job["id"], None
+        report_job_status(queue, job["id"], JOB_RUNNING, task=job["task"], worker=worker_id)
+        print(f"Worker {worker_id} started job {job['task']} {job['id']}")
+        try:
+            task = tasks.get(job["task"])
+            if task is None:
+                raise Exception(f"Task {job['task']} is not registered")
+            result = task(job["params"])
+            if queue.finish(job["id"], result):
+                report_job_status(queue, job["id"], JOB_DONE, task=job["task"])
+                print(f"Worker {worker_id} finished job {job['task']} {job['id']}")
+            elif queue.mark_cancelled(job["id"]):
+                # job was cancelled before supervisor stopped worker
+                report_job_status(queue, job["id"], JOB_CANCELLED, task=job["task"])
+                print(f"Job {job['id']} cancelled")
+        except Exception as err:
+            if os.environ.get('DEBUG', 'False') == 'True':
+                traceback.print_exc()
+            print(f"Error ... {err}")
+            if queue.fail(job["id"], str(err)):
+                report_job_status(queue, job["id"], JOB_FAILED, task=job["task"], error=str(err))
+            elif queue.mark_cancelled(job["id"]):
+                report_job_status(queue, job["id"], JOB_CANCELLED, task=job["task"])
+                print(f"Job {job['id']} cancelled")
+        finally:
+            _current_job["job_id"] = None
+            set_current_job_id("")  # before next job is claimed, so supervisor does not stop next job
+
+
+class WorkerPool:
+    """
+    Pool of worker processes, each worker own one device and process jobs from queue one by one.
+    Supervisor thread restarts died workers and terminates workers whose job was cancelled.
+    """
+    def __init__(self, queue: JobQueue, devices: list, tasks_module: str, poll_interval: float = 1.0):
+        """
+        Initialization
+        :param queue: job queue
+        :param devices: list of devices for workers as auto, cpu, cuda or cuda:N, one worker per item
+        :param tasks_module: module with JOB_TASKS dict of task name to function(params)
+        :param poll_interval: seconds between queue checks
+        """
+        self.queue = queue
+        self.devices = devices
+        self.tasks_module = tasks_module
+        self.poll_interval = poll_interval
+        self.context = multiprocessing.get_context("spawn")  # cuda can not be used in forked process
+        self.workers = {}
+        self._stop = threading.Event()
+        self._supervisor = None
+
+    def _spawn(self, worker_id: str, device: str):
+        current_job_id = self.context.Array("c", 64, lock=False)
+        job_lock = self.context.Lock()
+        process = self.context.Process(
+            target=_worker_main, args=(
+                self.queue.db_path, worker_id, device, self.tasks_module, self.poll_interval, current_job_id, job_lock
+            ),
+            name=f"wunjo-{worker_id}", daemon=True
+        )
+        process.start()
+        self.workers[worker_id] = {"process": process, "device": device, "current_job_id": current_job_id, "job_lock": job_lock}
+
+    def _terminate_job(self, worker: dict, job_id: str) -> bool:
+        """
+        Terminate worker only if it still process cancelled job
+        :param worker: worker
+        :param job_id: cancelled job
+        :return: False if worker is alive and does not process job now, cancellation is finished by worker
+        """
+        process = worker["process"]
+        if not process.is_alive():
+            return True
+        # worker changes current job under the same lock, so it can not take next job during check
+        if not worker["job_lock"].acquire(timeout=1):
+            return False
+        try:
+            if worker["current_job_id"].value.decode("ascii") != job_id:
+                return False
+            process.terminate()
+            process.join(timeout=10)
+            return True
+        finally:
+            worker["job_lock"].release()
+
+    def start(self):
+        self.queue.recover()
+        for i, device in enumerate(self.devices):
+            self._spawn(f"worker-{i}", device)
+        self._supervisor = threading.Thread(target=self._supervise, name="wunjo-supervisor", daemon=True)
+        self._supervisor.start()
+        print(f"Started {len(self.devices)} worker(s) on {', '.join(self.devices)}")
+
+    def stop(self):
+        self._stop.set()
+        for worker in self.workers.values():
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+
+    def _supervise(self):
+        while not self._stop.wait(self.poll_interval):
+            for worker_id, worker in list(self.workers.items()):
+                process = worker["process"]
+                # stop worker which process cancelled job, there is no safe way to stop model inside process
+                for job in self.queue.jobs(statuses=(JOB_CANCELLING,), worker=worker_id):
+                    if not self._terminate_job(worker, job["id"]):
+                        continue
+                    if self.queue.mark_cancelled(job["id"]):
+                        report_job_status(self.queue, job["id"], JOB_CANCELLED, task=job["task"])
+                        print(f"Job {job['id']} cancelled")
+                if not process.is_alive():
+                    for job in self.queue.jobs(statuses=(JOB_RUNNING,), worker=worker_id):
+                        self.queue.fail(job["id"], f"Worker stopped with code {process.exitcode}")
+                        report_job_status(self.queue, job["id"], JOB_FAILED, task=job["task"], error=f"Worker stopped with code {process.exitcode}")
+                    self._spawn(worker_id, worker["device"])
+
+    def status(self) -> list:
+        return [
+            {"worker": worker_id, "device": worker["device"], "alive": worker["process"].is_alive()}
+            for worker_id, worker in self.workers.items()
+        ]
+
+
+def get_worker_devices() -> list:
+    """
+    Devices of workers from WUNJO_WORKERS environment variable, for example cuda:0,cuda:1,cpu.
+    By default one worker which use processor chosen by user for each job.
+    """
+    workers = os.environ.get("WUNJO_WORKERS", "auto")
+    devices = [device.strip() for device in workers.split(",") if device.strip()]
+    return devices if devices else ["auto"]
@@ -0,0 +1,217 @@
+import os
+import cv2
+import json
+import struct
+import numpy as np
+
+
+# Binary masks of all objects of one clip in one file instead of PNG image for each frame and object.
+# File is header with json meta, index table (objects, frames, offset and length) and run length encoded
+# masks appended after index. Index and data are memory mapped, so mask is read by frame without decoding images.
+# Dilation and inversion are applied on read, masks are stored as they are predicted.
+
+_MAGIC = b"WMSK"
+_VERSION = 1
+_HEADER = struct.Struct("<4sII")  # magic, version, length of json meta
+_MAX_RUN = np.iinfo(np.uint16).max
+
+
+def encode_mask(mask: np.ndarray) -> bytes:
+    """
+    Run length encoding of flatten mask, runs are alternating from False.
+    Runs longer than uint16 are split by runs with zero length of other value
+    :param mask: bool mask (H, W)
+    :return: bytes of uint16 runs
+    """
+    flat = mask.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    runs = np.diff(bounds)
+    if flat.size > 0 and flat[0]:
+        runs = np.concatenate(([0], runs))
+    long_runs = np.flatnonzero(runs > _MAX_RUN)
+    if long_runs.size > 0:
+        parts, start = [], 0
+        for i in long_runs:
+            count, rest = divmod(int(runs[i]), _MAX_RUN)
+            parts += [runs[start:i], [_MAX_RUN, 0] * count, [rest]]
+            start = i + 1
+        parts.append(runs[start:])
+        runs = np.concatenate(parts)
+    return runs.astype(np.uint16).tobytes()
+
+
+def decode_mask(data, height: int, width: int) -> np.ndarray:
+    """
+    Decode run length encoded mask
+    :param data: bytes or uint8 array of uint16 runs
+    :param height: mask height
+    :param width: mask width
+    :return: bool mask (H, W)
+    """
+    runs = np.frombuffer(data, dtype=np.uint16)
+    values = np.arange(runs.size) % 2 == 1
+    return np.repeat(values, runs).reshape(height, width)
+
+
+class MaskStore:
+    """
+    Masks of objects for frames of clip in one memory mapped file with random access by frame name or index
+    """
+    def __init__(self, path: str, writable: bool = True):
+        """
+        Open existing store, use MaskStore.create to make new store
+        :param path: path to file
+        :param writable: open to write masks
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            magic, version, meta_length = _HEADER.unpack(file.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(f"{path} is not mask store")
+            meta = json.loads(file.read(meta_length).decode("utf-8"))
+        self.keys = meta["keys"]
+        self.frame_names = meta["frames"]
+        self.width, self.height = meta["width"], meta["height"]
+        self.kernel_sizes = meta["kernel_sizes"]
+        self.inverted = set(meta["inverted"])
+        self._key_index = {key: i for i, key in enumerate(self.keys)}
+        self._frame_index = {name: i for i, name in enumerate(self.frame_names)}
+        index_offset = self._index_offset(meta_length)
+        self.index = np.memmap(path, dtype=np.int64, mode="r+" if writable else "r", offset=index_offset,
+                               shape=(len(self.keys), len(self.frame_names), 2))
+        self._file = open(path, "r+b") if writable else None
+        self._data = None
+
+    @staticmethod
+    def _index_offset(meta_length: int) -> int:
+        return -(-(_HEADER.size + meta_length) // 8) * 8
+
+    @classmethod
+    def create(cls, path: str, frame_names: list, keys: list, width: int, height: int, kernel_sizes: dict = None, inverted: list = ()):
+        """
+        Create empty store
+        :param path: path to file
+        :param frame_names: names of frames of clip in order
+        :param keys: objects
+        :param width: width of masks
+        :param height: height of masks
+        :param kernel_sizes: dilation of mask for object on read
+        :param inverted: objects which are inverted on read after dilation
+        :return: MaskStore
+        """
+        meta = {
+            "keys": [str(key) for key in keys], "frames": list(frame_names), "width": int(width), "height": int(height),
+            "kernel_sizes": {str(key): int(size) for key, size in (kernel_sizes or {}).items()}, "inverted": [str(key) for key in inverted]
+        }
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        index = np.full((len(keys), len(frame_names), 2), -1, dtype=np.int64)  # offset -1 means mask is not saved
+        with open(path, "wb") as file:
+            file.write(_HEADER.pack(_MAGIC, _VERSION, len(meta_bytes)))
+            file.write(meta_bytes)
+            file.write(b"\0" * (cls._index_offset(len(meta_bytes)) - _HEADER.size - len(meta_bytes)))
+            file.write(index.tobytes())
+        return cls(path)
+
+    def _get_index(self, key, frame):
+        frame = frame if isinstance(frame, (int, np.integer)) else self._frame_index[frame]
+        return self._key_index[str(key)], frame
+
+    def has(self, key, frame) -> bool:
+        """Mask of object is saved for frame"""
+        return bool(self.index[self._get_index(key, frame)][0] >= 0)
+
+    def frames(self, key) -> list:
+        """Names of frames with saved mask of object"""
+        return [self.frame_names[i] for i in np.flatnonzero(self.index[self._key_index[str(key)], :, 0] >= 0)]
+
+    def write(self, key, frame, mask: np.ndarray, union: bool = False):
+        """
+        Save mask of object for frame
+        :param key: object
+        :param frame: frame name or index
+        :param mask: mask (H, W) or (1, 1, H, W) of any size, values above zero are mask
+        :param union: union with saved mask
+        """
+        if mask.ndim == 4:
+            mask = mask[0, 0]
+        if mask.shape[:2] != (self.height, self.width):
+            mask = cv2.resize(mask.astype(np.uint8), (self.width, self.height), interpolation=cv2.INTER_NEAREST)
+        mask = mask > 0
+        key_index, frame_index = self._get_index(key, frame)
+        if union and self.index[key_index, frame_index, 0] >= 0:
+            mask = mask | self._read_raw(key_index, frame_index)
+        data = encode_mask(mask)
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        self.index[key_index, frame_index] = (offset, len(data))
+
+    def _read_raw(self, key_index: int, frame_index: int):
+        offset, length = self.index[key_index, frame_index]
+        if offset < 0:
+            return np.zeros((self.height, self.width), dtype=bool)
+        if self._data is None or offset + length > self._data.size:
+            # file is grown by writes after last map
+            self._data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return decode_mask(self._data[offset:offset + length], self.height, self.width)
+
+    def read(self, key, frame, kernel_size: int = None) -> np.ndarray:
+        """
+        Read mask of object for frame, not saved mask is empty
+        :param key: object
+        :param frame: frame name or index
+        :param kernel_size: dilation, None to use kernel size of object
+        :return: bool mask (H, W)
+        """
+        key_index, frame_index = self._get_index(key, frame)
+        mask = self._read_raw(key_index, frame_index)
+        kernel_size = self.kernel_sizes.get(str(key), 0) if kernel_size is None else kernel_size
+        if kernel_size > 1 and mask.any():
+            mask = cv2.dilate(mask.view(np.uint8), np.ones((kernel_size, kernel_size), np.uint8), iterations=1) > 0
+        if str(key) in self.inverted:
+            mask = ~mask
+        return mask
+
+    def read_union(self, frame, keys: list = None) -> np.ndarray:
+        """
+        Union of masks of objects for frame
+        :param frame: frame name or index
+        :param keys: objects, None for all objects
+        :return: bool mask (H, W)
+        """
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        for key in self.keys if keys is None else keys:
+            if self.has(key, frame):
+                mask |= self.read(key, frame)
+        return mask
+
+    def export_png(self, key, folder: str):
+        """Save masks of object as black and white PNG files with frame names to edit them manually"""
+        os.makedirs(folder, exist_ok=True)
+        key_index = self._key_index[str(key)]
+        for name in self.frames(key):
+            cv2.imwrite(os.path.join(folder, name), self._read_raw(key_index, self._frame_index[name]).astype(np.uint8) * 255)
+
+    def import_png(self, key, folder: str):
+        """Save masks of object from PNG files with frame names, pixels above 128 are mask"""
+        for name in sorted(os.listdir(folder)):
+            if name in self._frame_index:
+                self.write(key, name, cv2.imread(os.path.join(folder, name), cv2.IMREAD_GRAYSCALE) > 128)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # memory maps have to be released before file is removed on Windows
+        if isinstance(self.index, np.memmap):
+            self.index.flush()
+        self.index = None
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,102 @@
+from functools import lru_cache
+
+import librosa
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Mel front-end shared by lip sync, speech synthesizer, vocoder and speech enhancement.
+# Filterbanks are built by librosa once for each set of parameters and used again by next calls.
+
+
+@lru_cache(maxsize=16)
+def get_mel_basis(sample_rate: int, n_fft: int, n_mels: int, fmin: float = 0.0, fmax: float = None, htk: bool = False) -> np.ndarray:
+    """
+    Mel filterbank cached by parameters
+    :return: read-only array (n_mels, 1 + n_fft // 2)
+    """
+    mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax, htk=htk)
+    mel_basis.setflags(write=False)
+    return mel_basis
+
+
+@lru_cache(maxsize=16)
+def get_inv_mel_basis(sample_rate: int, n_fft: int, n_mels: int, fmin: float = 0.0, fmax: float = None, htk: bool = False) -> np.ndarray:
+    """Pseudo inverse of mel filterbank cached by parameters"""
+    inv_mel_basis = np.linalg.pinv(get_mel_basis(sample_rate, n_fft, n_mels, fmin, fmax, htk))
+    inv_mel_basis.setflags(write=False)
+    return inv_mel_basis
+
+
+_torch_mel_basis = {}
+
+
+def get_mel_basis_torch(sample_rate: int, n_fft: int, n_mels: int, fmin: float = 0.0, fmax: float = None, htk: bool = False, device: str = "cpu"):
+    """Mel filterbank as torch tensor on device cached by parameters"""
+    import torch
+
+    key = (sample_rate, n_fft, n_mels, fmin, fmax, htk, str(device))
+    if key not in _torch_mel_basis:
+        mel_basis = get_mel_basis(sample_rate, n_fft, n_mels, fmin, fmax, htk)
+        _torch_mel_basis[key] = torch.from_numpy(np.array(mel_basis, dtype=np.float32)).to(device)
+    return _torch_mel_basis[key]
+
+
+def mel_magnitude(y: np.ndarray, sample_rate: int, n_fft: int, hop_length: int, win_length: int, n_mels: int,
+                  fmin: float = 0.0, fmax: float = None, htk: bool = False, device: str = None) -> np.ndarray:
+    """
+    Mel spectrogram amplitude of signal, STFT is the same as librosa.stft with center and reflect padding
+    :param y: signal
+    :param device: torch device to compute STFT and filterbank product, None to compute by librosa and numpy
+    :return: array (n_mels, frames)
+    """
+    if device is None:
+        spectrogram = np.abs(librosa.stft(y=y, n_fft=n_fft, hop_length=hop_length, win_length=win_length, pad_mode="reflect"))
+        return np.dot(get_mel_basis(sample_rate, n_fft, n_mels, fmin, fmax, htk), spectrogram)
+
+    import torch
+
+    with torch.no_grad():
+        signal = torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32)).to(device)
+        window = torch.hann_window(win_length, device=device)
+        spectrogram = torch.stft(
+            signal, n_fft, hop_length=hop_length, win_length=win_length, window=window, center=True, pad_mode="reflect",
+            return_complex=True
+        ).abs()
+        mel = torch.matmul(get_mel_basis_torch(sample_rate, n_fft, n_mels, fmin, fmax, htk, device), spectrogram)
+    return mel.cpu().numpy()
+
+
+class MelChunks:
+    """
+    Mel chunks for each video frame as strided views of one mel spectrogram, chunks are not copied.
+    Chunk i starts from int(i * mel_fps / fps), last chunk is end of mel.
+    """
+    def __init__(self, mel: np.ndarray, fps: float, step_size: int = 16, mel_fps: float = 80.):
+        """
+        Initialization
+        :param mel: mel spectrogram (n_mels, frames)
+        :param fps: frames per second of video
+        :param step_size: number of mel frames in chunk
+        :param mel_fps: mel frames per second
+        """
+        if mel.shape[1] < step_size:
+            # too short audio is extended by last mel frame
+            mel = np.pad(mel, ((0, 0), (0, step_size - mel.shape[1])), mode="edge")
+        self.windows = sliding_window_view(mel, step_size, axis=1)  # (n_mels, frames - step_size + 1, step_size)
+        last_start = mel.shape[1] - step_size
+        mel_idx_multiplier = mel_fps / fps
+        starts = (np.arange(int(last_start / mel_idx_multiplier) + 2) * mel_idx_multiplier).astype(int)
+        self.starts = np.append(starts[starts <= last_start], last_start)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return self.windows[:, self.starts[idx]]
+
+    def __iter__(self):
+        for start in self.starts:
+            yield self.windows[:, start]
@@ -0,0 +1,211 @@
+import os
+import gc
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import torch
+
+
+# Models loaded in this process are kept in registry and used again by next jobs.
+# Each model is keyed by (name, device, precision). When memory budget of device is exceeded,
+# the least recently used models are removed from registry.
+
+
+def estimate_model_size(model, max_depth: int = 4) -> int:
+    """
+    Estimate memory of model by torch tensors and onnx files inside object
+    :param model: model object, dict, list or class with models in attributes
+    :param max_depth: max depth of attributes
+    :return: size in bytes
+    """
+    visited = set()
+
+    def walk(obj, depth):
+        if obj is None or id(obj) in visited or depth > max_depth or isinstance(obj, (str, bytes, int, float, bool)):
+            return 0
+        visited.add(id(obj))
+        if isinstance(obj, torch.Tensor):
+            return obj.numel() * obj.element_size()
+        if isinstance(obj, torch.nn.Module):
+            size = sum(p.numel() * p.element_size() for p in obj.parameters())
+            return size + sum(b.numel() * b.element_size() for b in obj.buffers())
+        if isinstance(obj, dict):
+            return sum(walk(value, depth + 1) for value in obj.values())
+        if isinstance(obj, (list, tuple, set)):
+            return sum(walk(value, depth + 1) for value in obj)
+        size = 0
+        # onnx sessions do not show tensors, use size of model file
+        for attr in ("model_file", "_model_path", "model_path"):
+            path = getattr(obj, attr, None)
+            if isinstance(path, str) and os.path.isfile(path):
+                size += os.path.getsize(path)
+                break
+        if hasattr(obj, "__dict__"):
+            size += sum(walk(value, depth + 1) for value in vars(obj).values())
+        return size
+
+    return walk(model, 0)
+
+
+def get_memory_budget(device: str) -> int:
+    """
+    Memory budget for models of device. Can be set in Gb by WUNJO_MODEL_RAM_BUDGET and WUNJO_MODEL_VRAM_BUDGET
+    :param device: cuda or cpu
+    :return: budget in bytes
+    """
+    if "cuda" in device:
+        budget = os.environ.get("WUNJO_MODEL_VRAM_BUDGET")
+        if budget is not None:
+            return int(float(budget) * 1024 ** 3)
+        if torch.cuda.is_available():
+            # half of VRAM, the other part is needed for processing and models out of registry
+            return int(torch.cuda.get_device_properties(0).total_memory * 0.5)
+        return 0
+    return int(float(os.environ.get("WUNJO_MODEL_RAM_BUDGET", 8)) * 1024 ** 3)
+
+
+def get_free_memory(device: str) -> int:
+    """
+    Free memory of device for processing, memory cached by torch allocator is free for torch too
+    :param device: cuda or cpu
+    :return: free memory in bytes
+    """
+    if "cuda" in str(device) and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return get_memory_budget("cpu")
+
+
+class ModelRegistry:
+    """
+    Loaded models of process with LRU eviction by memory budget of RAM and VRAM and async preloading
+    """
+    def __init__(self):
+        self.models = OrderedDict()  # key: {"model", "size", "last_used"}
+        self.loading = {}  # key: future of model which is loading now
+        self.lock = threading.RLock()
+        self.executor = None
+
+    @staticmethod
+    def get_key(name: str, device: str = "cpu", precision: str = "fp32") -> tuple:
+        return name, "cuda" if "cuda" in str(device) else "cpu", precision
+
+    def get(self, name: str, loader, device: str = "cpu", precision: str = "fp32", files: list = None):
+        """
+        Get loaded model or load by loader
+        :param name: model name
+        :param loader: function without arguments which loads model
+        :param device: device of model
+        :param precision: precision of model
+        :param files: checkpoint files to estimate size of model before load
+        :return: model
+        """
+        key = self.get_key(name, device, precision)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.models[key]["last_used"] = time.time()
+                return self.models[key]["model"]
+            future = self.loading.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.loading[key] = future
+        if not is_owner:
+            return future.result()  # model is loading in other thread
+
+        try:
+            model = self._load(key, loader, files)
+        except Exception as err:
+            with self.lock:
+                self.loading.pop(key, None)
+            future.set_exception(err)
+            raise
+        with self.lock:
+            self.loading.pop(key, None)
+        future.set_result(model)
+        return model
+
+    def preload(self, name: str, loader, device: str = "cpu", precision: str = "fp32", files: list = None) -> Future:
+        """
+        Load model in background thread, get will wait this model instead of load again
+        :return: future of model
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(self.get, name, loader, device, precision, files)
+
+    def _load(self, key: tuple, loader, files: list = None):
+        name, device, _ = key
+        expected_size = sum(os.path.getsize(f) for f in files or [] if os.path.isfile(f))
+        self.evict(device, expected_size)
+
+        cuda_before = torch.cuda.memory_allocated() if device == "cuda" and torch.cuda.is_available() else None
+        print(f"Load model {name} on {device}")
+        model = loader()
+        if cuda_before is not None:
+            size = max(torch.cuda.memory_allocated() - cuda_before, 0)
+        else:
+            size = 0
+        size = size or estimate_model_size(model) or expected_size
+
+        with self.lock:
+            self.models[key] = {"model": model, "size": size, "last_used": time.time()}
+        self.evict(device, keep=key)
+        return model
+
+    def usage(self, device: str) -> int:
+        device = "cuda" if "cuda" in str(device) else "cpu"
+        with self.lock:
+            return sum(entry["size"] for key, entry in self.models.items() if key[1] == device)
+
+    def evict(self, device: str, extra_size: int = 0, keep: tuple = None):
+        """
+        Remove least recently used models of device while models with extra size are more than budget
+        :param device: device
+        :param extra_size: size of model which will be loaded
+        :param keep: key which should not be removed
+        :return: None
+        """
+        device = "cuda" if "cuda" in str(device) else "cpu"
+        budget = get_memory_budget(device)
+        removed = False
+        with self.lock:
+            for key in list(self.models.keys()):
+                if self.usage(device) + extra_size <= budget:
+                    break
+                if key[1] != device or key == keep:
+                    continue
+                print(f"Remove model {key[0]} from {device} memory")
+                del self.models[key]
+                removed = True
+        if removed:
+            gc.collect()
+            if device == "cuda":
+                torch.cuda.empty_cache()
+
+    def remove(self, name: str, device: str = "cpu", precision: str = "fp32"):
+        with self.lock:
+            self.models.pop(self.get_key(name, device, precision), None)
+
+    def clear(self, device: str = None):
+        """
+        Remove all models or models of device
+        :param device: device or None for all devices
+        :return: None
+        """
+        with self.lock:
+            for key in list(self.models.keys()):
+                if device is None or key[1] == ("cuda" if "cuda" in str(device) else "cpu"):
+                    del self.models[key]
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+model_registry = ModelRegistry()
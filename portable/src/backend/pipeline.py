@@ -0,0 +1,63 @@
+import queue
+import threading
+
+
+# Helpers to run processing as stages in threads connected by bounded queues.
+# Stage gets None from previous stage as end of items, after error of any stage all stages are stopped by event.
+
+
+class StageCounter:
+    """Throughput of pipeline stage to see which stage is bottleneck"""
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items: int, seconds: float):
+        with self.lock:
+            self.items += items
+            self.busy += seconds
+
+    def __str__(self):
+        speed = self.items / self.busy if self.busy > 0 else 0
+        return f"{self.name} {speed:.1f} frames/s busy {self.busy:.1f} s"
+
+
+def put_until_stopped(stage_queue, item, stop_event) -> bool:
+    """Wait free place in queue, but check what pipeline is not stopped"""
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_stage(process, in_queue, out_queue, stop_event, errors):
+    """
+    Run stage of pipeline in thread until None from previous stage
+    :param process: function of item, result is put in next queue
+    :param in_queue: queue of previous stage
+    :param out_queue: queue of next stage or None
+    :param stop_event: event to stop all stages after error
+    :param errors: list of errors of stages
+    """
+    try:
+        while not stop_event.is_set():
+            try:
+                item = in_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            result = process(item)
+            if out_queue is not None:
+                put_until_stopped(out_queue, result, stop_event)
+    except Exception as err:
+        errors.append(err)
+        stop_event.set()
+    finally:
+        if out_queue is not None:
+            put_until_stopped(out_queue, None, stop_event)
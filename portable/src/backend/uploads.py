@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+
+from werkzeug.utils import secure_filename
+
+
+# Resumable upload of media to tmp folder. Client creates upload with name and size, sends body of file
+# by chunks with explicit offset and commits upload. Chunks are streamed to part file without read in memory,
+# offset is size of part file, so chunk which is sent again after error is not appended twice.
+# Committed file appears in tmp folder by atomic rename, so existence of file means what upload is finished.
+# File with the same content as already uploaded file is linked to it instead of keep second copy.
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # size of block of stream which is written to disk
+UPLOAD_STALL_TIMEOUT = 120  # seconds without new chunks after which upload is counted as failed
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status_code: int = 400, **data):
+        super().__init__(message)
+        self.status_code = status_code
+        self.data = data
+
+
+def get_upload_folder(folder: str) -> str:
+    return os.path.join(folder, ".uploads")
+
+
+def get_pending_upload_time(folder: str, filename: str):
+    """
+    Time of last chunk of not committed upload of file, can be used in other process
+    :param folder: tmp folder
+    :param filename: name of file in tmp folder
+    :return: time or None if upload of file is not created
+    """
+    upload_folder = get_upload_folder(folder)
+    if not os.path.isdir(upload_folder):
+        return None
+    last_time = None
+    for name in os.listdir(upload_folder):
+        if not name.endswith(".json"):
+            continue
+        meta_path = os.path.join(upload_folder, name)
+        try:
+            with open(meta_path, "r") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            continue
+        if meta.get("filename") != filename:
+            continue
+        part_path = meta_path[:-len(".json")] + ".part"
+        upload_time = os.path.getmtime(part_path if os.path.exists(part_path) else meta_path)
+        last_time = upload_time if last_time is None else max(last_time, upload_time)
+    return last_time
+
+
+class UploadManager:
+    """Resumable uploads of files to one folder"""
+    def __init__(self, folder: str):
+        """
+        Initialization
+        :param folder: folder of committed files
+        """
+        self.folder = folder
+        self.upload_folder = get_upload_folder(folder)
+        os.makedirs(self.upload_folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.upload_locks = {}
+        self.hashers = {}  # upload id: (sha256 of received part, offset of hash)
+        self.content_hashes = {}  # sha256: name of committed file, to link files with the same content
+
+    def _paths(self, upload_id: str):
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            raise UploadError("Invalid upload id", 400)
+        base = os.path.join(self.upload_folder, upload_id)
+        return base + ".part", base + ".json"
+
+    def _get_lock(self, upload_id: str) -> threading.Lock:
+        with self.lock:
+            return self.upload_locks.setdefault(upload_id, threading.Lock())
+
+    def _read_meta(self, upload_id: str) -> dict:
+        _, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise UploadError("Upload not found", 404)
+
+    def _find_content(self, sha256: str, size: int):
+        name = self.content_hashes.get(sha256)
+        if name is None:
+            return None
+        path = os.path.join(self.folder, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            # file is removed by job, content is not available
+            self.content_hashes.pop(sha256, None)
+            return None
+        return path
+
+    def _link(self, source: str, target: str):
+        tmp_path = target + ".link"
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            # file system without hard links
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def create(self, filename: str, size: int, sha256: str = None) -> dict:
+        """
+        Create upload, if content with sha256 is already uploaded then file is committed without upload
+        :param filename: name of file in folder
+        :param size: size of file in bytes
+        :param sha256: optional hash of content computed by client
+        :return: status of upload
+        """
+        filename = secure_filename(filename or "")
+        if not filename:
+            raise UploadError("No file selected", 400)
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise UploadError("Invalid size", 400)
+        if size < 0:
+            raise UploadError("Invalid size", 400)
+        if sha256:
+            sha256 = sha256.lower()
+            existing_path = self._find_content(sha256, size)
+            if existing_path is not None:
+                self._link(existing_path, os.path.join(self.folder, filename))
+                self.content_hashes[sha256] = filename
+                return {"upload_id": None, "filename": filename, "offset": size, "size": size, "sha256": sha256, "status": "committed"}
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._paths(upload_id)
+        open(part_path, "wb").close()
+        with open(meta_path, "w") as file:
+            json.dump({"filename": filename, "size": size, "sha256": sha256, "created": time.time()}, file)
+        return {"upload_id": upload_id, "filename": filename, "offset": 0, "size": size, "sha256": sha256, "status": "created"}
+
+    def status(self, upload_id: str) -> dict:
+        """Offset from which client continues upload"""
+        meta = self._read_meta(upload_id)
+        part_path, _ = self._paths(upload_id)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return {"upload_id": upload_id, "filename": meta["filename"], "offset": offset, "size": meta["size"], "status": "uploading"}
+
+    def write(self, upload_id: str, offset: int, stream, length: int = None) -> dict:
+        """
+        Append chunk to upload
+        :param upload_id: upload id
+        :param offset: offset of chunk in file, it has to be equal to received size
+        :param stream: readable stream of chunk
+        :param length: length of chunk if known
+        :return: status with new offset
+        """
+        part_path, _ = self._paths(upload_id)
+        with self._get_lock(upload_id):
+            meta = self._read_meta(upload_id)
+            current = os.path.getsize(part_path)
+            if int(offset) != current:
+                # chunk is already received or previous chunk is lost, client continues from current offset
+                raise UploadError("Offset mismatch", 409, offset=current)
+            if length is not None and current + int(length) > meta["size"]:
+                raise UploadError("Chunk is out of file size", 400, offset=current)
+            hasher, hash_offset = self.hashers.pop(upload_id, (hashlib.sha256(), 0) if current == 0 else (None, None))
+            if hash_offset != current:
+                hasher = None  # server is restarted during upload, hash is computed from file on commit
+            try:
+                with open(part_path, "ab") as file:
+                    while True:
+                        block = stream.read(UPLOAD_CHUNK_SIZE)
+                        if not block:
+                            break
+                        if current + len(block) > meta["size"]:
+                            file.truncate(current)
+                            raise UploadError("Chunk is out of file size", 400, offset=current)
+                        file.write(block)
+                        current += len(block)
+                        if hasher is not None:
+                            hasher.update(block)
+            finally:
+                # written part of broken chunk is kept, client continues from new offset
+                if hasher is not None:
+                    self.hashers[upload_id] = (hasher, current)
+            return {"upload_id": upload_id, "filename": meta["filename"], "offset": current, "size": meta["size"], "status": "uploading"}
+
+    def commit(self, upload_id: str, sha256: str = None) -> dict:
+        """
+        Check size and hash of upload and move file to folder
+        :param upload_id: upload id
+        :param sha256: optional hash of content computed by client
+        :return: status with hash of content
+        """
+        part_path, meta_path = self._paths(upload_id)
+        with self._get_lock(upload_id):
+            meta = self._read_meta(upload_id)
+            size = os.path.getsize(part_path)
+            if size != meta["size"]:
+                raise UploadError("Upload is not complete", 409, offset=size)
+            hasher, hash_offset = self.hashers.pop(upload_id, (None, None))
+            if hasher is None or hash_offset != size:
+                hasher = hashlib.sha256()
+                with open(part_path, "rb") as file:
+                    for block in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b""):
+                        hasher.update(block)
+            content_hash = hasher.hexdigest()
+            expected_hash = (sha256 or meta.get("sha256") or "").lower()
+            if expected_hash and expected_hash != content_hash:
+                # content is broken, upload is started again
+                open(part_path, "wb").close()
+                raise UploadError("Hash mismatch", 422, offset=0, sha256=content_hash)
+            target_path = os.path.join(self.folder, meta["filename"])
+            existing_path = self._find_content(content_hash, size)
+            if existing_path is not None and os.path.abspath(existing_path) != os.path.abspath(target_path):
+                self._link(existing_path, target_path)
+                os.remove(part_path)
+            else:
+                os.replace(part_path, target_path)
+            os.remove(meta_path)
+            self.content_hashes[content_hash] = meta["filename"]
+        with self.lock:
+            self.upload_locks.pop(upload_id, None)
+        return {"upload_id": upload_id, "filename": meta["filename"], "offset": size, "size": size, "sha256": content_hash, "status": "committed"}
+
+    def abort(self, upload_id: str):
+        """Remove not committed upload"""
+        part_path, meta_path = self._paths(upload_id)
+        with self._get_lock(upload_id):
+            for path in (part_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.hashers.pop(upload_id, None)
+        with self.lock:
+            self.upload_locks.pop(upload_id, None)
+
+    def clean(self, max_age: float = 24 * 3600):
+        """Remove uploads without new chunks longer than max age"""
+        now = time.time()
+        for name in os.listdir(self.upload_folder):
+            path = os.path.join(self.upload_folder, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError as err:
+                print(f"Error during remove upload {err}")
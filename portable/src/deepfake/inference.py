@@ -3,10 +3,12 @@ import cv2
 import sys
 import math
 import torch
+import uuid
 import shutil
 import subprocess
 import numpy as np
 from tqdm import tqdm
+from collections import deque
 from time import strftime, sleep
 from argparse import Namespace
 
@@ -16,8 +18,8 @@ sys.path.insert(0, deepfake_root_path)
 
 """Video and image"""
 from src.utils.videoio import (
-    save_video_with_audio, cut_start_video, get_first_frame, encrypted, save_frames,
-    check_media_type, extract_audio_from_video, save_video_from_frames, video_to_frames
+    trim_range, get_first_frame, encrypted, Watermark, save_frames,
+    check_media_type, extract_audio_from_video, save_video_from_frames, video_to_frames, VideoReader, VideoWriter
 )
 from src.utils.imageio import save_image_cv2, read_image_cv2, save_colored_mask_cv2
 """Video and image"""
@@ -28,19 +30,22 @@ from src.utils.sync_lip import GenerateWave2Lip
 """Wav2Lip"""
 """Face Swap"""
 from src.utils.faceswap import FaceSwapDeepfake
+from src.face3d.recognition import FaceTrackCache
 """Face Swap"""
 """Retouch"""
-from src.retouch import InpaintModel, process_retouch, pil_to_cv2, convert_cv2_to_pil, VideoRemoveObjectProcessor, convert_colored_mask_thickness_cv2, upscale_retouch_frame
+from src.retouch import InpaintModel, process_retouch_batch, pil_to_cv2, convert_cv2_to_pil, VideoRemoveObjectProcessor, convert_colored_mask_thickness_cv2, upscale_retouch_frame
 """Retouch"""
 """Segmentation"""
-from src.utils.segment import SegmentAnything
+from src.utils.segment import SegmentAnything, get_file_hash, embedding_cache, segment_video
 from src.east.detect import SegmentText
 """Segmentation"""
 
 sys.path.pop(0)
 
-from backend.folders import DEEPFAKE_MODEL_FOLDER, TMP_FOLDER
+from backend.folders import DEEPFAKE_MODEL_FOLDER, TMP_FOLDER, FACE_CACHE_FOLDER
 from backend.download import download_model, unzip, check_download_size, get_nested_url, is_connected
+from backend.model_registry import model_registry, get_free_memory
+from backend.mask_store import MaskStore
 from backend.config import get_deepfake_config
 
 
@@ -53,8 +58,10 @@ class AnimationMouthTalk:
     """
     @staticmethod
     def main_video_deepfake(deepfake_dir: str, source: str, audio: str, face_fields: list = None, video_start: float = 0,
-                            video_end: float = 0, emotion_label: int = None, similar_coeff: float = 0.96):
+                            video_end: float = 0, emotion_label: int = None, similar_coeff: float = 0.96,
+                            keyframe_interval: int = 1):
         args = AnimationMouthTalk.load_video_default()
+        args.keyframe_interval = max(1, int(keyframe_interval))  # 1 detects faces on each frame, more tracks faces between keyframes
         use_cpu = False if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else True
 
         if torch.cuda.is_available() and not use_cpu:
@@ -96,35 +103,38 @@ class AnimationMouthTalk:
         # if this is video target
         type_file_target = check_media_type(source)
         if type_file_target == "animated":
-            # If video_start is not 0 when cut video from start
-            source = cut_start_video(source, float(video_start), float(video_end))
-            # get video frame for source if type is video
-            frame_dir = os.path.join(save_dir, "frames")
-            os.makedirs(frame_dir, exist_ok=True)
-            fps, frame_dir = save_frames(video=source, output_dir=frame_dir, rotate=args.rotate, crop=args.crop, resize_factor=args.resize_factor)
-            # Get a list of all frame files in the target_frames_path directory
-            frame_files = sorted([os.path.join(frame_dir, fname) for fname in os.listdir(frame_dir) if fname.endswith('.png')])
+            # detected faces are cached by content of video, trim range and transformations
+            cache_key = FaceTrackCache.get_key(source, float(video_start), float(video_end), args.rotate, args.crop, args.resize_factor, args.keyframe_interval)
+            # read video frames for source as stream without save frames on disk, video is trimmed by decoder
+            frames = VideoReader(video=source, rotate=args.rotate, crop=args.crop, resize_factor=args.resize_factor, cache_key=cache_key, start=float(video_start), end=float(video_end))
+            fps = frames.fps
         else:
             fps = 25
-            frame_files = [source]
+            frames = [source]
         # get mel of audio
-        mel_processor = MelProcessor(audio=audio, save_output=save_dir, fps=fps)
+        # STFT of audio is computed on gpu if it is used
+        mel_processor = MelProcessor(audio=audio, save_output=save_dir, fps=fps, device=device if device == "cuda" else None)
         mel_chunks = mel_processor.process()
         # create wav to lip
-        full_frames_files = frame_files[:len(mel_chunks)]
+        if isinstance(frames, VideoReader):
+            frames = VideoReader(video=source, rotate=args.rotate, crop=args.crop, resize_factor=args.resize_factor, limit=len(mel_chunks), cache_key=frames.cache_key, start=float(video_start), end=float(video_end))
+        else:
+            frames = frames[:len(mel_chunks)]
         batch_size = args.wav2lip_batch_size
-        wav2lip = GenerateWave2Lip(DEEPFAKE_MODEL_FOLDER, emotion_label=emotion_label, similar_coeff=similar_coeff)
+        wav2lip = GenerateWave2Lip(DEEPFAKE_MODEL_FOLDER, emotion_label=emotion_label, similar_coeff=similar_coeff, cache_dir=FACE_CACHE_FOLDER, keyframe_interval=args.keyframe_interval)
         wav2lip.face_fields = face_fields
+        # load model in background while faces are detected
+        wav2lip.preload_model(wav2lip_checkpoint, device)
 
         print("Face detect starting")
-        gen = wav2lip.datagen(full_frames_files, mel_chunks, args.img_size, args.wav2lip_batch_size, args.pads)
+        gen = wav2lip.datagen(frames, mel_chunks, args.img_size, args.wav2lip_batch_size, args.pads)
         # load wav2lip
         print("Starting mouth animate")
-        wav2lip_processed_video = wav2lip.generate_video_from_chunks(gen, mel_chunks, batch_size, wav2lip_checkpoint, device, save_dir, fps)
+        # audio is muxed while video is encoded
+        wav2lip_processed_video = wav2lip.generate_video_from_chunks(gen, mel_chunks, batch_size, wav2lip_checkpoint, device, save_dir, fps, audio=audio)
         if wav2lip_processed_video is None:
             return
-        wav2lip_result_video = wav2lip_processed_video
-        mp4_path = save_video_with_audio(wav2lip_result_video, audio, save_dir)
+        mp4_path = os.path.basename(wav2lip_processed_video)
 
         for f in os.listdir(save_dir):
             if mp4_path == f:
@@ -135,9 +145,6 @@ class AnimationMouthTalk:
                 elif os.path.isdir(os.path.join(save_dir, f)):
                     shutil.rmtree(os.path.join(save_dir, f))
 
-        for f in os.listdir(TMP_FOLDER):
-            os.remove(os.path.join(TMP_FOLDER, f))
-
         return mp4_path
 
     @staticmethod
@@ -150,7 +157,8 @@ class AnimationMouthTalk:
             crop=[0, -1, 0, -1],
             rotate=False,
             nosmooth=False,
-            img_size=96
+            img_size=96,
+            keyframe_interval=1
         )
 
 
@@ -163,8 +171,10 @@ class FaceSwap:
     def main_faceswap(deepfake_dir: str, target: str, target_face_fields: str, source: str, source_face_fields: str,
                       type_file_source: str, target_video_start: float = 0, target_video_end: float = 0,
                       source_current_time: float = 0, source_video_end: float = 0,
-                      multiface: bool = False, similarface: bool = False, similar_coeff: float = 0.95):
+                      multiface: bool = False, similarface: bool = False, similar_coeff: float = 0.95,
+                      keyframe_interval: int = 1):
         args = FaceSwap.load_faceswap_default()
+        args.keyframe_interval = max(1, int(keyframe_interval))  # 1 detects faces on each frame, more tracks faces between keyframes
 
         use_cpu = False if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else True
 
@@ -195,11 +205,8 @@ class FaceSwap:
         else:
             check_download_size(faceswap_checkpoint, link_faceswap_checkpoint)
 
-        faceswap = FaceSwapDeepfake(DEEPFAKE_MODEL_FOLDER, faceswap_checkpoint, similarface, similar_coeff, device)
+        faceswap = FaceSwapDeepfake(DEEPFAKE_MODEL_FOLDER, faceswap_checkpoint, similarface, similar_coeff, device, cache_dir=FACE_CACHE_FOLDER, keyframe_interval=args.keyframe_interval)
 
-        # transfer video without format from frontend to mp4 format
-        if type_file_source == "video":
-            source = cut_start_video(source, 0, float(source_video_end))
         # get fps and calculate current frame and get that frame for source
         source_frame = get_first_frame(source, float(source_current_time))
         source_face = faceswap.face_detect_with_alignment_from_source_frame(source_frame, source_face_fields)
@@ -207,28 +214,15 @@ class FaceSwap:
         # if this is video target
         type_file_target = check_media_type(target)
         if type_file_target == "animated":
-            # If video_start for target is not 0 when cut video from start
-            target = cut_start_video(target, float(target_video_start), float(target_video_end))
-
-            # get video frame for source if type is video
-            frame_dir = os.path.join(save_dir, "frames")
-            os.makedirs(frame_dir, exist_ok=True)
-
-            fps, frame_dir = save_frames(video=target, output_dir=frame_dir, rotate=args.rotate, crop=args.crop, resize_factor=args.resize_factor)
-            # create face swap
-            file_name = faceswap.swap_video(frame_dir, source_face, target_face_fields, save_dir, multiface, fps)
-            saved_file = os.path.join(save_dir, file_name)
-            # after generation
-            try:
-                file_name = encrypted(saved_file, save_dir)  # encrypted
-                saved_file = os.path.join(save_dir, file_name)
-            except Exception as err:
-                print(f"Error with encrypted {err}")
-
-            # get audio from video target
-            audio_file_name = extract_audio_from_video(target, save_dir)
-            # combine audio and video
-            file_name = save_video_with_audio(saved_file, os.path.join(save_dir, str(audio_file_name)), save_dir)
+            # detected faces are cached by content of video, trim range and transformations
+            cache_key = FaceTrackCache.get_key(target, float(target_video_start), float(target_video_end), args.rotate, args.crop, args.resize_factor, args.keyframe_interval)
+            # read video frames for target as stream without save frames on disk, video is trimmed by decoder
+            target_frames = VideoReader(video=target, rotate=args.rotate, crop=args.crop, resize_factor=args.resize_factor, cache_key=cache_key, start=float(target_video_start), end=float(target_video_end))
+            # create face swap, audio of target is muxed from the same start while video is encoded with watermark
+            file_name = faceswap.swap_video(
+                target_frames, source_face, target_face_fields, save_dir, multiface, target_frames.fps,
+                audio=target, audio_start=target_frames.start_time, watermark=Watermark()
+            )
 
         else:  # static file
             # create face swap on image
@@ -251,9 +245,6 @@ class FaceSwap:
                 elif os.path.isdir(os.path.join(save_dir, f)):
                     shutil.rmtree(os.path.join(save_dir, f))
 
-        for f in os.listdir(TMP_FOLDER):
-            os.remove(os.path.join(TMP_FOLDER, f))
-
         return file_name
 
     @staticmethod
@@ -262,12 +253,86 @@ class FaceSwap:
             resize_factor=1,
             crop=[0, -1, 0, -1],
             rotate=False,
+            keyframe_interval=1
         )
 
 
 class Retouch:
     """Retouch image or video"""
 
+    @staticmethod
+    def stream_remove_object(retouch_processor, frame_dir: str, frame_files: list, mask_store: MaskStore, save_dir: str, fps: float,
+                             work_size: tuple, audio: str = None, audio_start: float = 0, window_size: int = None, overlap: int = None,
+                             upscale: bool = True, blur: int = 1, use_half: bool = False):
+        """
+        Remove objects of all masks by streaming ProPainter and encode result with audio
+        :param retouch_processor: VideoRemoveObjectProcessor
+        :param frame_dir: directory of original frames
+        :param frame_files: names of frames, masks have the same names
+        :param mask_store: masks of all objects
+        :param save_dir: directory of result
+        :param fps: frames per second
+        :param work_size: width and height to process frames
+        :param audio: path to media with audio
+        :param audio_start: start of audio in seconds
+        :param window_size: frames in window, None to size by free memory of device
+        :param overlap: frames from previous window as context, None is 20% of window
+        :param upscale: paste result in original frames, else result has work size
+        :param blur: dilation of mask
+        :param use_half: fp16
+        :return: file name of video
+        """
+        work_width, work_height = work_size
+        process_width, process_height = work_width - work_width % 8, work_height - work_height % 8
+        short_clip_len, planned_window_size = retouch_processor.plan_batches(process_width, process_height)
+        if window_size is None:
+            window_size = planned_window_size
+        if overlap is None:
+            overlap = max(1, int(0.2 * window_size))
+        originals = deque()  # original frames and masks which are waiting result
+
+        def read_frames():
+            for frame_file in frame_files:
+                original = cv2.imread(os.path.join(frame_dir, frame_file))
+                work_frame = original if original.shape[:2] == (work_height, work_width) else cv2.resize(original, (work_width, work_height))
+                # union of masks of all objects, frames without masks have empty mask
+                binary_mask = mask_store.read_union(frame_file)
+                if binary_mask.shape != (work_height, work_width):
+                    binary_mask = cv2.resize(binary_mask.view(np.uint8), (work_width, work_height), interpolation=cv2.INTER_NEAREST) > 0
+                originals.append((original, binary_mask))
+                yield cv2.cvtColor(cv2.resize(work_frame, (process_width, process_height)), cv2.COLOR_BGR2RGB), binary_mask
+
+        file_name = str(uuid.uuid4()) + ".mp4"
+        out = None
+        progress_bar = tqdm(total=len(frame_files), unit='it', unit_scale=True, desc="Inpaint frames")
+        try:
+            comp_frames = retouch_processor.process_video_stream(
+                read_frames(), process_width, process_height, window_size=window_size, overlap=overlap, use_half=use_half, kernel_size=blur,
+                short_clip_len=short_clip_len
+            )
+            for comp_frame in comp_frames:
+                original, binary_mask = originals.popleft()
+                comp_frame = cv2.cvtColor(cv2.resize(comp_frame, (work_width, work_height)), cv2.COLOR_RGB2BGR)
+                if upscale:
+                    # paste only retouched region in original frame
+                    orig_height, orig_width = original.shape[:2]
+                    comp_frame = upscale_retouch_frame(mask=binary_mask, frame=comp_frame, original_frame=original, width=orig_width, height=orig_height)
+                if out is None:
+                    frame_height, frame_width = comp_frame.shape[:2]
+                    out = VideoWriter(os.path.join(save_dir, file_name), fps, frame_width, frame_height, audio=audio, audio_start=audio_start, total=len(frame_files), message="Remove object")
+                out.write(comp_frame)
+                progress_bar.update(1)
+        except BaseException:
+            if out is not None:
+                out.abort()
+            raise
+        finally:
+            progress_bar.close()
+        if out is None:
+            raise ValueError("No frames to remove object, check start and end time of video")
+        out.release()
+        return file_name
+
     @staticmethod
     def main_retouch(output: str, source: str, masks: dict, retouch_model_type: str = "retouch_object", predictor=None,
                      session=None, source_start: float = 0, source_end: float = 0, source_type: str = "img", mask_text=True,
@@ -424,13 +489,9 @@ class Retouch:
         segment_percentage = segment_percentage / 100
         segmentation = SegmentAnything(segment_percentage)
         if session is None:
-            session = segmentation.init_onnx(onnx_vit_checkpoint, device)
+            session = model_registry.get(f"sam_onnx_{vit_model_type}", lambda: SegmentAnything.init_onnx(onnx_vit_checkpoint, device), device, files=[onnx_vit_checkpoint])
         if predictor is None:
-            predictor = segmentation.init_vit(sam_vit_checkpoint, vit_model_type, device)
-
-        # cut video
-        if source_type == "video":
-            source = cut_start_video(source, source_start, source_end)
+            predictor = model_registry.get(f"sam_{vit_model_type}", lambda: SegmentAnything.init_vit(sam_vit_checkpoint, vit_model_type, device), device, files=[sam_vit_checkpoint])
 
         remove_keys = []
         for key in masks.keys():
@@ -458,24 +519,22 @@ class Retouch:
             frame_files = ["static_frame.png"]
             cv2.imwrite(os.path.join(frame_dir, frame_files[0]), read_image_cv2(source))
         elif source_media_type == "animated":
-            fps, frame_dir = save_frames(video=source, output_dir=frame_dir, rotate=False, crop=[0, -1, 0, -1], resize_factor=1)
+            # video is trimmed by decoder without intermediate file
+            fps, frame_dir = save_frames(video=source, output_dir=frame_dir, rotate=False, crop=[0, -1, 0, -1], resize_factor=1, start=source_start, end=source_end)
             frame_files = sorted(os.listdir(frame_dir))
         else:
             raise "Source is not detected as image or video"
 
         first_frame = read_image_cv2(os.path.join(frame_dir, frame_files[0]))
         orig_height, orig_width, _ = first_frame.shape
-        frame_batch_size = 50  # for improve remove object to limit VRAM, for CPU slowly, but people have a lot RAM
         work_dir = frame_dir
 
-        if source_media_type == "animated" and retouch_model_type == "improved_retouch_object" and device == "cuda":
-            # resize only for VRAM
-            gpu_vram = torch.cuda.get_device_properties(device).total_memory / (1024 ** 3)
-            # table of gpu memory
-            gpu_table = {32: 1280, 23: 1080, 15: 768, 7: 720, 6: 640, 2: 320}
-            # get user resize for gpu
-            max_size = max(val for key, val in gpu_table.items() if key <= gpu_vram)
-            print(f"Limit VRAM is {gpu_vram} Gb. Video will resize before {max_size} for max size")
+        if source_media_type == "animated" and retouch_model_type == "improved_retouch_object":
+            # resize by free memory of device, weights of models will be loaded in the same memory
+            model_files = [model_raft_things_path, model_recurrent_flow_path, model_pro_painter_path]
+            free_memory = get_free_memory(device) - sum(os.path.getsize(f) for f in model_files if os.path.exists(f))
+            max_size = VideoRemoveObjectProcessor.get_max_size(orig_width, orig_height, free_memory)
+            print(f"Free memory is {free_memory / 1024 ** 3:.1f} Gb. Video will resize before {max_size} for max size")
             # Resize frames while maintaining aspect ratio
             for frame_file in frame_files:
                 frame = read_image_cv2(os.path.join(frame_dir, frame_file))
@@ -501,86 +560,71 @@ class Retouch:
         segmentation.load_models(predictor=predictor, session=session)
         thickness_mask = 10
 
+        # masks of all objects are saved in one file, dilation by thickness is applied on read
+        mask_keys = list(masks.keys()) + (["text"] if mask_text else [])
+        mask_store = MaskStore.create(
+            os.path.join(tmp_dir, "masks.wmask"), frame_files, mask_keys, work_width, work_height,
+            kernel_sizes={key: thickness_mask for key in masks.keys()}
+        )
+
+        objects = {}
         for key in masks.keys():
-            print(f"Processing ID: {key}")
-            mask_key_save_path = os.path.join(tmp_dir, f"mask_{key}")
-            os.makedirs(mask_key_save_path, exist_ok=True)
-            start_time = masks[key]["start_time"]
-            end_time = masks[key]["end_time"]
-            start_frame = math.floor(start_time * fps)
-            end_frame = math.ceil(end_time * fps) + 1
-            # list of frames of list of one frame
-            filter_frames_files = frame_files[start_frame:end_frame]
-            # set progress bar
-            progress_bar = tqdm(total=len(filter_frames_files), unit='it', unit_scale=True)
-            filter_frame_file_name = filter_frames_files[0]
-            # read mot resized files
-            # TODO [1] work_dir has resized frames, but in this case I don't know quality of image after resize influence on segmentation quality? if not when use work_dir better else need to use frame_dir and resized on retouch
-            filter_frame = cv2.imread(os.path.join(work_dir, filter_frame_file_name))  # read first frame file after filter
-            # get segment mask
-            segment_mask = segmentation.set_obj(point_list=masks[key]["point_list"], frame=filter_frame)
-            # save first frame as 0001
-            segmentation.save_black_mask(filter_frame_file_name, segment_mask, mask_key_save_path, kernel_size=thickness_mask, width=work_width, height=work_height)
             if mask_color:
-                color = segmentation.hex_to_rgba(mask_color)
                 os.makedirs(os.path.join(save_dir, key), exist_ok=True)
-                orig_filter_frame = cv2.imread(os.path.join(frame_dir, filter_frame_file_name))
-                saving_mask = segmentation.apply_mask_on_frame(segment_mask, orig_filter_frame, color, orig_width, orig_height)
-                saving_mask.save(os.path.join(save_dir, key, filter_frame_file_name))
-
-            # update progress bar
+            start_frame = math.floor(masks[key]["start_time"] * fps)
+            end_frame = math.ceil(masks[key]["end_time"] * fps) + 1
+            objects[key] = {"point_list": masks[key]["point_list"], "start_frame": start_frame, "end_frame": end_frame}
+
+        # each frame is encoded once for all objects, masks of all objects are saved in one pass
+        print(f"Processing IDs: {', '.join(objects.keys())}")
+        # TODO [1] work_dir has resized frames, but in this case I don't know quality of image after resize influence on segmentation quality? if not when use work_dir better else need to use frame_dir and resized on retouch
+        segment_frames = segment_video(
+            predictor, session, frame_files, lambda frame_file: cv2.imread(os.path.join(work_dir, frame_file)), objects,
+            segment_percentage=segment_percentage
+        )
+        progress_bar = tqdm(total=len(frame_files), unit='it', unit_scale=True, desc="Segmentation")
+        for filter_frame_file_name, _, frame_masks in segment_frames:
+            orig_filter_frame = cv2.imread(os.path.join(frame_dir, filter_frame_file_name)) if mask_color else None
+            for key, segment_mask in frame_masks.items():
+                mask_store.write(key, filter_frame_file_name, segment_mask)
+                if mask_color:
+                    color = segmentation.hex_to_rgba(mask_color)
+                    saving_mask = segmentation.apply_mask_on_frame(segment_mask, orig_filter_frame, color, orig_width, orig_height)
+                    saving_mask.save(os.path.join(save_dir, key, filter_frame_file_name))
             progress_bar.update(1)
-
-            if len(filter_frames_files) > 1:
-                for filter_frame_file_name in filter_frames_files[1:]:
-                    # TODO [1] work_dir has resized frames, but in this case I don't know quality of image after resize influence on segmentation quality? if not when use work_dir better else need to use frame_dir and resized on retouch
-                    filter_frame = cv2.imread(os.path.join(work_dir, filter_frame_file_name))  # read frame file after filter
-                    segment_mask = segmentation.draw_mask_frames(frame=filter_frame)
-                    if segment_mask is None:
-                        print(key, "Encountered None mask. Breaking the loop.")
-                        break
-                    # save frames after 0002
-                    segmentation.save_black_mask(filter_frame_file_name, segment_mask, mask_key_save_path, kernel_size=thickness_mask, width=work_width, height=work_height)
-                    if mask_color:
-                        color = segmentation.hex_to_rgba(mask_color)
-                        orig_filter_frame = cv2.imread(os.path.join(frame_dir, filter_frame_file_name))
-                        saving_mask = segmentation.apply_mask_on_frame(segment_mask, orig_filter_frame, color, orig_width, orig_height)
-                        saving_mask.save(os.path.join(save_dir, key, filter_frame_file_name))
-
-                    progress_bar.update(1)
-            # set new key
-            masks[key]["frame_files_path"] = mask_key_save_path
-            # close progress bar for key
-            progress_bar.close()
+        # close progress bar for masks
+        progress_bar.close()
 
         if mask_text:
             print(f"Processing text")
-            mask_text_save_path = os.path.join(tmp_dir, f"mask_text")
-            os.makedirs(mask_text_save_path, exist_ok=True)
-            segment_text = SegmentText(device=device, vgg16_path=vgg16_baseline_path, east_path=vgg16_east_path)
+            segment_text = model_registry.get(
+                "east", lambda: SegmentText(device=device, vgg16_path=vgg16_baseline_path, east_path=vgg16_east_path),
+                device, files=[vgg16_baseline_path, vgg16_east_path]
+            )
+            text_batch_size = 8 if device == "cuda" else 2  # frames in one forward of EAST
             # set progress bar
-            progress_bar = tqdm(total=len(frame_files), unit='it', unit_scale=True)
-            for frame_file in frame_files:
-                frame_file_path = os.path.join(frame_dir, frame_file)
-                mask_text_frame = segment_text.detect_text(frame_file_path)
-                mask_text_frame_path = os.path.join(mask_text_save_path, frame_file)
-                mask_text_frame.save(mask_text_frame_path)
-                progress_bar.update(1)
+            progress_bar = tqdm(total=len(frame_files), unit='it', unit_scale=True, desc="Text detection")
+            for i in range(0, len(frame_files), text_batch_size):
+                batch_files = frame_files[i: i + text_batch_size]
+                batch_frames = [cv2.imread(os.path.join(frame_dir, frame_file)) for frame_file in batch_files]
+                mask_text_frames = segment_text.detect_text_batch(batch_frames)
+                for frame_file, orig_filter_frame, mask_text_frame in zip(batch_files, batch_frames, mask_text_frames):
+                    mask_store.write("text", frame_file, mask_text_frame)
 
-                if mask_color:
-                    mask_color_cv2 = pil_to_cv2(mask_text_frame)
-                    color = segment_text.hex_to_rgba(mask_color)
-                    os.makedirs(os.path.join(save_dir, "text"), exist_ok=True)
-                    orig_filter_frame = cv2.imread(os.path.join(frame_dir, frame_file))
-                    saving_mask = segment_text.apply_mask_on_frame(mask_color_cv2, convert_cv2_to_pil(orig_filter_frame), color, orig_width, orig_height)
-                    saving_mask.save(os.path.join(save_dir, "text", frame_file))
+                    if mask_color:
+                        color = segment_text.hex_to_rgba(mask_color)
+                        os.makedirs(os.path.join(save_dir, "text"), exist_ok=True)
+                        saving_mask = segment_text.apply_mask_on_frame(mask_text_frame, convert_cv2_to_pil(orig_filter_frame), color, orig_width, orig_height)
+                        saving_mask.save(os.path.join(save_dir, "text", frame_file))
+                progress_bar.update(len(batch_files))
             # close progress bar for text mask
             progress_bar.close()
             del segment_text
-            # Set mask path in masks
-            masks["text"] = {'frame_files_path': mask_text_save_path}
 
         if delay_mask != 0:
+            # masks are exported to images for manual edit and saved back after delay
+            for key in mask_store.keys:
+                mask_store.export_png(key, os.path.join(tmp_dir, f"mask_{key}"))
             print(f"Open folder with mask for manually edit with delay time {delay_mask} sec")
             if os.path.exists(tmp_dir):
                 if sys.platform == 'win32':
@@ -594,6 +638,8 @@ class Retouch:
                     subprocess.Popen(['xdg-open', tmp_dir])
             # delay time before next run
             sleep(int(delay_mask))
+            for key in mask_store.keys:
+                mask_store.import_png(key, os.path.join(tmp_dir, f"mask_{key}"))
 
         if mask_color:
             print("Mask save is finished. Open folder")
@@ -612,88 +658,54 @@ class Retouch:
         torch.cuda.empty_cache()
 
         if retouch_model_type is None:
-            for f in os.listdir(TMP_FOLDER):
-                os.remove(os.path.join(TMP_FOLDER, f))
             # remove tmp dir
+            mask_store.close()
             shutil.rmtree(tmp_dir)
             return save_dir
 
+        save_name = None
         if source_media_type == "animated" and retouch_model_type == "improved_retouch_object":
             # raft
-            retouch_processor = VideoRemoveObjectProcessor(device, model_raft_things_path, model_recurrent_flow_path, model_pro_painter_path)
-            overlap = int(0.2 * frame_batch_size)
-
-            for key in masks.keys():
-                mask_files = sorted(os.listdir(masks[key]["frame_files_path"]))
-
-                # processing video with batch size because of limit VRAM
-                if len(mask_files) < 3:
-                    continue
-
-                for i in range(0, len(mask_files), frame_batch_size - overlap):
-                    if len(mask_files) - i < 3:  # not less than 3 frames for batch
-                        continue
-                    # read mask by batch_size and convert back from file image
-                    current_mask_files = mask_files[i: i + frame_batch_size]
-                    inpaint_mask_frames = [cv2.imread(os.path.join(tmp_dir, f"mask_{key}", current_mask_file), cv2.IMREAD_GRAYSCALE) for current_mask_file in current_mask_files]
-                    # Binarize the image
-                    binary_masks = []
-                    for idx, inpaint_mask_frame in enumerate(inpaint_mask_frames):
-                        binary_mask = cv2.threshold(inpaint_mask_frame, 128, 1, cv2.THRESH_BINARY)[1]
-                        # If it's not the first batch and the frame is within the overlap range, set the mask to false
-                        if i > 0 and idx < overlap:
-                            binary_mask = np.zeros_like(binary_mask)
-                        bool_mask = binary_mask.astype(bool)
-                        reshaped_mask = bool_mask[np.newaxis, np.newaxis, ...]
-                        binary_masks.append(reshaped_mask)
-                    # read frames by name of current_mask_files
-                    current_frame_files = current_mask_files
-                    current_frames = [cv2.imread(os.path.join(work_dir, current_frame_file)) for current_frame_file in current_frame_files]
-
-                    # convert frame to pillow
-                    current_frames = [retouch_processor.transfer_to_pil(f) for f in current_frames]
-                    resized_frames, size, out_size = retouch_processor.resize_frames(current_frames)
-                    width, height = size
-
-                    flow_masks, masks_dilated = retouch_processor.read_retouch_mask(binary_masks, width, height, kernel_size=blur)
-                    update_frames, flow_masks, masks_dilated, masked_frame_for_save, frames_inp = retouch_processor.process_frames_with_retouch_mask(frames=resized_frames, masks_dilated=masks_dilated, flow_masks=flow_masks, height=height, width=width)
-                    comp_frames = retouch_processor.process_video_with_mask(update_frames, masks_dilated, flow_masks, frames_inp, width, height, use_half=use_half)
-                    comp_frames = [cv2.resize(f, out_size) for f in comp_frames]
-                    comp_frames_bgr = [cv2.cvtColor(f, cv2.COLOR_RGB2BGR) for f in comp_frames]
-                    # update frames in work dir
-                    for j in range(len(comp_frames_bgr)):
-                        cv2.imwrite(os.path.join(work_dir, current_frame_files[j]), comp_frames_bgr[j])
-                        # upscale frame
-                        if upscale:
-                            orig_frame = cv2.imread(os.path.join(frame_dir, current_frame_files[j]))
-                            retouched_orig_frame = upscale_retouch_frame(mask=binary_masks[j], frame=comp_frames_bgr[j],  original_frame=orig_frame, width=orig_width, height=orig_height)
-                            cv2.imwrite(os.path.join(frame_dir, current_frame_files[j]), retouched_orig_frame)
+            retouch_processor = model_registry.get(
+                "propainter", lambda: VideoRemoveObjectProcessor(device, model_raft_things_path, model_recurrent_flow_path, model_pro_painter_path),
+                device, files=[model_raft_things_path, model_recurrent_flow_path, model_pro_painter_path]
+            )
+            # masks of all objects are removed in one pass, frames stream through windows to encoder without files
+            save_name = Retouch.stream_remove_object(
+                retouch_processor, frame_dir, frame_files, mask_store, save_dir, fps=fps, work_size=(work_width, work_height),
+                audio=source, audio_start=trim_range(source_start, source_end)[0], upscale=upscale, blur=blur, use_half=use_half
+            )
             # empty cache
             del retouch_processor
             torch.cuda.empty_cache()
         else:
             # retouch
-            model_retouch = InpaintModel(model_path=model_retouch_path)
+            model_retouch = model_registry.get(retouch_model_name, lambda: InpaintModel(model_path=model_retouch_path), device, files=[model_retouch_path])
+            retouch_window_size = 8  # frames read together
+            retouch_batch_size = 4 if device == "cuda" else 1  # crops in one forward
 
-            for key in masks.keys():
-                mask_files = sorted(os.listdir(masks[key]["frame_files_path"]))
+            for key in mask_store.keys:
+                mask_files = mask_store.frames(key)
                 # set progress bar
-                progress_bar = tqdm(total=len(mask_files), unit='it', unit_scale=True)
-                for file_name in mask_files:
-                    # read mask to pillow
-                    segment_mask = cv2.imread(os.path.join(tmp_dir, f"mask_{key}", file_name), cv2.IMREAD_GRAYSCALE)
-                    binary_mask = cv2.threshold(segment_mask, 128, 1, cv2.THRESH_BINARY)[1]
-                    bool_mask = binary_mask.astype(bool)
-                    reshaped_mask = bool_mask[np.newaxis, np.newaxis, ...]
-                    segment_mask_pil = convert_colored_mask_thickness_cv2(reshaped_mask)
-                    # read frame to pillow
-                    current_frame = cv2.imread(os.path.join(work_dir, file_name))
-                    frame_pil = convert_cv2_to_pil(current_frame)
-                    # retouch_frame
-                    retouch_frame = process_retouch(img=frame_pil, mask=segment_mask_pil, model=model_retouch)
-                    # update frame
-                    cv2.imwrite(os.path.join(work_dir, file_name), pil_to_cv2(retouch_frame))
-                    progress_bar.update(1)
+                progress_bar = tqdm(total=len(mask_files), unit='it', unit_scale=True, desc="Retouch")
+                # frames are retouched by windows, so crops around masks with the same size are inpainted together
+                for i in range(0, len(mask_files), retouch_window_size):
+                    window_files = mask_files[i: i + retouch_window_size]
+                    segment_masks_pil, frames_pil = [], []
+                    for file_name in window_files:
+                        # read mask to pillow
+                        bool_mask = mask_store.read(key, file_name)
+                        reshaped_mask = bool_mask[np.newaxis, np.newaxis, ...]
+                        segment_masks_pil.append(convert_colored_mask_thickness_cv2(reshaped_mask))
+                        # read frame to pillow
+                        current_frame = cv2.imread(os.path.join(work_dir, file_name))
+                        frames_pil.append(convert_cv2_to_pil(current_frame))
+                    # retouch only region around mask
+                    retouch_frames = process_retouch_batch(imgs=frames_pil, masks=segment_masks_pil, model=model_retouch, batch_size=retouch_batch_size)
+                    # update frames
+                    for file_name, retouch_frame in zip(window_files, retouch_frames):
+                        cv2.imwrite(os.path.join(work_dir, file_name), pil_to_cv2(retouch_frame))
+                    progress_bar.update(len(window_files))
                 # close progress bar for key
                 progress_bar.close()
             # empty cache
@@ -705,24 +717,19 @@ class Retouch:
             # for other methods this will not influence
             work_dir = frame_dir
 
-        if source_media_type == "animated":
-            # get saved file as merge frames to video
-            video_name = save_video_from_frames(frame_names="frame%04d.png", save_path=work_dir, fps=fps, alternative_save_path=save_dir)
-            # get audio from video target
-            audio_file_name = extract_audio_from_video(source, save_dir)
-            # combine audio and video
-            save_name = save_video_with_audio(os.path.join(save_dir, video_name), os.path.join(save_dir, str(audio_file_name)), save_dir)
-        else:
-            save_name = frame_files[0]
-            retouched_frame = read_image_cv2(os.path.join(work_dir, save_name))
-            cv2.imwrite(os.path.join(save_dir, save_name), retouched_frame)
+        if save_name is None:  # streaming remove object encodes video itself
+            if source_media_type == "animated":
+                # get saved file as merge frames to video with audio from video target
+                save_name = save_video_from_frames(frame_names="frame%04d.png", save_path=work_dir, fps=fps, alternative_save_path=save_dir, audio=source, audio_start=trim_range(source_start, source_end)[0])
+            else:
+                save_name = frame_files[0]
+                retouched_frame = read_image_cv2(os.path.join(work_dir, save_name))
+                cv2.imwrite(os.path.join(save_dir, save_name), retouched_frame)
 
         # remove tmp dir
+        mask_store.close()
         shutil.rmtree(tmp_dir)
 
-        for f in os.listdir(TMP_FOLDER):
-            os.remove(os.path.join(TMP_FOLDER, f))
-
         return os.path.join(save_dir, save_name)
 
 
@@ -736,8 +743,6 @@ class MediaEdit:
         media_start = float(media_start)
         media_end = float(media_end)
 
-        audio_file_name = extract_audio_from_video(source, save_dir)
-
         if enhancer:
             use_cpu = False if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else True
             if torch.cuda.is_available() and not use_cpu:
@@ -752,11 +757,9 @@ class MediaEdit:
                 stream = cv2.VideoCapture(source)
                 fps = stream.get(cv2.CAP_PROP_FPS)
                 stream.release()
-                source = cut_start_video(source, media_start, media_end)
                 print("Starting improve video")
-                enhanced_name = content_enhancer(source, save_folder=save_dir, method=enhancer, fps=float(fps), device=device)
-                enhanced_path = os.path.join(save_dir, enhanced_name)
-                save_name = save_video_with_audio(enhanced_path, os.path.join(save_dir, audio_file_name), save_dir)
+                # video is trimmed by decoder and enhanced frames are encoded with audio without intermediate files
+                save_name = content_enhancer(source, save_folder=save_dir, method=enhancer, fps=float(fps), device=device, start=media_start, end=media_end)
             else:
                 print("Starting improve image")
                 save_name = content_enhancer(source, save_folder=save_dir, method=enhancer, device=device)
@@ -770,16 +773,11 @@ class MediaEdit:
                     elif os.path.isdir(os.path.join(save_dir, f)):
                         shutil.rmtree(os.path.join(save_dir, f))
 
-            for f in os.listdir(TMP_FOLDER):
-                os.remove(os.path.join(TMP_FOLDER, f))
-
             return save_name
 
         if is_get_frames:
-            source = cut_start_video(source, media_start, media_end)
-            video_to_frames(source, save_dir)
-            for f in os.listdir(TMP_FOLDER):
-                os.remove(os.path.join(TMP_FOLDER, f))
+            audio_file_name = extract_audio_from_video(source, save_dir, start=media_start, end=media_end)
+            video_to_frames(source, save_dir, start_seconds=media_start, end_seconds=media_end)
 
             if os.path.exists(save_dir):
                 if sys.platform == 'win32':
@@ -803,19 +801,18 @@ class MediaEdit:
         save_dir = os.path.join(output, strftime("%Y_%m_%d_%H%M%S"))
         os.makedirs(save_dir, exist_ok=True)
 
-        # get saved file as merge frames to video
-        video_name = save_video_from_frames(frame_names="%d.png", save_path=source_folder, fps=fps)
-
-        # combine audio and video
-        video_name = save_video_with_audio(os.path.join(source_folder, video_name), str(audio_path), save_dir)
-
-        for f in os.listdir(TMP_FOLDER):
-            os.remove(os.path.join(TMP_FOLDER, f))
+        # get saved file as merge frames to video with audio in one pass
+        video_name = save_video_from_frames(frame_names="%d.png", save_path=source_folder, fps=fps, alternative_save_path=save_dir, audio=str(audio_path))
 
         return os.path.join(save_dir, video_name)
 
 
 class GetSegment:
+    @staticmethod
+    def clear_cache():
+        # image embeddings of interactive segmentation
+        embedding_cache.clear()
+
     @staticmethod
     def load_model():
         use_cpu = False if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else True
@@ -886,23 +883,25 @@ class GetSegment:
         predictor = segmentation.init_vit(sam_vit_checkpoint, model_type, device)
         session = segmentation.init_onnx(onnx_vit_checkpoint, device)
 
-        return {"predictor": predictor, "session": session}
+        return {"predictor": predictor, "session": session, "model_type": model_type}
 
     @staticmethod
-    def get_segment_mask_file(predictor, session, source: str, point_list: list):
+    def get_segment_mask_file(predictor, session, source: str, point_list: list, model_type: str = None, obj_id=1):
         # set time sleep else file will not still loaded
         # read frame
         source_media_type = check_media_type(source)
         if source_media_type == "static":
-            frame = read_image_cv2(source)
+            read_frame = lambda: read_image_cv2(source)
         elif source_media_type == "animated":
-            frame = get_first_frame(source, float(0))
+            read_frame = lambda: get_first_frame(source, float(0))
         else:
             # return source
             return os.path.basename(source)
-        # segmentation
-        segmentation = SegmentAnything()
-        mask = segmentation.draw_mask(predictor=predictor, session=session, frame=frame, point_list=point_list)
+        # segmentation, frame is read and encoded only for first click, next clicks run only decoder
+        cache_key = (get_file_hash(source), 0, model_type)
+        mask = SegmentAnything.draw_mask_cached(
+            predictor=predictor, session=session, point_list=point_list, cache_key=cache_key, read_frame=read_frame, obj_id=obj_id
+        )
         # save mask in tmp?
         mask_file_name = save_colored_mask_cv2(TMP_FOLDER, mask)
         return mask_file_name
@@ -1,4 +1,5 @@
 import os
+import cv2
 import math
 import torch
 from torchvision import transforms
@@ -52,55 +53,72 @@ def load_pil(img):
 
 def is_valid_poly(res, score_shape, scale):
     """
-    Check if the poly in image scope
-    :param res: restored poly in original image
+    Check if the polys in image scope
+    :param res: restored polys in original image <numpy.ndarray, (n,2,4)> or one poly (2,4)
     :param score_shape: score map shape
     :param scale: feature map -> image
-    :return: True if valid
+    :return: True if valid, bool array for n polys
     """
-    cnt = 0
-    for i in range(res.shape[1]):
-        if res[0, i] < 0 or res[0, i] >= score_shape[1] * scale or \
-                res[1, i] < 0 or res[1, i] >= score_shape[0] * scale:
-            cnt += 1
-    return True if cnt <= 1 else False
+    outside = (res[..., 0, :] < 0) | (res[..., 0, :] >= score_shape[1] * scale) | \
+              (res[..., 1, :] < 0) | (res[..., 1, :] >= score_shape[0] * scale)
+    return outside.sum(axis=-1) <= 1
 
 
 def restore_polys(valid_pos, valid_geo, score_shape, scale=4):
     """
-    Restore polys from feature maps in given positions
+    Restore polys from feature maps in given positions, all positions are restored together
     :param valid_pos: potential text positions <numpy.ndarray, (n,2)>
     :param valid_geo: geometry in valid_pos <numpy.ndarray, (5,n)>
     :param score_shape: shape of score map
     :param scale: image / feature map
     :return: restored polys <numpy.ndarray, (n,8)>, index
     """
-    polys = []
-    index = []
-    valid_pos *= scale
+    valid_pos = valid_pos * scale
     d = valid_geo[:4, :]  # 4 x N
-    angle = valid_geo[4, :]  # N,
-
-    for i in range(valid_pos.shape[0]):
-        x = valid_pos[i, 0]
-        y = valid_pos[i, 1]
-        y_min = y - d[0, i]
-        y_max = y + d[1, i]
-        x_min = x - d[2, i]
-        x_max = x + d[3, i]
-        rotate_mat = get_rotate_mat(-angle[i])
-
-        temp_x = np.array([[x_min, x_max, x_max, x_min]]) - x
-        temp_y = np.array([[y_min, y_min, y_max, y_max]]) - y
-        coordidates = np.concatenate((temp_x, temp_y), axis=0)
-        res = np.dot(rotate_mat, coordidates)
-        res[0, :] += x
-        res[1, :] += y
-
-        if is_valid_poly(res, score_shape, scale):
-            index.append(i)
-            polys.append([res[0, 0], res[1, 0], res[0, 1], res[1, 1], res[0, 2], res[1, 2], res[0, 3], res[1, 3]])
-    return np.array(polys), index
+    angle = -valid_geo[4, :]  # N,
+
+    # corners relative to position, order is top left, top right, bottom right, bottom left
+    temp_x = np.stack((-d[2], d[3], d[3], -d[2]), axis=1)  # N x 4
+    temp_y = np.stack((-d[0], -d[0], d[1], d[1]), axis=1)  # N x 4
+    cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    res = np.empty((valid_pos.shape[0], 2, 4))
+    res[:, 0] = cos * temp_x - sin * temp_y + valid_pos[:, 0:1]
+    res[:, 1] = sin * temp_x + cos * temp_y + valid_pos[:, 1:2]
+
+    index = np.flatnonzero(is_valid_poly(res, score_shape, scale))
+    # x1, y1, x2, y2, x3, y3, x4, y4
+    polys = res[index].transpose(0, 2, 1).reshape(-1, 8)
+    return polys, index
+
+
+def nms_boxes(boxes, nms_thresh=0.2):
+    """
+    Greedy non maximum suppression by bounding rectangles of polys, IoU of box with rest boxes is computed at once.
+    Kept poly is average of suppressed polys weighted by score, so text region is not lost
+    :param boxes: polys with score <numpy.ndarray, (n,9)>
+    :param nms_thresh: IoU threshold
+    :return: polys with score <numpy.ndarray, (k,9)>
+    """
+    if boxes.shape[0] < 2:
+        return boxes
+    x1, y1 = boxes[:, 0:8:2].min(axis=1), boxes[:, 1:8:2].min(axis=1)
+    x2, y2 = boxes[:, 0:8:2].max(axis=1), boxes[:, 1:8:2].max(axis=1)
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-boxes[:, 8])
+    kept = []
+    while order.size > 0:
+        i, rest = order[0], order[1:]
+        inter = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None) * \
+                np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        group = np.concatenate(([i], rest[iou > nms_thresh]))
+        weights = boxes[group, 8:9]
+        merged = np.empty(9, dtype=boxes.dtype)
+        merged[:8] = (boxes[group, :8] * weights).sum(axis=0) / weights.sum()
+        merged[8] = boxes[i, 8]
+        kept.append(merged)
+        order = rest[iou <= nms_thresh]
+    return np.stack(kept)
 
 
 def get_boxes(score, geo, score_thresh=0.9, nms_thresh=0.2):
@@ -117,7 +135,7 @@ def get_boxes(score, geo, score_thresh=0.9, nms_thresh=0.2):
     if xy_text.size == 0:
         return None
 
-    xy_text = xy_text[np.argsort(xy_text[:, 0])]
+    xy_text = xy_text[np.argsort(xy_text[:, 0], kind="stable")]
     valid_pos = xy_text[:, ::-1].copy()  # n x 2, [x, y]
     valid_geo = geo[:, xy_text[:, 0], xy_text[:, 1]]  # 5 x n
     polys_restored, index = restore_polys(valid_pos, valid_geo, score.shape)
@@ -127,7 +145,7 @@ def get_boxes(score, geo, score_thresh=0.9, nms_thresh=0.2):
     boxes = np.zeros((polys_restored.shape[0], 9), dtype=np.float32)
     boxes[:, :8] = polys_restored
     boxes[:, 8] = score[xy_text[index, 0], xy_text[index, 1]]
-    return boxes
+    return nms_boxes(boxes, nms_thresh)
 
 
 def adjust_ratio(boxes, ratio_w, ratio_h):
@@ -198,6 +216,25 @@ def detect_dataset(model, device, test_img_path, submit_path):
             f.writelines(seq)
 
 
+def fill_polys_mask(shape, boxes, ratio_w=1., ratio_h=1.):
+    """
+    Rasterize filled polys in uint8 mask
+    :param shape: height and width of mask
+    :param boxes: polys <numpy.ndarray, (n,9)> or None
+    :param ratio_w: ratio of width from polys to mask
+    :param ratio_h: ratio of height from polys to mask
+    :return: uint8 mask with 255 in text regions
+    """
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    if boxes is None:
+        return mask
+    polys = boxes[:, :8].reshape(-1, 4, 2) * np.array([ratio_w, ratio_h])
+    for poly in np.around(polys).astype(np.int32):
+        # polys are convex and overlap, each of them is filled separately, so overlap is not a hole
+        cv2.fillConvexPoly(mask, poly, 255)
+    return mask
+
+
 def plot_filled_mask(img, boxes):
     """
     Plot filled boxes on a black image
@@ -221,22 +258,39 @@ class SegmentText:
         self.model = EAST(pretrained=True, model_path=vgg16_path).to(device)
         self.model.load_state_dict(torch.load(east_path, map_location=device))  # Add map_location for device
         self.model.eval()
+        self._input = None  # input tensor is used again by next batches with the same shape
+
+    def get_input(self, batch_size, height, width):
+        """Input tensor on device for batch, it is allocated again only for new shape"""
+        if self._input is None or self._input.shape[0] < batch_size or self._input.shape[2:] != (height, width):
+            self._input = torch.empty((batch_size, 3, height, width), dtype=torch.float32, device=self.device)
+        return self._input[:batch_size]
+
+    def detect_text_batch(self, frames, max_resolution=1280):
+        """
+        Detect text in frames by one forward of EAST
+        :param frames: BGR uint8 frames with the same size
+        :param max_resolution: max side of frames for model
+        :return: list of uint8 masks with size of frames, 255 is text
+        """
+        h, w = frames[0].shape[:2]
+        scale = min(1., max_resolution / max(w, h))
+        # size for model is divisible by 32
+        resize_w, resize_h = int(w * scale) // 32 * 32, int(h * scale) // 32 * 32
+        batch = np.stack([cv2.resize(frame, (resize_w, resize_h), interpolation=cv2.INTER_LINEAR) for frame in frames])
+        inputs = self.get_input(len(frames), resize_h, resize_w)
+        with torch.no_grad():
+            # BGR uint8 to normalized RGB on device
+            inputs.copy_(torch.from_numpy(batch[..., ::-1].copy()).to(self.device).permute(0, 3, 1, 2))
+            inputs.div_(255).sub_(0.5).div_(0.5)
+            score, geo = self.model(inputs)
+        score, geo = score.cpu().numpy(), geo.cpu().numpy()
+        return [fill_polys_mask((h, w), get_boxes(score[i], geo[i]), w / resize_w, h / resize_h) for i in range(len(frames))]
 
     def detect_text(self, img_path, max_resolution=1280):
-        img = Image.open(img_path)
-        # Resize to improve quality
-        w, h = img.size
-        if max(w, h) > max_resolution:
-            scale = max_resolution / max(w, h)
-            new_w, new_h = int(w * scale), int(h * scale)
-            img = img.resize((new_w, new_h))
-        img, _, _ = resize_img(img)  # Get resized image
-        # Detect text boxes
-        boxes = detect(img, self.model, self.device)
-        # Use the new function to draw filled boxes
-        filled_mask = plot_filled_mask(img, boxes)
-        # Restore image
-        return filled_mask.resize((w, h))
+        frame = cv2.imread(img_path)
+        mask = self.detect_text_batch([frame], max_resolution=max_resolution)[0]
+        return Image.fromarray(mask).convert("RGB")
 
     @staticmethod
     def apply_mask_on_frame(mask, frame, color, width=None, height=None):
@@ -1,24 +1,232 @@
 import os
 import sys
+import hashlib
+import cv2
 import numpy as np
+from tqdm import tqdm
 import torch  # import torch first to use cuda for onnx, also need to install onnxruntime-gpu for this
 
 import insightface
 
 import onnxruntime
+from insightface.app.common import Face
+from insightface.utils import face_align
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.model_registry import model_registry
+
+
+class FaceTrackCache:
+    """
+    Detected faces for each frame of video saved as numpy arrays on disk.
+    The same video with the same trim range and transformations will not be detected again.
+    """
+    fields = ("bbox", "kps", "det_score", "gender", "age", "embedding")
+    embedding_dim = 512  # size of arcface embedding
+
+    def __init__(self, cache_dir: str, max_files: int = 64):
+        """
+        Initialization
+        :param cache_dir: directory for cache files
+        :param max_files: max number of videos in cache, old files will be removed
+        """
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(video: str, *params) -> str:
+        """
+        Get key by content of video and params like trim range, rotate, crop and resize
+        :param video: path to video
+        :param params: params which change frames
+        :return: key
+        """
+        hasher = hashlib.blake2b(digest_size=20)
+        with open(video, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        hasher.update(repr(params).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def load(self, key: str, limit: int = None):
+        """
+        Load faces for frames from cache
+        :param key: cache key
+        :param limit: number of frames which will be used
+        :return: list of faces for each frame or None if cache is absent
+        """
+        cache_file = self.get_path(key)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            data = np.load(cache_file)
+            cached_limit = int(data["limit"])
+            if cached_limit >= 0 and (limit is None or limit > cached_limit):
+                return None  # cache was created for less number of frames
+            offsets = data["offsets"]
+            fields = {field: data[field] for field in self.fields}
+        except Exception as err:
+            print(f"Face cache {cache_file} can not be read: {err}")
+            return None
+        os.utime(cache_file)  # update time for removing old files
+
+        predictions = []
+        for i in range(len(offsets) - 1):
+            if limit is not None and i >= limit:
+                break
+            start, end = offsets[i], offsets[i + 1]
+            predictions.append([Face(**{field: value[j] for field, value in fields.items()}) for j in range(start, end)])
+        return predictions
+
+    def save(self, key: str, predictions: list, limit: int = None):
+        """
+        Save faces for frames in cache
+        :param key: cache key
+        :param predictions: list of faces for each frame
+        :param limit: number of frames which were detected or None if whole video
+        :return: None
+        """
+        faces = [face for dets in predictions for face in dets]
+        offsets = np.cumsum([0] + [len(dets) for dets in predictions]).astype(np.int64)
+        data = {
+            # shapes are explicit, so video without faces is saved and loaded as empty arrays
+            "bbox": np.array([face.bbox for face in faces], dtype=np.float32).reshape(len(faces), 4),
+            "kps": np.array([face.kps for face in faces], dtype=np.float32).reshape(len(faces), 5, 2),
+            "det_score": np.array([face.det_score for face in faces], dtype=np.float32).reshape(len(faces)),
+            "gender": np.array([face.gender for face in faces], dtype=np.int8).reshape(len(faces)),
+            "age": np.array([face.age for face in faces], dtype=np.int16).reshape(len(faces)),
+            "embedding": np.array([face.embedding for face in faces], dtype=np.float32).reshape(len(faces), self.embedding_dim),
+        }
+        tmp_file = self.get_path(key) + ".tmp.npz"
+        np.savez(tmp_file, offsets=offsets, limit=np.int64(-1 if limit is None else limit), **data)
+        os.replace(tmp_file, self.get_path(key))
+        self.remove_old_files()
+
+    def remove_old_files(self):
+        cache_files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npz")]
+        cache_files.sort(key=os.path.getmtime, reverse=True)
+        for cache_file in cache_files[self.max_files:]:
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
+
+
+class FaceIdentityGallery:
+    """
+    Embeddings of one face identity in preallocated matrix with fixed capacity.
+    When gallery is full, new embeddings replace old by reservoir sampling, so gallery keeps representative samples
+    of whole video. Distances to all samples are calculated by one matrix product.
+    """
+    def __init__(self, capacity: int = 256, dim: int = 512, seed: int = 0):
+        """
+        Initialization
+        :param capacity: max number of embeddings
+        :param dim: size of embedding
+        :param seed: seed for reservoir sampling
+        """
+        self.capacity = capacity
+        self.embeddings = np.zeros((capacity, dim), dtype=np.float32)
+        self.square_norms = np.zeros(capacity, dtype=np.float32)
+        self.count = 0  # number of embeddings in matrix
+        self.num_seen = 0  # number of all added embeddings
+        self.embedding_sum = np.zeros(dim, dtype=np.float64)
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def centroid(self):
+        if self.num_seen == 0:
+            return None
+        return (self.embedding_sum / self.num_seen).astype(np.float32)
+
+    def add(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if embedding.shape[0] != self.embeddings.shape[1]:
+            # gallery created with default size, but model has another size of embedding
+            if self.num_seen > 0:
+                raise ValueError(f"Embedding size {embedding.shape[0]} is not equal gallery size {self.embeddings.shape[1]}")
+            self.embeddings = np.zeros((self.capacity, embedding.shape[0]), dtype=np.float32)
+            self.embedding_sum = np.zeros(embedding.shape[0], dtype=np.float64)
+        self.num_seen += 1
+        self.embedding_sum += embedding
+        if self.count < self.capacity:
+            idx = self.count
+            self.count += 1
+        else:
+            idx = self.rng.integers(0, self.num_seen)
+            if idx >= self.capacity:
+                return
+        self.embeddings[idx] = embedding
+        self.square_norms[idx] = np.dot(embedding, embedding)
+
+    def distances(self, embeddings):
+        """
+        Euclidean distances between embeddings and all samples of gallery
+        :param embeddings: one embedding or matrix of embeddings
+        :return: matrix of distances with shape (number of embeddings, number of samples)
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        samples = self.embeddings[:self.count]
+        square_distances = np.sum(embeddings ** 2, axis=1)[:, None] + self.square_norms[None, :self.count] - 2 * embeddings @ samples.T
+        return np.sqrt(np.maximum(square_distances, 0))
 
 
 class FaceRecognition:
     """ONNX Face Recognition (if I will use onnx models)"""
-    def __init__(self, model_path):
+    def __init__(self, model_path, cache_dir=None, num_workers: int = None, intra_op_threads: int = None, batch_size: int = 16,
+                 keyframe_interval: int = 1):
+        """
+        Initialization
+        :param model_path: path to models
+        :param cache_dir: directory to cache detected faces of video
+        :param keyframe_interval: detect faces each n frame and track faces between, 1 is detect on each frame
+        :param num_workers: number of frames analysed at the same time, by default WUNJO_FACE_WORKERS or cpu count
+        :param intra_op_threads: number of onnx threads for each model run, by default cpu count divided by workers
+        :param batch_size: number of frames in one batch for video
+        """
         # use cpu as with cuda on onnx can be problem
         access_providers = onnxruntime.get_available_providers()
         if "CUDAExecutionProvider" in access_providers:
             provider = ["CUDAExecutionProvider"] if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else ["CPUExecutionProvider"]
         else:
             provider = ["CPUExecutionProvider"]
-        self.face_analyser = insightface.app.FaceAnalysis(name='buffalo_l', root=model_path, providers=provider)
-        self.face_analyser.prepare(ctx_id=0)
+        self.face_track_cache = FaceTrackCache(cache_dir) if cache_dir else None
+
+        cpu_count = os.cpu_count() or 1
+        if num_workers is None:
+            # on gpu frames are processed in one stream, on cpu frames use all cores
+            default_workers = 1 if "CUDAExecutionProvider" in provider else min(cpu_count, 8)
+            num_workers = int(os.environ.get('WUNJO_FACE_WORKERS', default_workers))
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+        if "CPUExecutionProvider" in provider and (self.num_workers > 1 or intra_op_threads is not None):
+            intra_op_threads = intra_op_threads or max(1, cpu_count // self.num_workers)
+        else:
+            intra_op_threads = None
+
+        def load_face_analyser():
+            face_analyser = insightface.app.FaceAnalysis(name='buffalo_l', root=model_path, providers=provider)
+            face_analyser.prepare(ctx_id=0)
+            if intra_op_threads is not None:
+                self.set_session_threads(face_analyser, provider, intra_op_threads)
+            return face_analyser
+
+        device = "cuda" if "CUDAExecutionProvider" in provider else "cpu"
+        # analyser with other number of threads is other model in registry
+        self.face_analyser = model_registry.get(f"buffalo_l_{intra_op_threads or 0}", load_face_analyser, device)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers) if self.num_workers > 1 else None
+
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.max_track_error = 0.03  # max forward-backward error of key point relative to face size
+        self.max_track_scale_change = 0.2  # max change of face size between two frames
+        self.scene_cut_threshold = 40  # mean difference of small gray frames to detect scene cut
 
         self.window = []
         self.window_size = 50  # last n distances for sliding window
@@ -26,20 +234,226 @@ class FaceRecognition:
         self.max_rate_of_change = 0.05  # maximum allowed rate of change for running average
         self.fixed_threshold = 0.6  # initial fixed threshold
 
+    @staticmethod
+    def set_session_threads(face_analyser, provider, intra_op_threads: int, inter_op_threads: int = 1):
+        """
+        Recreate onnx sessions of analyser models with threads options, insightface does not pass session options
+        :param face_analyser: insightface FaceAnalysis
+        :param provider: onnx providers
+        :param intra_op_threads: number of threads for one operation
+        :param inter_op_threads: number of threads for parallel operations
+        :return: None
+        """
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = intra_op_threads
+        session_options.inter_op_num_threads = inter_op_threads
+        for model in face_analyser.models.values():
+            model.session = onnxruntime.InferenceSession(model.model_file, sess_options=session_options, providers=provider)
+
     def get_faces(self, frame):
         return self.face_analyser.get(frame)
 
+    def detect_faces(self, frame):
+        """
+        Detect faces on frame and get all attributes except recognition embedding
+        :param frame: frame
+        :return: list of faces
+        """
+        bboxes, kpss = self.face_analyser.det_model.detect(frame, max_num=0, metric='default')
+        faces = []
+        for i in range(bboxes.shape[0]):
+            face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+            for taskname, model in self.face_analyser.models.items():
+                if taskname in ("detection", "recognition"):
+                    continue
+                model.get(frame, face)
+            faces.append(face)
+        return faces
+
+    def get_faces_batch(self, frames: list):
+        """
+        Get faces for batch of frames. Detection runs in threads, recognition runs as one batch for all faces
+        :param frames: list of frames
+        :return: list of faces for each frame in the same order
+        """
+        if self.executor is not None and len(frames) > 1:
+            predictions = list(self.executor.map(self.detect_faces, frames))
+        else:
+            predictions = [self.detect_faces(frame) for frame in frames]
+
+        recognition_model = self.face_analyser.models.get("recognition")
+        if recognition_model is None:
+            return predictions
+
+        faces = [face for dets in predictions for face in dets]
+        aligned_faces = [
+            face_align.norm_crop(frame, landmark=face.kps, image_size=recognition_model.input_size[0])
+            for frame, dets in zip(frames, predictions) for face in dets
+        ]
+        for start in range(0, len(aligned_faces), self.batch_size * 4):
+            embeddings = recognition_model.get_feat(aligned_faces[start:start + self.batch_size * 4])
+            for face, embedding in zip(faces[start:start + self.batch_size * 4], embeddings):
+                face.embedding = embedding.flatten()
+        return predictions
+
+    def get_faces_video(self, frames, total: int = None, cache_key: str = None, limit: int = None):
+        """
+        Detect faces for each frame of video, faces will be got from cache if video was already detected
+        :param frames: iterable of frames
+        :param total: number of frames for progress
+        :param cache_key: key of video in cache or None to not use cache
+        :param limit: max number of frames if video is not read to the end
+        :return: list of faces for each frame
+        """
+        use_cache = self.face_track_cache is not None and cache_key is not None
+        if use_cache:
+            predictions = self.face_track_cache.load(cache_key, limit)
+            if predictions is not None:
+                print("Faces are loaded from cache")
+                return predictions
+
+        if self.keyframe_interval > 1:
+            predictions = self.track_faces_video(frames, total)
+        else:
+            predictions = self.detect_faces_video(frames, total)
+
+        if use_cache:
+            try:
+                self.face_track_cache.save(cache_key, predictions, limit)
+            except Exception as err:
+                print(f"Faces are not saved in cache: {err}")
+        return predictions
+
+    def detect_faces_video(self, frames, total: int = None):
+        """
+        Detect faces on each frame by batches
+        :param frames: iterable of frames
+        :param total: number of frames for progress
+        :return: list of faces for each frame
+        """
+        predictions = []
+        batch = []
+        progress_bar = tqdm(total=total, desc="Face detection")
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) >= self.batch_size:
+                predictions += self.get_faces_batch(batch)
+                progress_bar.update(len(batch))
+                batch = []
+        if batch:
+            predictions += self.get_faces_batch(batch)
+            progress_bar.update(len(batch))
+        progress_bar.close()
+        return predictions
+
+    def track_faces_video(self, frames, total: int = None):
+        """
+        Detect faces on keyframes and move faces by optical flow of key points between keyframes.
+        Faces are detected again on scene cut, when track is lost or when there are no faces to track.
+        :param frames: iterable of frames
+        :param total: number of frames for progress
+        :return: list of faces for each frame
+        """
+        predictions = []
+        prev_gray, prev_small, prev_faces = None, None, []
+        since_keyframe = 0
+        num_keyframes = 0
+        for frame in tqdm(frames, total=total, desc="Face tracking"):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+            faces = None
+            is_scene_cut = prev_small is not None and np.mean(np.abs(small - prev_small)) > self.scene_cut_threshold
+            if prev_faces and since_keyframe < self.keyframe_interval and not is_scene_cut:
+                faces = self.track_faces(prev_gray, gray, prev_faces)
+            if faces is None:
+                faces = self.get_faces_batch([frame])[0]
+                since_keyframe = 0
+                num_keyframes += 1
+            predictions.append(faces)
+            since_keyframe += 1
+            prev_gray, prev_small, prev_faces = gray, small, faces
+        print(f"Faces are detected on {num_keyframes} keyframes from {len(predictions)} frames")
+        return predictions
+
+    def track_faces(self, prev_gray, gray, faces: list):
+        """
+        Move faces from previous frame to current frame by optical flow of key points
+        :param prev_gray: previous gray frame
+        :param gray: current gray frame
+        :param faces: faces on previous frame
+        :return: list of faces or None if track is lost and faces should be detected again
+        """
+        points = np.concatenate([face.kps for face in faces]).astype(np.float32).reshape(-1, 1, 2)
+        lk_params = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **lk_params)
+        if next_points is None:
+            return None
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, next_points, None, **lk_params)
+        if back_points is None:
+            return None
+        is_tracked = (status.reshape(-1) == 1) & (back_status.reshape(-1) == 1)
+        errors = np.linalg.norm((points - back_points).reshape(-1, 2), axis=1)
+
+        tracked_faces = []
+        num_kps = len(faces[0].kps)
+        for i, face in enumerate(faces):
+            face_slice = slice(i * num_kps, (i + 1) * num_kps)
+            x1, y1, x2, y2 = face.bbox
+            face_size = max(x2 - x1, y2 - y1, 1)
+            if not is_tracked[face_slice].all() or errors[face_slice].max() > max(1.5, self.max_track_error * face_size):
+                return None  # drift of key points
+            old_kps = points[face_slice].reshape(-1, 2)
+            new_kps = next_points[face_slice].reshape(-1, 2)
+            matrix, _ = cv2.estimateAffinePartial2D(old_kps, new_kps)
+            if matrix is None:
+                return None
+            scale = np.sqrt(matrix[0, 0] ** 2 + matrix[1, 0] ** 2)
+            if abs(scale - 1) > self.max_track_scale_change:
+                return None
+            center_x, center_y = matrix @ np.array([(x1 + x2) / 2, (y1 + y2) / 2, 1], dtype=np.float32)
+            half_w, half_h = (x2 - x1) * scale / 2, (y2 - y1) * scale / 2
+
+            tracked_face = Face(dict(face))  # attributes and embedding are kept from keyframe
+            tracked_face.bbox = np.array([center_x - half_w, center_y - half_h, center_x + half_w, center_y + half_h], dtype=np.float32)
+            tracked_face.kps = new_kps
+            if face.get("landmark_2d_106") is not None:
+                tracked_face.landmark_2d_106 = cv2.transform(face.landmark_2d_106.reshape(-1, 1, 2).astype(np.float32), matrix).reshape(-1, 2)
+            if face.get("landmark_3d_68") is not None:
+                landmark_3d_68 = face.landmark_3d_68.copy()
+                landmark_3d_68[:, :2] = cv2.transform(landmark_3d_68[:, :2].reshape(-1, 1, 2).astype(np.float32), matrix).reshape(-1, 2)
+                tracked_face.landmark_3d_68 = landmark_3d_68
+            tracked_faces.append(tracked_face)
+        return tracked_faces
+
     @staticmethod
     def calculate_distance(embedding1, embedding2):
         # Your distance calculation here
         return np.linalg.norm(embedding1 - embedding2)
 
     def is_similar_face(self, embedding, face_pred_list, similar_coeff: float = 0.95) -> bool:
-        if not face_pred_list:
+        if not len(face_pred_list):
             return False
 
-        distances = [self.calculate_distance(embedding, known_embedding) for known_embedding in face_pred_list]
+        if isinstance(face_pred_list, FaceIdentityGallery):
+            distances = face_pred_list.distances(embedding)[0]
+        else:
+            distances = np.linalg.norm(np.asarray(face_pred_list) - embedding, axis=1)
+
+        return self.is_similar_by_distances(distances, similar_coeff)
+
+    def is_similar_faces(self, embeddings: list, gallery: FaceIdentityGallery, similar_coeff: float = 0.95) -> list:
+        """
+        Check many faces of one frame with gallery by one matrix product
+        :param embeddings: list of embeddings
+        :param gallery: gallery of face identity
+        :param similar_coeff: similar coefficient
+        :return: list of bool for each embedding
+        """
+        if not len(gallery) or not len(embeddings):
+            return [False] * len(embeddings)
+        return [self.is_similar_by_distances(distances, similar_coeff) for distances in gallery.distances(np.stack(embeddings))]
 
+    def is_similar_by_distances(self, distances, similar_coeff: float = 0.95) -> bool:
         current_average = np.mean(distances)
 
         if self.running_average is None:
@@ -1,3 +1,5 @@
+from collections import deque
+
 import cv2
 import torch
 import numpy as np
@@ -7,6 +9,7 @@ from tqdm import tqdm
 from torchvision import transforms
 
 from .inpaint_model import InpaintModel
+from backend.model_registry import get_free_memory
 
 # Retouch new approach
 from .model.modules.flow_comp_raft import RAFT_bi
@@ -193,11 +196,77 @@ class VideoRemoveObjectProcessor:
         return Image.fromarray(frame_rgb)
 
     def process_video_with_mask(self, frames, masks_dilated, flow_masks, frames_inp, width, height, raft_iter=20, subvideo_length=80, neighbor_length=10, ref_stride=10, use_half=False):
+        gt_flows_bi = self.compute_flows(frames, raft_iter=raft_iter)
+        return self.complete_video(frames, masks_dilated, flow_masks, frames_inp, gt_flows_bi, width, height, subvideo_length=subvideo_length, neighbor_length=neighbor_length, ref_stride=ref_stride, use_half=use_half)
+
+    @staticmethod
+    def estimate_memory(width, height, window_size=0, short_clip_len=0):
+        """
+        Estimate memory to remove object in window
+        :param width: frame width
+        :param height: frame height
+        :param window_size: frames in ProPainter window
+        :param short_clip_len: frames in RAFT clip
+        :return: bytes
+        """
+        # correlation pyramids of RAFT for forward and backward flow of each pair of frames
+        raft_pair = 2 * ((height // 8) * (width // 8)) ** 2 * 4 * 4 / 3
+        # frames, masks, flows, propagated frames and features of one frame of window in float32
+        window_frame = height * width * 4 * 36
+        return int(raft_pair * short_clip_len + window_frame * window_size)
+
+    def plan_batches(self, width, height, neighbor_length=10, memory_fraction=0.7, max_window_size=80, min_window_size=10):
+        """
+        Size RAFT clip and ProPainter window by free memory of device, instead of fixed tables
+        :param width: frame width
+        :param height: frame height
+        :param neighbor_length: neighbor frames of transformer, it needs memory in addition to window
+        :param memory_fraction: part of free memory to use
+        :param max_window_size: max frames in window
+        :param min_window_size: min frames in window
+        :return: frames in RAFT clip, frames in window
+        """
+        free_memory = get_free_memory(self.device) * memory_fraction
+        short_clip_len = int(free_memory * 0.5 // max(self.estimate_memory(width, height, short_clip_len=1), 1))
+        short_clip_len = min(12, max(2, short_clip_len))
+        window_size = int(free_memory // max(self.estimate_memory(width, height, window_size=1), 1)) - neighbor_length
+        window_size = min(max_window_size, max(min_window_size, window_size))
+        print(f"Free memory {free_memory / 1024 ** 3:.1f} Gb for {width}x{height}: RAFT clip {short_clip_len} frames, window {window_size} frames")
+        return short_clip_len, window_size
+
+    @staticmethod
+    def get_max_size(width, height, free_memory, min_window_size=10, neighbor_length=10, memory_fraction=0.7,
+                     sizes=(1920, 1280, 1080, 960, 768, 720, 640, 480, 320)):
+        """
+        Max side of frames which minimal window fits in free memory
+        :param width: frame width
+        :param height: frame height
+        :param free_memory: free memory in bytes
+        :return: max side of frames
+        """
+        max_side = max(width, height)
+        for size in [max_side] + [size for size in sizes if size < max_side]:
+            scale = size / max_side
+            need = VideoRemoveObjectProcessor.estimate_memory(int(width * scale), int(height * scale), min_window_size + neighbor_length, 2)
+            if need <= free_memory * memory_fraction:
+                return size
+        return sizes[-1]
+
+    def compute_flows(self, frames, raft_iter=20, short_clip_len=None):
+        """
+        Forward and backward flows of RAFT between neighbour frames
+        :param frames: frames (1, T, 3, H, W)
+        :param raft_iter: iterations of RAFT
+        :param short_clip_len: frames in one RAFT run, None to choose by width
+        :return: forward and backward flows (1, T - 1, 2, H, W)
+        """
         video_length = frames.size(1)
 
         with torch.no_grad():
             # ---- compute flow ----
-            if frames.size(-1) <= 640:
+            if short_clip_len is not None:
+                pass
+            elif frames.size(-1) <= 640:
                 short_clip_len = 12
             elif frames.size(-1) <= 720:
                 short_clip_len = 8
@@ -226,7 +295,21 @@ class VideoRemoveObjectProcessor:
             else:
                 gt_flows_bi = self.fix_raft(frames, iters=raft_iter)
                 torch.cuda.empty_cache()
+        return gt_flows_bi
+
+    def complete_video(self, frames, masks_dilated, flow_masks, frames_inp, gt_flows_bi, width, height, subvideo_length=80, neighbor_length=10, ref_stride=10, use_half=False):
+        """
+        Complete flows, propagate image and inpaint frames by transformer
+        :param frames: frames (1, T, 3, H, W) in [-1, 1]
+        :param masks_dilated: masks (1, T, 1, H, W)
+        :param flow_masks: masks for flow (1, T, 1, H, W)
+        :param frames_inp: RGB uint8 frames
+        :param gt_flows_bi: flows of RAFT from compute_flows
+        :return: list of RGB uint8 frames
+        """
+        video_length = frames.size(1)
 
+        with torch.no_grad():
             if use_half:
                 frames, flow_masks, masks_dilated = frames.half(), flow_masks.half(), masks_dilated.half()
                 gt_flows_bi = (gt_flows_bi[0].half(), gt_flows_bi[1].half())
@@ -302,7 +385,7 @@ class VideoRemoveObjectProcessor:
             ref_num = -1
 
         # ---- feature propagation + transformer ----
-        for f in tqdm(range(0, video_length, neighbor_stride)):
+        for f in tqdm(range(0, video_length, neighbor_stride), desc="ProPainter"):
             neighbor_ids = [i for i in range(max(0, f - neighbor_stride), min(video_length, f + neighbor_stride + 1))]
             ref_ids = self.get_ref_index(f, neighbor_ids, video_length, ref_stride, ref_num)
             selected_imgs = updated_frames[:, neighbor_ids + ref_ids, :, :, :]
@@ -336,8 +419,217 @@ class VideoRemoveObjectProcessor:
 
         return comp_frames
 
+    def frame_to_tensor(self, frame):
+        """RGB uint8 frame to tensor (3, H, W) in [-1, 1] on device"""
+        return torch.from_numpy(np.ascontiguousarray(frame)).to(self.device).permute(2, 0, 1).float().div_(255.).mul_(2).sub_(1)
+
+    def mask_to_tensor(self, mask):
+        """Pillow mask 0 or 255 to tensor (1, H, W) on device"""
+        return torch.from_numpy(np.array(mask)).to(self.device).float().div_(255.).unsqueeze(0)
+
+    def process_video_stream(self, items, width, height, window_size=50, overlap=10, raft_iter=20, subvideo_length=80,
+                             neighbor_length=10, ref_stride=10, use_half=False, kernel_size=10, short_clip_len=None):
+        """
+        Remove object from video by sliding window, frames are yielded when window is done.
+        Ring buffer on device keeps frames, masks and RAFT flows of window. Flows are computed only for new frames,
+        last overlap frames of window are kept with result and empty mask as context for next window.
+        Frames with empty mask far from masked frames are yielded without RAFT and ProPainter,
+        last overlap of them are kept to be context of next masked frames.
+        :param items: iterable of RGB uint8 frame with size width x height (sides are multiple of 8) and bool mask (H, W) of any size
+        :param width: width of frames
+        :param height: height of frames
+        :param window_size: frames in window with context
+        :param overlap: context frames from previous window
+        :param raft_iter: iterations of RAFT
+        :param use_half: use fp16 after RAFT
+        :param kernel_size: dilation of mask
+        :param short_clip_len: frames in one RAFT run, None to choose by width
+        :return: generator of RGB uint8 frames
+        """
+        overlap = min(overlap, window_size - 3)  # not less than 3 new frames in window
+        buffer_frames, buffer_inp, buffer_flow_masks, buffer_masks = [], [], [], []
+        buffer_flows_f, buffer_flows_b = [], []
+        num_context = 0
+        recent = deque(maxlen=max(overlap, 1))  # frames yielded without changes
+        trailing_empty = 0  # frames with empty mask after last masked frame
+        pending = None
+        source = iter(items)
+        is_end = False
+
+        while not is_end:
+            # fill ring buffer by new frames
+            first_new = len(buffer_frames)
+            while len(buffer_frames) < window_size:
+                item = pending if pending is not None else next(source, None)
+                pending = None
+                if item is None:
+                    is_end = True
+                    break
+                frame, mask = item
+                if not np.any(mask):
+                    if len(buffer_frames) == num_context:
+                        # nothing to remove in window, context is already yielded
+                        recent.extend(buffer_inp)
+                        buffer_frames, buffer_inp, buffer_flow_masks, buffer_masks = [], [], [], []
+                        buffer_flows_f, buffer_flows_b = [], []
+                        num_context = first_new = 0
+                        recent.append(frame)
+                        yield frame
+                        continue
+                    if trailing_empty >= overlap and len(buffer_frames) >= 3:
+                        # enough context after masked frames, window is done early
+                        pending = item
+                        break
+                    trailing_empty += 1
+                    flow_mask = masks_dilated = torch.zeros((1, height, width), device=self.device)
+                else:
+                    trailing_empty = 0
+                    if not buffer_frames and recent:
+                        # frames before object are context without mask
+                        for prev_frame in recent:
+                            buffer_frames.append(self.frame_to_tensor(prev_frame))
+                            buffer_inp.append(prev_frame)
+                            buffer_flow_masks.append(torch.zeros((1, height, width), device=self.device))
+                            buffer_masks.append(torch.zeros((1, height, width), device=self.device))
+                        num_context = len(recent)
+                        recent.clear()
+                    flow_masks, masks_dilated = self.read_retouch_mask([mask], width, height, kernel_size=kernel_size)
+                    flow_mask, masks_dilated = self.mask_to_tensor(flow_masks[0]), self.mask_to_tensor(masks_dilated[0])
+                buffer_frames.append(self.frame_to_tensor(frame))
+                buffer_inp.append(frame)
+                buffer_flow_masks.append(flow_mask)
+                buffer_masks.append(masks_dilated)
+            if len(buffer_frames) == num_context:
+                break
+            if len(buffer_frames) < 3:
+                # too short video for flows, frames are without changes
+                for frame in buffer_inp[num_context:]:
+                    yield frame
+                break
+
+            # flows only between new frames and last frame of context
+            flows_start = max(0, first_new - 1)
+            flows_f, flows_b = self.compute_flows(
+                torch.stack(buffer_frames[flows_start:]).unsqueeze(0), raft_iter=raft_iter, short_clip_len=short_clip_len
+            )
+            buffer_flows_f += list(flows_f[0])
+            buffer_flows_b += list(flows_b[0])
+
+            gt_flows_bi = (torch.stack(buffer_flows_f).unsqueeze(0), torch.stack(buffer_flows_b).unsqueeze(0))
+            comp_frames = self.complete_video(
+                torch.stack(buffer_frames).unsqueeze(0), torch.stack(buffer_masks).unsqueeze(0),
+                torch.stack(buffer_flow_masks).unsqueeze(0), buffer_inp, gt_flows_bi, width, height,
+                subvideo_length=subvideo_length, neighbor_length=neighbor_length, ref_stride=ref_stride, use_half=use_half
+            )
+            for frame in comp_frames[num_context:]:
+                yield frame
+            if is_end:
+                break
+
+            # keep last frames with result as context, result is already known, so mask is empty
+            drop = len(buffer_frames) - overlap
+            buffer_frames = [self.frame_to_tensor(frame) for frame in comp_frames[drop:]]
+            buffer_inp = comp_frames[drop:]
+            buffer_flow_masks = [torch.zeros_like(mask) for mask in buffer_flow_masks[drop:]]
+            buffer_masks = [torch.zeros_like(mask) for mask in buffer_masks[drop:]]
+            buffer_flows_f, buffer_flows_b = buffer_flows_f[drop:], buffer_flows_b[drop:]
+            num_context = overlap
+
+
+def get_mask_roi(mask, pad_ratio=0.5, min_pad=64, multiple=32, max_area_ratio=0.6):
+    """
+    Bounding box of mask with context around it for inpaint, box sides are multiple to share size between frames
+    :param mask: bool mask (H, W)
+    :param pad_ratio: context around mask relative to max side of mask box
+    :param min_pad: min context around mask in pixels
+    :param multiple: box sides are multiple of this value, it has to be multiple of 8
+    :param max_area_ratio: if box is bigger than this part of frame, full frame is used
+    :return: (x1, y1, x2, y2), "full" to inpaint full frame or None if mask is empty
+    """
+    height, width = mask.shape[:2]
+    x, y, w, h = cv2.boundingRect(mask.astype(np.uint8))
+    if w == 0 or h == 0:
+        return None
+    pad = max(min_pad, int(max(w, h) * pad_ratio))
+    crop_w = -(-(w + 2 * pad) // multiple) * multiple
+    crop_h = -(-(h + 2 * pad) // multiple) * multiple
+    if crop_w > width or crop_h > height or crop_w * crop_h > max_area_ratio * width * height:
+        return "full"
+    # center box on mask and move inside frame
+    x1 = min(max(0, x + w // 2 - crop_w // 2), width - crop_w)
+    y1 = min(max(0, y + h // 2 - crop_h // 2), height - crop_h)
+    return x1, y1, x1 + crop_w, y1 + crop_h
+
+
+def inpaint_batch(images, masks, model):
+    """
+    Inpaint batch of images by one forward
+    :param images: uint8 RGB images (N, H, W, 3), sides are multiple of 8
+    :param masks: bool masks (N, H, W)
+    :param model: InpaintModel
+    :return: uint8 RGB images (N, H, W, 3)
+    """
+    img = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2).float()
+    img = (img / 255 - 0.5) / 0.5
+    mask = torch.from_numpy(masks[:, None].astype(np.float32))
+
+    with torch.no_grad():
+        generated, _ = model({'image': img, 'mask': mask})
+    generated = torch.clamp(generated, -1, 1)
+    generated = (generated + 1) / 2 * 255
+    return generated.cpu().numpy().astype(np.uint8).transpose((0, 2, 3, 1))
+
+
+def process_retouch_batch(imgs, masks, model, batch_size=4):
+    """
+    Retouch frames only in region of mask. Crop around mask is inpainted and pasted back,
+    crops of the same size from different frames are inpainted together
+    :param imgs: list of pillow images
+    :param masks: list of pillow masks
+    :param model: InpaintModel
+    :param batch_size: max crops in one forward
+    :return: list of pillow images
+    """
+    results = [None] * len(imgs)
+    groups = {}
+    for i, (img, mask) in enumerate(zip(imgs, masks)):
+        img = img.convert("RGB")
+        if mask.size != img.size:
+            mask = mask.resize(img.size, Image.NEAREST)
+        mask_np = np.array(mask) > 0
+        roi = get_mask_roi(mask_np)
+        if roi is None:
+            results[i] = img  # nothing to retouch
+        elif roi == "full":
+            results[i] = process_retouch(img, mask, model, roi=False)
+        else:
+            x1, y1, x2, y2 = roi
+            groups.setdefault((y2 - y1, x2 - x1), []).append((i, np.array(img), mask_np, roi))
+
+    for items in groups.values():
+        for j in range(0, len(items), batch_size):
+            batch = items[j:j + batch_size]
+            crops = np.stack([img_np[y1:y2, x1:x2] for _, img_np, _, (x1, y1, x2, y2) in batch])
+            crop_masks = np.stack([mask_np[y1:y2, x1:x2] for _, _, mask_np, (x1, y1, x2, y2) in batch])
+            generated = inpaint_batch(crops, crop_masks, model)
+            for (i, img_np, _, (x1, y1, x2, y2)), crop, crop_mask, gen in zip(batch, crops, crop_masks, generated):
+                img_np[y1:y2, x1:x2] = np.where(crop_mask[..., None], gen, crop)
+                results[i] = Image.fromarray(img_np)
+    return results
+
+
+def process_retouch(img, mask, model, roi=True):
+    """
+    Retouch image by mask
+    :param img: pillow image
+    :param mask: pillow mask
+    :param model: InpaintModel
+    :param roi: inpaint only region around mask, full frame is used for big masks
+    :return: pillow image
+    """
+    if roi:
+        return process_retouch_batch([img], [mask], model)[0]
 
-def process_retouch(img, mask, model):
     img = img.convert("RGB")
     img_raw = np.array(img)
     w_raw, h_raw = img.size
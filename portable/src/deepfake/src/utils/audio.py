@@ -5,6 +5,7 @@ import numpy as np
 from scipy import signal
 from scipy.io import wavfile
 from src.utils.hparams import hparams as hp
+from backend.mel import get_mel_basis, mel_magnitude
 
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
@@ -42,9 +43,19 @@ def linearspectrogram(wav):
         return _normalize(S)
     return S
 
-def melspectrogram(wav):
-    D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
-    S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+def melspectrogram(wav, device=None):
+    """
+    Mel spectrogram of wav
+    :param wav: signal
+    :param device: torch device to compute STFT, None to compute by librosa
+    :return: mel spectrogram
+    """
+    wav = preemphasis(wav, hp.preemphasis, hp.preemphasize)
+    if hp.use_lws:
+        mel = _linear_to_mel(np.abs(_stft(wav)))
+    else:
+        mel = mel_magnitude(wav, hp.sample_rate, hp.n_fft, get_hop_size(), hp.win_size, hp.num_mels, hp.fmin, hp.fmax, device=device)
+    S = _amp_to_db(mel) - hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
@@ -93,8 +104,7 @@ def _linear_to_mel(spectogram, _mel_basis = None):
 
 def _build_mel_basis():
     assert hp.fmax <= hp.sample_rate // 2
-    return librosa.filters.mel(sr=hp.sample_rate, n_fft=hp.n_fft, n_mels=hp.num_mels,
-                               fmin=hp.fmin, fmax=hp.fmax)
+    return get_mel_basis(hp.sample_rate, hp.n_fft, hp.num_mels, hp.fmin, hp.fmax)
 
 def _amp_to_db(x):
     min_level = np.exp(hp.min_level_db / 20 * np.log(10))
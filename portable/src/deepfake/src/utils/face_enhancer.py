@@ -2,15 +2,19 @@ import os
 import cv2
 import json
 import uuid
+import time
+import queue
+import threading
 
 from tqdm import tqdm
 
-from deepfake.src.utils.videoio import save_video_from_frames
+from deepfake.src.utils.videoio import check_media_type, trim_range, VideoReader, VideoWriter
 from backend.folders import DEEPFAKE_MODEL_FOLDER
 from backend.download import get_nested_url, is_connected, download_model, check_download_size
+from backend.pipeline import StageCounter, put_until_stopped, run_stage
 
 
-def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
+def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30, start=0, end=None):
     if os.path.isfile(os.path.join(DEEPFAKE_MODEL_FOLDER, 'deepfake.json')):
         with open(os.path.join(DEEPFAKE_MODEL_FOLDER, 'deepfake.json'), 'r', encoding="utf8") as file:
             config_deepfake = json.load(file)
@@ -18,8 +22,8 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
         raise "[Error] Config file deepfake.json is not exist"
 
     local_model_path = os.path.join(DEEPFAKE_MODEL_FOLDER, 'gfpgan', 'weights')
-    save_frame_folder = os.path.join(save_folder, "enhancer")
-    os.makedirs(save_frame_folder, exist_ok=True)
+    # fp16 and channels_last are faster on gpu only
+    use_cuda = 'cuda' in str(device)
 
     if method == 'gfpgan':
         from deepfake.src.utils.gfpganer import GFPGANer
@@ -40,7 +44,9 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
             arch="clean",
             channel_multiplier=2,
             bg_upsampler=None,
-            device=device
+            device=device,
+            half=use_cuda,
+            channels_last=use_cuda
         )
     elif method == 'animesgan':
         # https://raw.githubusercontent.com/xinntao/Real-ESRGAN/master/inference_realesrgan_video.py
@@ -50,12 +56,6 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
         model_path = os.path.join(local_model_path, 'realesr-animevideov3.pth')
         url = get_nested_url(config_deepfake, ["gfpgan", "realesr-animevideov3.pth"])
 
-        if device == "cpu":  # CPU
-            import warnings
-            warnings.warn('The unoptimized RealESRGAN is slow on CPU. We do not use it. '
-                          'If you really want to use it, please modify the corresponding codes.')
-            return media_path
-
         model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
         if not os.path.isfile(model_path):
             # check what is internet access
@@ -74,6 +74,8 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
             tile_pad=10,
             pre_pad=0,
             half=True,
+            device=device,
+            channels_last=True,
         )
     elif method == 'realesrgan':
         from realesrgan.archs.srvgg_arch import SRVGGNetCompact
@@ -85,12 +87,6 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
         wdn_url = get_nested_url(config_deepfake, ["gfpgan", "realesr-general-wdn-x4v3.pth"])
         models_path = [general_model_path, wdn_model_path]
 
-        if device == "cpu":  # CPU
-            import warnings
-            warnings.warn('The unoptimized RealESRGAN is slow on CPU. We do not use it. '
-                          'If you really want to use it, please modify the corresponding codes.')
-            return media_path
-
         model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
         denoise_strength = 0.5
         dni_weight = [denoise_strength, 1 - denoise_strength]
@@ -121,37 +117,15 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
             pre_pad=0,
             half=True,
             dni_weight=dni_weight,
+            device=device,
+            channels_last=True,
         )
     else:
         raise ValueError(f'Wrong model version {method}.')
 
-    if media_path.endswith(('.mp4', '.avi', '.mov', '.gif')):  # Video or GIF
-        cap = cv2.VideoCapture(media_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        for idx in tqdm(range(total_frames), desc="Processing video"):
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            if method == 'gfpgan':
-                _, _, output = restorer.enhance(frame, has_aligned=False, only_center_face=False, paste_back=True)
-            elif method in ['animesgan', 'realesrgan']:
-                # downgrade quality before upscale
-                frame = resize_frame_downscale(frame, scale=0.5)
-                output, _ = restorer.enhance(frame)
-                # downscale after upscale
-                output = resize_frame_downscale(output, scale=0.5)
-            else:
-                raise ValueError(f'Wrong model version {method}.')
-
-            # Create a unique filename based on the current frame index
-            file_name = f"{idx:04d}.png"
-            save_path = os.path.join(save_frame_folder, file_name)
-            cv2.imwrite(save_path, output)
-
-        cap.release()
-        file_name = save_video_from_frames(frame_names="%04d.png", save_path=save_frame_folder, fps=fps, alternative_save_path=save_folder)
+    if check_media_type(media_path) == "animated":  # Video or GIF
+        # video is trimmed by decoder from start to end in seconds and encoded with audio without frames on disk
+        file_name = enhance_video(restorer, method, media_path, save_folder, fps=fps, start=start, end=end)
     else:  # Image
         file_name = str(uuid.uuid4()) + '.png'
         save_path = os.path.join(save_folder, file_name)
@@ -170,6 +144,165 @@ def enhancer(media_path, save_folder, method='gfpgan', device='cpu', fps=30):
     return file_name
 
 
+def enhance_video(restorer, method, media_path, save_folder, fps=30, start=0, end=None, window_size=16, batch_size=8, queue_size=2):
+    """
+    Enhance video by windows of frames. Stages are run in parallel with bounded queues: read -> enhance -> encode.
+    Faces of all frames in window are restored by batched GFPGAN forwards,
+    RealESRGAN upscales each tile for batch of frames by one forward.
+    :param restorer: GFPGANer or RealESRGANer
+    :param method: gfpgan, animesgan or realesrgan
+    :param media_path: path to video
+    :param save_folder: directory of result
+    :param fps: frames per second
+    :param start: start of video in seconds
+    :param end: end of video in seconds
+    :param window_size: number of frames enhanced together
+    :param batch_size: max faces or frames in one forward
+    :param queue_size: number of windows waiting between stages
+    :return: file name of video with audio
+    """
+    if method == 'gfpgan':
+        stage_names = ("read", "detect", "restore", "paste", "encode")
+    elif method in ['animesgan', 'realesrgan']:
+        stage_names = ("read", "upscale", "encode")
+    else:
+        raise ValueError(f'Wrong model version {method}.')
+
+    frames = VideoReader(media_path, start=start, end=end)
+    file_name = str(uuid.uuid4()) + '.mp4'
+    save_file = os.path.join(save_folder, file_name)
+    out = None
+
+    enhance_queue, encode_queue = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+    counters = {name: StageCounter(name) for name in stage_names}
+
+    def read():
+        window = []
+        try:
+            start_time = time.time()
+            for frame in frames:
+                if stop_event.is_set():
+                    return
+                window.append(frame)
+                if len(window) == window_size:
+                    counters["read"].add(len(window), time.time() - start_time)
+                    put_until_stopped(enhance_queue, window, stop_event)
+                    window = []
+                    start_time = time.time()
+            if window:
+                counters["read"].add(len(window), time.time() - start_time)
+                put_until_stopped(enhance_queue, window, stop_event)
+        except Exception as err:
+            errors.append(err)
+            stop_event.set()
+        finally:
+            put_until_stopped(enhance_queue, None, stop_event)
+
+    def encode(window):
+        start_time = time.time()
+        for frame in window:
+            out.write(frame)
+        counters["encode"].add(len(window), time.time() - start_time)
+
+    reader = threading.Thread(target=read, daemon=True)
+    encoder = threading.Thread(target=run_stage, args=(encode, encode_queue, None, stop_event, errors), daemon=True)
+    reader.start()
+    progress_bar = tqdm(total=len(frames), desc="Face enhancement")
+    try:
+        while not stop_event.is_set():
+            try:
+                window = enhance_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if window is None:
+                break
+            if method == 'gfpgan':
+                output = enhance_faces_window(restorer, window, counters, batch_size)
+            else:
+                output = upscale_window(restorer, window, counters, batch_size)
+            if out is None:
+                frame_h, frame_w = output[0].shape[:2]
+                audio_start = trim_range(start, end)[0]
+                out = VideoWriter(save_file, fps, frame_w, frame_h, audio=media_path, audio_start=audio_start, total=len(frames), message="Enhance video")
+                encoder.start()
+            put_until_stopped(encode_queue, output, stop_event)
+            progress_bar.update(len(window))
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        progress_bar.close()
+        if out is not None:
+            put_until_stopped(encode_queue, None, stop_event)
+            encoder.join()
+        reader.join()
+        if out is not None:
+            if stop_event.is_set():
+                out.abort()
+            else:
+                out.release()
+
+    if errors:
+        raise errors[0]
+    if out is None:
+        raise ValueError(f"Video {media_path} has not frames to enhance")
+    print("Enhancer stages throughput: " + "; ".join(str(counter) for counter in counters.values()))
+    return file_name
+
+
+def enhance_faces_window(restorer, window, counters, batch_size=8):
+    """
+    Restore faces of all frames in window by batches
+    :param restorer: GFPGANer
+    :param window: list of frames
+    :param counters: stage counters
+    :param batch_size: max faces in one forward
+    :return: list of frames
+    """
+    start_time = time.time()
+    detections = []
+    for frame in window:
+        faces, affine_matrices = restorer.detect_faces(frame, only_center_face=False)
+        detections.append((faces, affine_matrices))
+    counters["detect"].add(len(window), time.time() - start_time)
+
+    start_time = time.time()
+    restored_faces = restorer.restore_faces([face for faces, _ in detections for face in faces], batch_size=batch_size)
+    counters["restore"].add(len(window), time.time() - start_time)
+
+    start_time = time.time()
+    output = []
+    offset = 0
+    for frame, (faces, affine_matrices) in zip(window, detections):
+        output.append(restorer.paste_faces(frame, affine_matrices, restored_faces[offset:offset + len(faces)]))
+        offset += len(faces)
+    counters["paste"].add(len(window), time.time() - start_time)
+    return output
+
+
+def upscale_window(restorer, window, counters, batch_size=8):
+    """
+    Upscale frames of window by batches
+    :param restorer: RealESRGANer
+    :param window: list of frames
+    :param counters: stage counters
+    :param batch_size: max frames in one forward of tile
+    :return: list of frames
+    """
+    start_time = time.time()
+    # downgrade quality before upscale
+    frames = [resize_frame_downscale(frame, scale=0.5) for frame in window]
+    output = []
+    for i in range(0, len(frames), batch_size):
+        output += restorer.enhance_batch(frames[i:i + batch_size])
+    # downscale after upscale
+    output = [resize_frame_downscale(frame, scale=0.5) for frame in output]
+    counters["upscale"].add(len(window), time.time() - start_time)
+    return output
+
+
 def resize_frame_downscale(frame, scale=0.25, min_side=320):
     # Calculate new dimensions
     height, width = frame.shape[:2]
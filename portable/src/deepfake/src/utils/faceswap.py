@@ -3,39 +3,187 @@ import sys
 import cv2
 import uuid
 import numpy as np
-import torch
 from tqdm import tqdm
 import onnxruntime
 
 import insightface
+from insightface.utils import face_align
 
-from concurrent.futures import ThreadPoolExecutor
-import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 
 root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.join(root_path, "deepfake"))
-from src.face3d.recognition import FaceRecognition
+from src.face3d.recognition import FaceRecognition, FaceIdentityGallery
+from src.utils.videoio import VideoWriter, iter_frames
 sys.path.pop(0)
 
+from backend.model_registry import model_registry
+
+
+def paste_back_face(target_img, bgr_fake, aimg, M):
+    """
+    Paste swapped face back in frame with soft mask, the same as paste back of insightface INSwapper
+    :param target_img: frame
+    :param bgr_fake: swapped aligned face
+    :param aimg: original aligned face
+    :param M: affine matrix of alignment
+    :return: frame with swapped face
+    """
+    # insightface also calculates difference mask of faces, but does not use it in result, so it is skipped
+    IM = cv2.invertAffineTransform(M)
+    img_white = np.full((aimg.shape[0], aimg.shape[1]), 255, dtype=np.float32)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, (target_img.shape[1], target_img.shape[0]), borderValue=0.0)
+    img_white = cv2.warpAffine(img_white, IM, (target_img.shape[1], target_img.shape[0]), borderValue=0.0)
+    img_white[img_white > 20] = 255
+    img_mask = img_white
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    if len(mask_h_inds) == 0:
+        return target_img  # face is out of frame
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    mask_size = int(np.sqrt(mask_h * mask_w))
+    k = max(mask_size // 10, 10)
+    kernel = np.ones((k, k), np.uint8)
+    img_mask = cv2.erode(img_mask, kernel, iterations=1)
+    k = max(mask_size // 20, 5)
+    kernel_size = (k, k)
+    blur_size = tuple(2 * i + 1 for i in kernel_size)
+    img_mask = cv2.GaussianBlur(img_mask, blur_size, 0)
+    img_mask /= 255
+    img_mask = np.reshape(img_mask, [img_mask.shape[0], img_mask.shape[1], 1])
+    fake_merged = img_mask * bgr_fake + (1 - img_mask) * target_img.astype(np.float32)
+    return fake_merged.astype(np.uint8)
+
+
+class FaceSwapEngine:
+    """
+    Face swap of video frames in stages: aligned crops of faces, one run of swap model for batch of faces
+    and paste back of faces in worker pool. Number of frames in processing is limited to bound memory.
+    Swap model runs only in caller thread, so the same engine works on CPU and GPU.
+    """
+    def __init__(self, face_swap_model, source_face, batch_size: int = 16, num_workers: int = None, max_frames_in_progress: int = None):
+        """
+        Initialization
+        :param face_swap_model: insightface INSwapper model
+        :param source_face: source face
+        :param batch_size: number of faces in one run of swap model
+        :param num_workers: number of threads for paste back, by default WUNJO_FACESWAP_WORKERS or cpu count
+        :param max_frames_in_progress: max number of frames in memory waiting paste back and write
+        """
+        self.model = face_swap_model
+        self.batch_size = max(1, batch_size)
+        if num_workers is None:
+            num_workers = int(os.environ.get('WUNJO_FACESWAP_WORKERS', min(os.cpu_count() or 1, 8)))
+        self.num_workers = max(1, num_workers)
+        self.max_frames_in_progress = max_frames_in_progress or self.batch_size * 2 + self.num_workers * 2
+        # model input can have fixed batch size 1
+        self.is_batch_model = not isinstance(self.model.input_shape[0], int) or self.model.input_shape[0] != 1
+        latent = source_face.normed_embedding.reshape((1, -1))
+        latent = np.dot(latent, self.model.emap)
+        self.latent = (latent / np.linalg.norm(latent)).astype(np.float32)
+
+    def run_model(self, aligned_faces: list):
+        """
+        Swap aligned faces
+        :param aligned_faces: list of aligned faces
+        :return: list of swapped faces
+        """
+        blob = cv2.dnn.blobFromImages(aligned_faces, 1.0 / self.model.input_std, self.model.input_size, (self.model.input_mean,) * 3, swapRB=True)
+        if self.is_batch_model:
+            latent = np.repeat(self.latent, len(aligned_faces), axis=0)
+            preds = self.model.session.run(self.model.output_names, {self.model.input_names[0]: blob, self.model.input_names[1]: latent})[0]
+        else:
+            preds = np.concatenate([
+                self.model.session.run(self.model.output_names, {self.model.input_names[0]: blob[i:i + 1], self.model.input_names[1]: self.latent})[0]
+                for i in range(len(aligned_faces))
+            ])
+        img_fakes = preds.transpose((0, 2, 3, 1))
+        return [np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, ::-1] for img_fake in img_fakes]
+
+    @staticmethod
+    def paste_back_frame(frame, swapped_faces: list):
+        for bgr_fake, aimg, M in swapped_faces:
+            frame = paste_back_face(frame, bgr_fake, aimg, M)
+        return frame
+
+    def swap_frames(self, frames, face_det_results: list):
+        """
+        Swap faces on frames
+        :param frames: iterable of frames
+        :param face_det_results: list of target faces for each frame
+        :return: generator of frames in the same order
+        """
+        in_progress = deque()  # futures or frames without faces in frame order
+        pending = []  # frames with aligned faces which wait run of model
+        num_pending_faces = 0
+
+        def run_pending():
+            aligned_faces = [aimg for _, crops in pending for aimg, _ in crops]
+            try:
+                swapped_faces = iter(self.run_model(aligned_faces))
+            except Exception as err:
+                # release paste back workers which wait these faces
+                for future, _ in pending:
+                    future.set_exception(err)
+                pending.clear()
+                raise
+            for future, crops in pending:
+                future.set_result([(next(swapped_faces), aimg, M) for aimg, M in crops])
+            pending.clear()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for frame, dets in zip(frames, face_det_results):
+                crops = [face_align.norm_crop2(frame, face.kps, self.model.input_size[0]) for face in dets if face is not None]
+                if not crops:
+                    in_progress.append(frame)
+                else:
+                    swapped_future = Future()
+                    pending.append((swapped_future, crops))
+                    num_pending_faces += len(crops)
+                    in_progress.append(executor.submit(lambda f, sf: self.paste_back_frame(f, sf.result()), frame, swapped_future))
+                    if num_pending_faces >= self.batch_size:
+                        run_pending()
+                        num_pending_faces = 0
+
+                while len(in_progress) >= self.max_frames_in_progress:
+                    # oldest frame can wait model, then run model for not full batch
+                    if isinstance(in_progress[0], Future) and pending:
+                        run_pending()
+                        num_pending_faces = 0
+                    item = in_progress.popleft()
+                    yield item.result() if isinstance(item, Future) else item
+
+            if pending:
+                run_pending()
+            while in_progress:
+                item = in_progress.popleft()
+                yield item.result() if isinstance(item, Future) else item
+
 
 class FaceSwapDeepfake:
     """
     Face swap by one photo
     """
-    def __init__(self, model_path, face_swap_model_path, similarface = False, similar_coeff=0.95, device="cpu"):
+    def __init__(self, model_path, face_swap_model_path, similarface = False, similar_coeff=0.95, device="cpu", cache_dir=None, keyframe_interval=1,
+                 batch_size=16, num_workers=None):
         """
         Initialization
         :param model_path: path to model deepfake where will be download face recognition
         :param face_swap_model_path: path to face swap model
+        :param cache_dir: directory to cache detected faces of video
+        :param keyframe_interval: detect faces each n frame and track faces between
+        :param batch_size: number of faces in one run of face swap model
+        :param num_workers: number of threads for paste back of faces
         """
         self.device = device
-        self.face_recognition = FaceRecognition(model_path)
+        self.face_recognition = FaceRecognition(model_path, cache_dir, keyframe_interval=keyframe_interval)
         self.access_providers = onnxruntime.get_available_providers()
         self.face_swap_model = self.load(face_swap_model_path)
         self.face_target_fields = None
         self.similarface = similarface
-        self.lock = threading.Lock()  # Create a lock
-        self.progress = 0  # Initialize a progress counter
+        self.batch_size = batch_size
+        self.num_workers = num_workers
         self.similar_coeff = similar_coeff
 
     def load(self, face_swap_model_path):
@@ -50,7 +198,11 @@ class FaceSwapDeepfake:
         else:
             provider = ["CPUExecutionProvider"]
 
-        return insightface.model_zoo.get_model(face_swap_model_path, providers=provider)
+        device = "cuda" if provider == ["CUDAExecutionProvider"] else "cpu"
+        return model_registry.get(
+            "inswapper", lambda: insightface.model_zoo.get_model(face_swap_model_path, providers=provider),
+            device, files=[face_swap_model_path]
+        )
 
     @staticmethod
     def get_real_crop_box(frame, squareFace):
@@ -114,24 +266,32 @@ class FaceSwapDeepfake:
             boxes[i] = np.mean(window, axis=0)
         return boxes
 
-    def face_detect_with_alignment_crop(self, image_files, face_fields):
+    def get_video_faces(self, frames):
+        """
+        Detect all faces in each frame, use cache if frames have cache key
+        :param frames: VideoReader, list of frames or list of file paths of images
+        :return: list of detected faces for each frame
+        """
+        return self.face_recognition.get_faces_video(
+            iter_frames(frames), total=len(frames), cache_key=getattr(frames, "cache_key", None), limit=getattr(frames, "limit", None)
+        )
+
+    def face_detect_with_alignment_crop(self, frames, face_fields):
         """
         Detect faces to swap if face_fields
-        :param image_files: list of file paths of target images
+        :param frames: VideoReader, list of frames or list of file paths of target images
         :param face_fields: crop target face
         :return:
         """
         predictions = []
-        face_embedding_list = []
+        face_embedding_list = FaceIdentityGallery()
         face_gender = None
 
         # Read the first image to get the center
-        first_image = cv2.imread(image_files[0])
+        first_image = next(iter_frames(frames))
         x_center, y_center = self.get_real_crop_box(first_image, face_fields)
 
-        for image_file in tqdm(image_files):
-            image = cv2.imread(image_file)
-            dets = self.face_recognition.get_faces(image)
+        for dets in self.get_video_faces(frames):
             if not dets:
                 predictions.append([None])
                 continue
@@ -141,27 +301,28 @@ class FaceSwapDeepfake:
                 x1, y1, x2, y2 = face.bbox
                 face_gender = face.gender  # face gender
                 predictions.append([face])  # prediction
-                face_embedding_list += [face.normed_embedding]
+                face_embedding_list.add(face.normed_embedding)
                 x_center = int((x1 + x2) / 2)  # set new center
                 y_center = int((y1 + y2) / 2)  # set new center
-            elif not face_embedding_list:  # not face yet, set new face
+            elif not len(face_embedding_list):  # not face yet, set new face
                 for face in dets:
                     x1, y1, x2, y2 = face.bbox
                     if x1 <= x_center <= x2 and y1 <= y_center <= y2:
                         face_gender = face.gender  # face gender
                         predictions.append([face])  # prediction
-                        face_embedding_list += [face.normed_embedding]
+                        face_embedding_list.add(face.normed_embedding)
                         x_center = int((x1 + x2) / 2)  # set new center
                         y_center = int((y1 + y2) / 2)  # set new center
                         break
             else:  # here is already recognition
                 local_face_param = []
-                for i, face in enumerate(dets):
+                # compare all faces of frame with gallery by one matrix product
+                similar_list = self.face_recognition.is_similar_faces([face.normed_embedding for face in dets], face_embedding_list, self.similar_coeff)
+                for i, (face, is_similar) in enumerate(zip(dets, similar_list)):
                     x1, y1, x2, y2 = face.bbox
                     x_center = int((x1 + x2) / 2)  # set new center
                     y_center = int((y1 + y2) / 2)  # set new center
                     normed_embedding = face.normed_embedding
-                    is_similar = self.face_recognition.is_similar_face(normed_embedding, face_embedding_list, self.similar_coeff)
                     if x1 <= x_center <= x2 and y1 <= y_center <= y2:
                         local_face_param += [{
                             "is_center": True, "is_gender": face_gender == face.gender, "is_embed": is_similar,
@@ -180,7 +341,7 @@ class FaceSwapDeepfake:
                         face_gender = param["gender"]  # face gender
                         # predictions.append([dets[param["id"]]])  # prediction
                         local_predictions.append(dets[param["id"]])
-                        face_embedding_list += [param["embed"]]
+                        face_embedding_list.add(param["embed"])
                         x_center = int((x1 + x2) / 2)  # set new center
                         y_center = int((y1 + y2) / 2)  # set new center
                         if not self.similarface:  # if user want to get only one face in frame
@@ -192,154 +353,67 @@ class FaceSwapDeepfake:
 
         return predictions
 
-    def face_detect_with_alignment_all(self, image_files):
+    def face_detect_with_alignment_all(self, frames):
         """
         Detect all faces in each image
-        :param image_files: list of file paths of images
+        :param frames: VideoReader, list of frames or list of file paths of images
         :return: list of detected faces for each image
         """
         predictions = []
-        for image_file in tqdm(image_files):
-            image = cv2.imread(image_file)
-            dets = self.face_recognition.get_faces(image)
+        for dets in self.get_video_faces(frames):
             if not dets:
                 predictions.append([None])
                 continue
             predictions.append(dets)
         return predictions
 
-    def process_frame(self, args):
-        frame, face_det_result, source_face, progress_bar, output_directory, idx = args
-        tmp_frame = frame.copy()
-        for face in face_det_result:
-            if face is None:
-                break
-            else:
-                tmp_frame = self.face_swap_model.get(tmp_frame, face, source_face, paste_back=True)
-        # Save the frame with zero-padded filename
-        filename = os.path.join(output_directory, f"frame_{idx:04d}.png")
-        cv2.imwrite(filename, tmp_frame)
-        with self.lock:
-            self.progress += 1
-            progress_bar.update(1)  # Update progress bar in a thread-safe manner
-        return filename
-
-    def swap_video(self, target_frames_path, source_face, target_face_fields, save_file: str, multiface=False, fps=30, video_format=".mp4"):
-        if "CUDAExecutionProvider" in self.access_providers and torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu'):
-            # thread will not work correct with GPU
-            return self.swap_video_cuda(target_frames_path, source_face, target_face_fields, save_file, multiface, fps, video_format)
-        else:
-            return self.swap_video_thread(target_frames_path, source_face, target_face_fields, save_file, multiface, fps,video_format)
-
-    def swap_video_thread(self, target_frames_path, source_face, target_face_fields, save_path: str, multiface=False, fps=30, video_format=".mp4"):
+    def swap_video(self, target_frames, source_face, target_face_fields, save_path: str, multiface=False, fps=30, video_format=".mp4", audio=None, audio_start=0, watermark=None):
         """
-        Face swap video with Threads. Will not work with CUDA
-        :param target_frames_path: directory containing target frames
+        Face swap video
+        :param target_frames: VideoReader or list of file paths of target frames
         :param source_face: source face
         :param target_face_fields: crop field for target face
-        :param save_file: save file path
+        :param save_path: save directory
         :param multiface: bool use swap all face or use target crop
         :param fps: video fps
         :param video_format: video format
-        :return:
+        :param audio: path to media which audio is muxed into result in the same pass
+        :param audio_start: start of audio in seconds, if target video was trimmed
+        :param watermark: Watermark stage applied to frames before encoder or None
+        :return: file name
         """
-        file_name = str(uuid.uuid4()) + '.mp4'
+        file_name = self.get_video_file_name(video_format)
         save_file = os.path.join(save_path, file_name)
-        frame_save_path = os.path.join(save_path, "faceswap_frames")
-        os.makedirs(frame_save_path, exist_ok=True)
-
-        # Get a list of all frame files in the target_frames_path directory
-        frame_files = sorted([os.path.join(target_frames_path, fname) for fname in os.listdir(target_frames_path) if fname.endswith('.jpg') or fname.endswith('.png')])
-
-        # Read the first frame to get the dimensions
-        first_frame = cv2.imread(frame_files[0])
-        frame_h, frame_w = first_frame.shape[:-1]
-
-        if video_format == '.mp4':
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        elif video_format == '.avi':
-            fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        else:
-            raise ValueError("Unsupported video format: {}".format(video_format))
-
-        out = cv2.VideoWriter(save_file, fourcc, fps, (frame_w, frame_h))
 
-        # Adjust the way we get face detection results
-        if multiface:
-            print("Getting all face...")
-            face_det_results = self.face_detect_with_alignment_all(frame_files)
-        else:
-            print("Getting target face...")
-            face_det_results = self.face_detect_with_alignment_crop(frame_files, target_face_fields)
+        face_det_results = self.get_face_det_results(target_frames, target_face_fields, multiface)
 
         print("Starting face swap...")
-
-        progress_bar = tqdm(total=len(frame_files), unit='it', unit_scale=True)
-
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            processed_frame_files = list(executor.map(self.process_frame, [
-                (cv2.imread(frame_files[i]), face_det_results[i], source_face, progress_bar, frame_save_path, i) for i
-                in range(len(frame_files))
-            ]))
-
-        progress_bar.close()
-
-        processed_frame_files.sort()  # Ensure files are in the correct order
-
-        for frame_file in processed_frame_files:
-            frame = cv2.imread(frame_file)
+        engine = FaceSwapEngine(self.face_swap_model, source_face, self.batch_size, self.num_workers)
+        out = None
+        for frame in tqdm(engine.swap_frames(iter_frames(target_frames), face_det_results), total=len(face_det_results), unit='it', unit_scale=True, desc="Swap faces"):
+            if out is None:
+                out = VideoWriter(save_file, fps, frame.shape[1], frame.shape[0], audio=audio, audio_start=audio_start, total=len(face_det_results), message="Face swap")
+            if watermark is not None:
+                watermark.apply(frame)
             out.write(frame)
-
-        out.release()
+        if out is not None:
+            out.release()
         print("Face swap processing finished...")
         return file_name
 
-    def swap_video_cuda(self, target_frames_path, source_face, target_face_fields, save_path: str, multiface=False, fps=30, video_format=".mp4"):
-        """Face swap video without Threads"""
-        file_name = str(uuid.uuid4()) + '.mp4'
-        save_file = os.path.join(save_path, file_name)
-
-        # Get a list of all frame files in the target_frames_path directory
-        frame_files = sorted([os.path.join(target_frames_path, fname) for fname in os.listdir(target_frames_path) if fname.endswith('.png')])
-        # Read the first frame to get the dimensions
-        first_frame = cv2.imread(frame_files[0])
-        frame_h, frame_w = first_frame.shape[:-1]
-
-        if video_format == '.mp4':
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        elif video_format == '.avi':
-            fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        else:
-            raise ValueError("Unsupported video format: {}".format(video_format))
-
-        out = cv2.VideoWriter(save_file, fourcc, fps, (frame_w, frame_h))
-
+    def get_face_det_results(self, target_frames, target_face_fields, multiface):
         # Adjust the way we get face detection results
         if multiface:
             print("Getting all face...")
-            face_det_results = self.face_detect_with_alignment_all(frame_files)
-        else:
-            print("Getting target face...")
-            face_det_results = self.face_detect_with_alignment_crop(frame_files, target_face_fields)
-
-        print("Starting face swap...")
-        progress_bar = tqdm(total=len(face_det_results), unit='it', unit_scale=True)
-        for i, dets in enumerate(face_det_results):
-            tmp_frame = cv2.imread(frame_files[i])
-            for face in dets:
-                if face is None:
-                    break
-                else:
-                    tmp_frame = self.face_swap_model.get(tmp_frame, face, source_face, paste_back=True)
-            out.write(tmp_frame)
-            progress_bar.update(1)
-        else:
-            out.release()
-            print("Face swap processing finished...")
-        progress_bar.close()
-
-        return file_name
+            return self.face_detect_with_alignment_all(target_frames)
+        print("Getting target face...")
+        return self.face_detect_with_alignment_crop(target_frames, target_face_fields)
 
+    @staticmethod
+    def get_video_file_name(video_format):
+        if video_format not in (".mp4", ".avi"):
+            raise ValueError("Unsupported video format: {}".format(video_format))
+        return str(uuid.uuid4()) + video_format
 
     def swap_image(self, target_frame, source_face, face_fields, save_dir: str, multiface=False):
         save_file = os.path.join(save_dir, "swapped_image.png")
@@ -3,10 +3,10 @@ import sys
 import cv2
 import torch
 import subprocess
-from basicsr.utils import img2tensor, tensor2img
+import numpy as np
+from contextlib import nullcontext
 from basicsr.utils.download_util import load_file_from_url
 from facexlib.utils.face_restoration_helper import FaceRestoreHelper
-from torchvision.transforms.functional import normalize
 
 from gfpgan.archs.gfpgan_bilinear_arch import GFPGANBilinear
 from gfpgan.archs.gfpganv1_arch import GFPGANv1
@@ -26,11 +26,16 @@ class GFPGANer():
         arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
         channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
         bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        half (bool): Whether to restore faces with fp16 autocast on cuda. Default: False.
+        channels_last (bool): Whether to use channels_last memory format. Default: False.
     """
 
-    def __init__(self, model_path, root_dir, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, device=None):
+    def __init__(self, model_path, root_dir, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, device=None,
+                 half=False, channels_last=False):
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
+        self.half = half and 'cuda' in str(device)
+        self.channels_last = channels_last
 
         # initialize model
         self.device = device
@@ -108,6 +113,8 @@ class GFPGANer():
         self.gfpgan.load_state_dict(loadnet[keyname], strict=True)
         self.gfpgan.eval()
         self.gfpgan = self.gfpgan.to(self.device)
+        if self.channels_last:
+            self.gfpgan = self.gfpgan.to(memory_format=torch.channels_last)
 
     @torch.no_grad()
     def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True, weight=0.5):
@@ -124,21 +131,7 @@ class GFPGANer():
             self.face_helper.align_warp_face()
 
         # face restoration
-        for cropped_face in self.face_helper.cropped_faces:
-            # prepare data
-            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(self.device)
-
-            try:
-                output = self.gfpgan(cropped_face_t, return_rgb=False, weight=weight)[0]
-                # convert to image
-                restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
-            except RuntimeError as error:
-                print(f'\tFailed inference for GFPGAN: {error}.')
-                restored_face = cropped_face
-
-            restored_face = restored_face.astype('uint8')
+        for restored_face in self.restore_faces(self.face_helper.cropped_faces, weight=weight):
             self.face_helper.add_restored_face(restored_face)
 
         if not has_aligned and paste_back:
@@ -155,3 +148,64 @@ class GFPGANer():
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
         else:
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
+
+    def detect_faces(self, img, only_center_face=False):
+        """
+        Detect and align faces of image
+        :param img: BGR image
+        :param only_center_face: only face in center
+        :return: aligned faces 512x512 and affine matrices to paste restored faces back
+        """
+        self.face_helper.clean_all()
+        self.face_helper.read_image(img)
+        self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+        self.face_helper.align_warp_face()
+        return self.face_helper.cropped_faces, self.face_helper.affine_matrices
+
+    @torch.no_grad()
+    def restore_faces(self, faces, weight=0.5, batch_size=8):
+        """
+        Restore aligned faces by batches, so faces of many frames are restored by one forward
+        :param faces: aligned BGR faces 512x512
+        :param weight: weight of restoration
+        :param batch_size: max faces in forward
+        :return: restored BGR faces
+        """
+        restored_faces = []
+        for i in range(0, len(faces), batch_size):
+            batch = np.stack(faces[i:i + batch_size])
+            try:
+                restored_faces += list(self._restore_batch(batch, weight))
+            except RuntimeError as error:
+                print(f'\tFailed inference for GFPGAN: {error}.')
+                restored_faces += list(batch)
+        return restored_faces
+
+    def _restore_batch(self, faces, weight):
+        # the same as img2tensor with normalize to [-1, 1], but for batch on device
+        faces_t = torch.from_numpy(faces).to(self.device).flip(-1).permute(0, 3, 1, 2).float().div_(127.5).sub_(1.)
+        if self.channels_last:
+            faces_t = faces_t.contiguous(memory_format=torch.channels_last)
+        with torch.autocast("cuda", dtype=torch.float16) if self.half else nullcontext():
+            output = self.gfpgan(faces_t, return_rgb=False, weight=weight)[0]
+        # the same as tensor2img with min_max (-1, 1) and rgb2bgr
+        output = output.float().clamp_(-1, 1).add_(1.).mul_(127.5).round_().flip(1).permute(0, 2, 3, 1)
+        return output.to(torch.uint8).cpu().numpy()
+
+    def paste_faces(self, img, affine_matrices, restored_faces):
+        """
+        Paste restored faces back to image
+        :param img: BGR image which was used in detect_faces
+        :param affine_matrices: affine matrices from detect_faces
+        :param restored_faces: restored faces in the same order as detected
+        :return: restored image
+        """
+        self.face_helper.clean_all()
+        self.face_helper.read_image(img)
+        self.face_helper.affine_matrices = affine_matrices
+        for restored_face in restored_faces:
+            self.face_helper.add_restored_face(restored_face)
+        # upsample the background
+        bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale)[0] if self.bg_upsampler is not None else None
+        self.face_helper.get_inverse_affine(None)
+        return self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
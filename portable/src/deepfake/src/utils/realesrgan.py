@@ -6,8 +6,10 @@ import numpy as np
 import os
 import queue
 import threading
+import time
 import torch
 import subprocess
+from contextlib import nullcontext, contextmanager
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
 
@@ -25,6 +27,9 @@ class RealESRGANer():
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        channels_last (bool): Whether to use channels_last memory format. Default: False.
+        precision (str): Precision on cpu, fp32 or bf16. Default: None is WUNJO_CPU_PRECISION or fp32.
+        threads (int): Number of torch threads on cpu. Default: None is WUNJO_TORCH_THREADS or cpu count.
     """
 
     def __init__(self,
@@ -38,13 +43,17 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 channels_last=False,
+                 precision=None,
+                 threads=None):
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
         self.pre_pad = pre_pad
         self.mod_scale = None
         self.half = half
+        self.channels_last = channels_last
 
         # initialize model
         if gpu_id:
@@ -99,8 +108,21 @@ class RealESRGANer():
 
         model.eval()
         self.model = model.to(self.device)
+        self.precision = "fp32"
+        self.tile_batch_size = None  # all tiles of batch in one forward
+        self.threads = None  # torch threads on cpu, set only during upscale because worker process runs other jobs
+        if torch.device(self.device).type == 'cpu':
+            # fp16 is slow on cpu, oneDNN kernels are fast with channels_last and bf16 if cpu supports it
+            self.half = False
+            self.channels_last = True
+            self.precision = precision or os.environ.get('WUNJO_CPU_PRECISION', 'fp32')
+            self.threads = threads or get_cpu_threads()
+            if self.tile_size > 0:
+                self.tile_size, self.tile_batch_size = get_cpu_tile(getattr(model, 'num_feat', 64), self.tile_pad)
         if self.half:
             self.model = self.model.half()
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
 
     def dni(self, net_a, net_b, dni_weight, key='params', loc='cpu'):
         """Deep network interpolation.
@@ -120,7 +142,12 @@ class RealESRGANer():
         self.img = img.unsqueeze(0).to(self.device)
         if self.half:
             self.img = self.img.half()
+        self.pad_input()
 
+    def pad_input(self):
+        """Pre-pad and mod pad of input batch self.img"""
+        if self.channels_last:
+            self.img = self.img.contiguous(memory_format=torch.channels_last)
         # pre_pad
         if self.pre_pad != 0:
             self.img = F.pad(self.img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
@@ -138,9 +165,13 @@ class RealESRGANer():
                 self.mod_pad_w = (self.mod_scale - w % self.mod_scale)
             self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
 
+    def forward(self, img):
+        with torch.autocast("cpu", dtype=torch.bfloat16) if self.precision == "bf16" else nullcontext():
+            return self.model(img)
+
     def process(self):
         # model inference
-        self.output = self.model(self.img)
+        self.output = self.forward(self.img)
 
     def tile_process(self):
         """It will first crop input images to tiles, and then process each tile.
@@ -179,16 +210,14 @@ class RealESRGANer():
                 # input tile dimensions
                 input_tile_width = input_end_x - input_start_x
                 input_tile_height = input_end_y - input_start_y
-                tile_idx = y * tiles_x + x + 1
                 input_tile = self.img[:, :, input_start_y_pad:input_end_y_pad, input_start_x_pad:input_end_x_pad]
 
-                # upscale tile
-                try:
-                    with torch.no_grad():
-                        output_tile = self.model(input_tile)
-                except RuntimeError as error:
-                    print('Error', error)
-                print(f'\tTile {tile_idx}/{tiles_x * tiles_y}')
+                # upscale tile, tile of all images in batch is upscaled by one forward, on cpu by batches in cache
+                with torch.no_grad():
+                    if self.tile_batch_size:
+                        output_tile = torch.cat([self.forward(tile) for tile in input_tile.split(self.tile_batch_size)])
+                    else:
+                        output_tile = self.forward(input_tile)
 
                 # output tile area on total image
                 output_start_x = input_start_x * self.scale
@@ -218,8 +247,12 @@ class RealESRGANer():
             self.output = self.output[:, :, 0:h - self.pre_pad * self.scale, 0:w - self.pre_pad * self.scale]
         return self.output
 
-    @torch.no_grad()
     def enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
+        with cpu_threads(self.threads):
+            return self._enhance(img, outscale, alpha_upsampler)
+
+    @torch.no_grad()
+    def _enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
         h_input, w_input = img.shape[0:2]
         # img: numpy
         img = img.astype(np.float32)
@@ -291,6 +324,124 @@ class RealESRGANer():
         return output, img_mode
 
 
+    def enhance_batch(self, imgs, outscale=None):
+        """
+        Upsample BGR uint8 images of the same size together, the same as enhance for each image
+        :param imgs: list of images
+        :param outscale: scale of result
+        :return: list of upsampled images
+        """
+        with cpu_threads(self.threads):
+            return self._enhance_batch(imgs, outscale)
+
+    @torch.no_grad()
+    def _enhance_batch(self, imgs, outscale=None):
+        h_input, w_input = imgs[0].shape[0:2]
+        # BGR uint8 to RGB float on device for all images by one copy
+        batch = torch.from_numpy(np.stack(imgs)).to(self.device)
+        self.img = batch.flip(-1).permute(0, 3, 1, 2).float().div_(255.)
+        if self.half:
+            self.img = self.img.half()
+        self.pad_input()
+        if self.tile_size > 0:
+            self.tile_process()
+        else:
+            self.process()
+        output = self.post_process()
+        output = output.float().clamp_(0, 1).mul_(255.).round_().flip(1).permute(0, 2, 3, 1)
+        outputs = list(output.to(torch.uint8).cpu().numpy())
+
+        if outscale is not None and outscale != float(self.scale):
+            size = (int(w_input * outscale), int(h_input * outscale))
+            outputs = [cv2.resize(output, size, interpolation=cv2.INTER_LANCZOS4) for output in outputs]
+        return outputs
+
+
+def get_cpu_threads() -> int:
+    """Number of torch threads on cpu from WUNJO_TORCH_THREADS, by default cpu count"""
+    return max(1, int(os.environ.get('WUNJO_TORCH_THREADS', os.cpu_count() or 1)))
+
+
+@contextmanager
+def cpu_threads(num_threads: int = None):
+    """Set number of torch threads inside block and restore previous number after it, None to keep number"""
+    if not num_threads:
+        yield
+        return
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous_threads)
+
+
+def get_cpu_cache_size() -> int:
+    """Size of last level cache of cpu in bytes, 8 Mb if it is unknown"""
+    for name in ("SC_LEVEL3_CACHE_SIZE", "SC_LEVEL2_CACHE_SIZE"):
+        try:
+            size = os.sysconf(name)
+        except (AttributeError, ValueError, OSError):
+            continue
+        if size and size > 0:
+            return size
+    return 8 * 1024 ** 2
+
+
+def get_cpu_tile(num_feat=64, tile_pad=10, min_tile=64, max_tile=400):
+    """
+    Tile size and number of tiles in one forward on cpu, input and output feature maps of conv have to be in cache
+    :param num_feat: channels of feature maps
+    :param tile_pad: pad of tile
+    :param min_tile: min tile size
+    :param max_tile: max tile size
+    :return: tile size, tiles in one forward
+    """
+    cache_size = get_cpu_cache_size()
+    bytes_per_pixel = 2 * num_feat * 4  # input and output feature maps in float32
+    tile = int(math.sqrt(cache_size / 2 / bytes_per_pixel)) // 16 * 16
+    tile = max(min_tile, min(max_tile, tile))
+    tile_batch_size = max(1, cache_size // (bytes_per_pixel * (tile + 2 * tile_pad) ** 2))
+    return tile, tile_batch_size
+
+
+def benchmark_cpu(frames=8, width=480, height=270, num_conv=16, threads=None, precision="fp32"):
+    """
+    Frames per second of RealESRGAN upscale on cpu for each number of threads, model has random weights
+    :param frames: number of frames
+    :param width: frame width
+    :param height: frame height
+    :param num_conv: 16 for realesr-animevideov3 and 32 for realesr-general-x4v3
+    :param threads: list of threads, by default powers of two up to cpu count
+    :param precision: fp32 or bf16
+    :return: dict of threads and frames per second
+    """
+    import tempfile
+    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+    cpu_count = os.cpu_count() or 1
+    threads = threads or sorted({2 ** i for i in range(int(math.log2(cpu_count)) + 1)} | {cpu_count})
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=num_conv, upscale=4, act_type='prelu')
+    images = [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(frames)]
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = os.path.join(tmp_dir, "model.pth")
+        torch.save({"params": model.state_dict()}, model_path)
+        for num_threads in threads:
+            upsampler = RealESRGANer(
+                scale=4, model_path=model_path, root_dir=tmp_dir, model=model, tile=400, tile_pad=10, pre_pad=0,
+                device="cpu", precision=precision, threads=num_threads
+            )
+            upsampler.enhance_batch(images[:1])  # warm up
+            start = time.time()
+            for image in images:
+                upsampler.enhance_batch([image])
+            result[num_threads] = frames / (time.time() - start)
+            print(f"RealESRGAN {width}x{height} {precision} on {num_threads} threads: {result[num_threads]:.2f} frames/s, "
+                  f"{result[num_threads] / num_threads:.3f} frames/s per thread, tile {upsampler.tile_size}")
+    return result
+
+
 class PrefetchReader(threading.Thread):
     """Prefetch images.
 
@@ -339,3 +490,8 @@ class IOConsumer(threading.Thread):
             save_path = msg['save_path']
             cv2.imwrite(save_path, output)
         print(f'IO worker {self.qid} is done.')
+
+
+if __name__ == "__main__":
+    # python -m deepfake.src.utils.realesrgan
+    benchmark_cpu()
@@ -1,12 +1,72 @@
 import os
 import sys
 import cv2
+import torch
 import random
+import hashlib
+import threading
 import numpy as np
 import onnxruntime
 from PIL import Image
+from functools import lru_cache
+from collections import OrderedDict
 
 from deepfake.src.segment_anything import sam_model_registry, SamPredictor
+from backend.model_registry import get_free_memory
+
+
+@lru_cache(maxsize=32)
+def _get_file_hash(path: str, size: int, mtime: int) -> str:
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_file_hash(path: str) -> str:
+    """
+    Hash of file content, file is read again only if size or modification time is changed
+    :param path: path to file
+    :return: sha1 hex
+    """
+    stat = os.stat(path)
+    return _get_file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class EmbeddingCache:
+    """
+    Image embeddings of SAM encoder keyed by (source hash, frame index, model type).
+    Entry keeps low res logits of last prompt for each object, so next click on the same frame
+    runs only ONNX decoder with previous mask as mask input.
+    """
+    def __init__(self, max_items: int = 8):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                self.items.move_to_end(key)
+            return entry
+
+    def put(self, key, embedding: np.ndarray, image_size: tuple) -> dict:
+        entry = {"embedding": embedding, "image_size": image_size, "logits": {}}
+        with self.lock:
+            self.items[key] = entry
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+embedding_cache = EmbeddingCache()
 
 
 class SegmentAnything:
@@ -43,6 +103,36 @@ class SegmentAnything:
         predictor.set_image(img)
         return predictor.get_image_embedding().cpu().numpy()
 
+    @staticmethod
+    def get_embeddings(predictor, frames: list) -> list:
+        """
+        Image embeddings of frames with the same size by one forward of image encoder
+        :param predictor: SamPredictor
+        :param frames: frames in the same format as for set_image
+        :return: list of embeddings (1, C, H, W)
+        """
+        inputs = [torch.as_tensor(predictor.transform.apply_image(frame), device=predictor.device).permute(2, 0, 1) for frame in frames]
+        with torch.no_grad():
+            features = predictor.model.image_encoder(predictor.model.preprocess(torch.stack(inputs)))
+        features = features.cpu().numpy()
+        return [features[i:i + 1] for i in range(len(frames))]
+
+    @staticmethod
+    def get_encoder_batch_size(predictor, max_batch_size: int = 8, memory_fraction: float = 0.7) -> int:
+        """
+        Frames in one forward of image encoder by free memory, global attention map of each frame is the biggest tensor
+        :param predictor: SamPredictor
+        :param max_batch_size: max frames in batch
+        :param memory_fraction: part of free memory to use
+        :return: batch size
+        """
+        if predictor.device.type != "cuda":
+            return 1
+        encoder = predictor.model.image_encoder
+        tokens = (encoder.img_size // 16) ** 2
+        frame_memory = 2 * encoder.blocks[0].attn.num_heads * tokens ** 2 * 4 + 512 * 1024 ** 2
+        return int(max(1, min(max_batch_size, get_free_memory("cuda") * memory_fraction // frame_memory)))
+
     @staticmethod
     def read_image(img_path: str):
         image = cv2.imread(img_path)
@@ -50,8 +140,16 @@ class SegmentAnything:
 
 
     @staticmethod
-    def draw_mask(predictor, session, point_list, frame, box=None):
-        originalHeight, originalWidth, _ = frame.shape
+    def get_prompt(predictor, point_list, image_size, box=None):
+        """
+        Points and box in format of ONNX decoder
+        :param predictor: SamPredictor to transform coordinates
+        :param point_list: points from canvas
+        :param image_size: height and width of frame
+        :param box: box [x1, y1, x2, y2] or None
+        :return: point coords and point labels
+        """
+        originalHeight, originalWidth = image_size
 
         input_point = []
         input_label = []
@@ -92,32 +190,84 @@ class SegmentAnything:
             onnx_coord = np.concatenate([input_point, np.array([[0.0, 0.0]])], axis=0)[None, :, :]
             onnx_label = np.concatenate([input_label, np.array([-1])], axis=0)[None, :].astype(np.float32)
 
-        onnx_coord = predictor.transform.apply_coords(onnx_coord, frame.shape[:2]).astype(np.float32)
-
-        predictor.set_image(frame)
-        frame_embedding = predictor.get_image_embedding().cpu().numpy()
+        onnx_coord = predictor.transform.apply_coords(onnx_coord, image_size).astype(np.float32)
+        return onnx_coord, onnx_label
 
-        onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
-        onnx_has_mask_input = np.zeros(1, dtype=np.float32)
+    @staticmethod
+    def decode_mask(predictor, session, embedding, onnx_coord, onnx_label, image_size, mask_input=None):
+        """
+        Decode mask from image embedding by ONNX decoder, image encoder is not used
+        :param predictor: SamPredictor for mask threshold
+        :param session: ONNX session of decoder
+        :param embedding: image embedding
+        :param onnx_coord: point coords
+        :param onnx_label: point labels
+        :param image_size: height and width of frame
+        :param mask_input: low res logits of previous mask (1, 1, 256, 256) or None
+        :return: masks in format false true and low res logits
+        """
+        if mask_input is None:
+            onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
+            onnx_has_mask_input = np.zeros(1, dtype=np.float32)
+        else:
+            onnx_mask_input = mask_input.astype(np.float32)
+            onnx_has_mask_input = np.ones(1, dtype=np.float32)
 
         ort_inputs = {
-            "image_embeddings": frame_embedding,
+            "image_embeddings": embedding,
             "point_coords": onnx_coord,
             "point_labels": onnx_label,
             "mask_input": onnx_mask_input,
             "has_mask_input": onnx_has_mask_input,
-            "orig_im_size": np.array(frame.shape[:2], dtype=np.float32)
+            "orig_im_size": np.array(image_size, dtype=np.float32)
         }
 
-        masks, _, _ = session.run(None, ort_inputs)
+        masks, _, low_res_logits = session.run(None, ort_inputs)
         masks = masks > predictor.model.mask_threshold
-        # TODO if it will be very slow, I can optimize by keeping low_res_logits in self for each frame to nor repeat load
+        return masks, low_res_logits
+
+    @staticmethod
+    def draw_mask(predictor, session, point_list, frame, box=None, embedding=None):
+        onnx_coord, onnx_label = SegmentAnything.get_prompt(predictor, point_list, frame.shape[:2], box)
+        frame_embedding = SegmentAnything.get_embedding(predictor, frame) if embedding is None else embedding
+        masks, _ = SegmentAnything.decode_mask(predictor, session, frame_embedding, onnx_coord, onnx_label, frame.shape[:2])
         return masks
 
-    def draw_mask_frames(self, frame):
+    @staticmethod
+    def draw_mask_cached(predictor, session, point_list, cache_key, read_frame, obj_id=1):
+        """
+        Draw mask by clicks on frame, image embedding is computed only once for frame and model.
+        If new points only add clicks to previous points of object, previous low res logits are mask input.
+        :param predictor: SamPredictor
+        :param session: ONNX session of decoder
+        :param point_list: points from canvas
+        :param cache_key: (source hash, frame index, model type)
+        :param read_frame: function to read RGB frame, it is called only if embedding is not in cache
+        :param obj_id: object id of mask
+        :return: masks in format false true
+        """
+        entry = embedding_cache.get(cache_key)
+        if entry is None:
+            frame = read_frame()
+            entry = embedding_cache.put(cache_key, SegmentAnything.get_embedding(predictor, frame), frame.shape[:2])
+
+        points = [(point["x"], point["y"], point.get("color")) for point in point_list]
+        previous_points, previous_logits = entry["logits"].get(obj_id, ([], None))
+        if not (previous_points and points[:len(previous_points)] == previous_points):
+            previous_logits = None  # points are removed or moved, previous mask is not prompt
+
+        onnx_coord, onnx_label = SegmentAnything.get_prompt(predictor, point_list, entry["image_size"])
+        masks, low_res_logits = SegmentAnything.decode_mask(
+            predictor, session, entry["embedding"], onnx_coord, onnx_label, entry["image_size"], mask_input=previous_logits
+        )
+        entry["logits"][obj_id] = (points, low_res_logits)
+        return masks
+
+    def draw_mask_frames(self, frame, embedding=None):
         """
         Predict mask and move draw_obj for objid
         :param frame: frame
+        :param embedding: image embedding of frame, None to encode frame
         :return: list mask in format false true
         """
         originalHeight, originalWidth, _ = frame.shape
@@ -126,7 +276,7 @@ class SegmentAnything:
         cY_prev = self.draw_obj["cY"]
         prev_area = self.draw_obj["area"]
         prev_box = self.draw_obj["box"]
-        mask = self.draw_mask(predictor=self.predictor, session=self.session, point_list=point_list, frame=frame, box=prev_box)
+        mask = self.draw_mask(predictor=self.predictor, session=self.session, point_list=point_list, frame=frame, box=prev_box, embedding=embedding)
         centroid = self.compute_centroid(mask)
         if centroid is None:
             cX = cX_prev
@@ -214,8 +364,8 @@ class SegmentAnything:
                 max_bbox = [x, y, x + w, y + h]
         return np.array(max_bbox)
 
-    def set_obj(self, point_list, frame):
-        mask = self.draw_mask(predictor=self.predictor, session=self.session, point_list=point_list, frame=frame)
+    def set_obj(self, point_list, frame, embedding=None):
+        mask = self.draw_mask(predictor=self.predictor, session=self.session, point_list=point_list, frame=frame, embedding=embedding)
         centroid = self.compute_centroid(mask)
         if centroid is None:
             cX = 0
@@ -382,3 +532,50 @@ class SegmentAnything:
         # Return as RGBA with full opacity
         return tuple(rgb) + (255,)
 
+
+def segment_video(predictor, session, frame_files: list, read_frame, objects: dict, segment_percentage: float = 0.25, batch_size: int = None):
+    """
+    Track masks of all objects on video. Each frame is read and encoded by image encoder only once and frames
+    are encoded by batches, ONNX decoder runs for each object with its own prompt on the same embedding.
+    Object is not tracked after mask area changes more than segment percentage.
+    :param predictor: SamPredictor
+    :param session: ONNX session of decoder
+    :param frame_files: names of frames
+    :param read_frame: function to read frame by name
+    :param objects: dict of key to {"point_list": points, "start_frame": first index, "end_frame": index after last}
+    :param segment_percentage: max change of mask area between frames
+    :param batch_size: frames in one forward of encoder, None to choose by free memory
+    :return: generator of frame name, frame and dict of key to mask for frames with objects
+    """
+    trackers = {}
+    for key in objects.keys():
+        trackers[key] = SegmentAnything(segment_percentage)
+        trackers[key].load_models(predictor=predictor, session=session)
+    stopped = set()
+    batch_size = batch_size or SegmentAnything.get_encoder_batch_size(predictor)
+
+    def active_keys(i):
+        return [key for key, obj in objects.items() if obj["start_frame"] <= i < obj["end_frame"] and key not in stopped]
+
+    indexes = [i for i in range(len(frame_files)) if active_keys(i)]
+    for batch_start in range(0, len(indexes), batch_size):
+        # objects can be stopped in previous batch
+        batch_indexes = [i for i in indexes[batch_start: batch_start + batch_size] if active_keys(i)]
+        if not batch_indexes:
+            continue
+        frames = [read_frame(frame_files[i]) for i in batch_indexes]
+        embeddings = SegmentAnything.get_embeddings(predictor, frames)
+        for i, frame, embedding in zip(batch_indexes, frames, embeddings):
+            frame_masks = {}
+            for key in active_keys(i):
+                if i == objects[key]["start_frame"]:
+                    mask = trackers[key].set_obj(point_list=objects[key]["point_list"], frame=frame, embedding=embedding)
+                else:
+                    mask = trackers[key].draw_mask_frames(frame=frame, embedding=embedding)
+                if mask is None:
+                    print(key, "Encountered None mask. Breaking the loop.")
+                    stopped.add(key)
+                    continue
+                frame_masks[key] = mask
+            if frame_masks:
+                yield frame_files[i], frame, frame_masks
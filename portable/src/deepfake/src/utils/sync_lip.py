@@ -4,18 +4,26 @@ import torch
 import cv2
 import sys
 import os
+import time
+import queue
+import threading
+from contextlib import nullcontext
 
 
 root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.join(root_path, "deepfake"))
 from src.video2fake import Wav2Lip, Emo2Lip
-from src.face3d.recognition import FaceRecognition
+from src.face3d.recognition import FaceRecognition, FaceIdentityGallery
+from src.utils.videoio import VideoWriter, iter_frames, loop_frames
 sys.path.pop(0)
 
+from backend.model_registry import model_registry
+from backend.pipeline import StageCounter, put_until_stopped, run_stage
+
 
 class GenerateWave2Lip:
-    def __init__(self, model_path, emotion_label, similar_coeff=0.95):
-        self.face_recognition = FaceRecognition(model_path)
+    def __init__(self, model_path, emotion_label, similar_coeff=0.95, cache_dir=None, keyframe_interval=1):
+        self.face_recognition = FaceRecognition(model_path, cache_dir, keyframe_interval=keyframe_interval)
         self.face_fields = None
         self.emotion, self.use_emotion = (self.to_emotion_categorical(emotion_label), True) if emotion_label else (None, False)
         self.similar_coeff = 0.95  # Similarity coefficient for face
@@ -67,23 +75,25 @@ class GenerateWave2Lip:
             return int(center_x), int(center_y)
         return None, None
 
-    def face_detect_with_alignment_crop(self, image_files):
+    def face_detect_with_alignment_crop(self, frames):
         """
         Detect faces to swap if face_fields
-        :param image_files: list of file paths of target images
+        :param frames: VideoReader, list of frames or list of file paths of target images
         :return:
         """
         predictions = []
-        face_embedding_list = []
+        face_embedding_list = FaceIdentityGallery()
         face_gender = None
 
         # Read the first image to get the center
-        first_image = cv2.imread(image_files[0])
+        first_image = next(iter_frames(frames))
         x_center, y_center = self.get_real_crop_box(first_image)
 
-        for image_file in tqdm(image_files):
-            image = cv2.imread(image_file)
-            dets = self.face_recognition.get_faces(image)
+        # faces will be got from cache if frames have cache key and video was detected before
+        all_dets = self.face_recognition.get_faces_video(
+            iter_frames(frames), total=len(frames), cache_key=getattr(frames, "cache_key", None), limit=getattr(frames, "limit", None)
+        )
+        for dets in all_dets:
             if not dets:
                 predictions.append([None])
                 continue
@@ -93,27 +103,28 @@ class GenerateWave2Lip:
                 x1, y1, x2, y2 = face.bbox
                 face_gender = face.gender  # face gender
                 predictions.append([face])  # prediction
-                face_embedding_list += [face.normed_embedding]
+                face_embedding_list.add(face.normed_embedding)
                 x_center = int((x1 + x2) / 2)  # set new center
                 y_center = int((y1 + y2) / 2)  # set new center
-            elif not face_embedding_list:  # not face yet, set new face
+            elif not len(face_embedding_list):  # not face yet, set new face
                 for face in dets:
                     x1, y1, x2, y2 = face.bbox
                     if x1 <= x_center <= x2 and y1 <= y_center <= y2:
                         face_gender = face.gender  # face gender
                         predictions.append([face])  # prediction
-                        face_embedding_list += [face.normed_embedding]
+                        face_embedding_list.add(face.normed_embedding)
                         x_center = int((x1 + x2) / 2)  # set new center
                         y_center = int((y1 + y2) / 2)  # set new center
                         break
             else:  # here is already recognition
                 local_face_param = []
-                for i, face in enumerate(dets):
+                # compare all faces of frame with gallery by one matrix product
+                similar_list = self.face_recognition.is_similar_faces([face.normed_embedding for face in dets], face_embedding_list, self.similar_coeff)
+                for i, (face, is_similar) in enumerate(zip(dets, similar_list)):
                     x1, y1, x2, y2 = face.bbox
                     x_center = int((x1 + x2) / 2)  # set new center
                     y_center = int((y1 + y2) / 2)  # set new center
                     normed_embedding = face.normed_embedding
-                    is_similar = self.face_recognition.is_similar_face(normed_embedding, face_embedding_list, self.similar_coeff)
                     if x1 <= x_center <= x2 and y1 <= y_center <= y2:
                         local_face_param += [{
                             "is_center": True, "is_gender": face_gender == face.gender, "is_embed": is_similar,
@@ -131,7 +142,7 @@ class GenerateWave2Lip:
                         x1, y1, x2, y2 = param["bbox"]
                         face_gender = param["gender"]  # face gender
                         local_predictions.append(dets[param["id"]])
-                        face_embedding_list += [param["embed"]]
+                        face_embedding_list.add(param["embed"])
                         x_center = int((x1 + x2) / 2)  # set new center
                         y_center = int((y1 + y2) / 2)  # set new center
                         break
@@ -143,67 +154,155 @@ class GenerateWave2Lip:
         return predictions
 
 
-    def datagen(self, frame_files: list, mels: list, img_size: int, wav2lip_batch_size: int, pads: list =[0, 10, 0, 0]):
+    def datagen(self, frames, mels: list, img_size: int, wav2lip_batch_size: int, pads: list =[0, 10, 0, 0], queue_size: int = 2):
         """
         Generator function that processes frames and their corresponding mel spectrograms
-        for feeding into a Wav2Lip model.
-        :param frame_files: List of input path to images.
+        for feeding into a Wav2Lip model. Batches are assembled in background thread while model processes previous batch.
+        :param frames: VideoReader or list of input path to images.
         :param mels: List of mel spectrogram chunks corresponding to each frame.
         :param img_size: The target size to which detected faces will be resized.
         :param wav2lip_batch_size: Batch size for the Wav2Lip model.
         :param pads: Padding for the face bounding box.
-        :param nosmooth: Whether to apply a smoothing function to detected bounding boxes.
-        :yield: Batches of processed images, mel spectrograms, original frames, and face coordinates.
+        :param queue_size: Number of assembled batches waiting for model.
+        :yield: Batches of uint8 images (N, H, W, 6) and mel spectrograms (N, 1, 80, 16) as torch tensors,
+        original frames, face coordinates and release function. Tensors are views of reused buffers,
+        call release(copy_event) after copy of tensors, buffer is filled again only after copy_event is completed.
         """
+        if not len(mels):
+            return
+        if isinstance(frames, (list, tuple)):
+            # images are read once, not in each loop of frames
+            frames = list(iter_frames(frames))
+        face_det_results = self.face_detect_with_alignment_crop(frames)  # BGR2RGB for CNN face detection
+
+        batches = queue.Queue(maxsize=queue_size)
+        stop_event = threading.Event()
+        # buffer is filled again only after consumer releases it and non blocking copy from it to device is finished
+        free_buffers = queue.Queue()
+        for buffer in self.allocate_batch_buffers(queue_size + 2, wav2lip_batch_size, img_size, mels[0].shape):
+            free_buffers.put((buffer, None))
+        producer = threading.Thread(
+            target=self._assemble_batches, args=(frames, mels, face_det_results, img_size, free_buffers, batches, stop_event), daemon=True
+        )
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # generator can be closed before end
+            stop_event.set()
+            while producer.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
 
-        img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-        face_det_results = self.face_detect_with_alignment_crop(frame_files)  # BGR2RGB for CNN face detection
-
-        for i, m in enumerate(mels):
-            idx = i % len(frame_files)
-
-            frame_to_save = cv2.imread(frame_files[idx])
-            dets = face_det_results[idx]
-            coords = dets[0].get("bbox") if dets[0] is not None else (0, 0, 0, 0)
-            x1, y1, x2, y2 = map(int, coords)
-            x1 = max(x1, 0)
-            x2 = max(x2, 0)
-            y1 = max(y1, 0)
-            y2 = max(y2, 0)
-            if int(x2 - x1) == 0 and int(y2 - y1) == 0:
-                # if empty face add as face full frame
-                img_batch.append(cv2.resize(frame_to_save, (img_size, img_size)))
-            else:
-                face = frame_to_save[int(y1): int(y2), int(x1):int(x2)]
-                face = cv2.resize(face, (img_size, img_size))
-                img_batch.append(face)
-
-            mel_batch.append(m)
-            frame_batch.append(frame_to_save)
-            coords_batch.append((y1, y2, x1, x2))
-
-            if len(img_batch) >= wav2lip_batch_size:
-                img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-                img_masked = img_batch.copy()
-                img_masked[:, img_size // 2:] = 0
-
-                img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-                mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-                yield img_batch, mel_batch, frame_batch, coords_batch
-                img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-        if len(img_batch) > 0:
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, img_size // 2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-            yield img_batch, mel_batch, frame_batch, coords_batch
+    @staticmethod
+    def allocate_batch_buffers(count: int, batch_size: int, img_size: int, mel_shape: tuple):
+        """
+        Preallocated batches in pinned memory to copy them in GPU without blocking
+        :param count: number of buffers
+        :param batch_size: batch size
+        :param img_size: size of face
+        :param mel_shape: shape of mel chunk
+        :return: list of (images, mels) tensors
+        """
+        pin_memory = torch.cuda.is_available()
+        return [(
+            torch.empty((batch_size, img_size, img_size, 6), dtype=torch.uint8, pin_memory=pin_memory),
+            torch.empty((batch_size, 1, *mel_shape), dtype=torch.float32, pin_memory=pin_memory)
+        ) for _ in range(count)]
+
+    def _assemble_batches(self, frames, mels, face_det_results, img_size, free_buffers, batches, stop_event):
+        """Write face crops and mels in free buffers and put batches in queue"""
+        half = img_size // 2
+        is_cached = isinstance(frames, list)
+
+        def put(item):
+            # wait free place in queue, but check what consumer is not stopped
+            while not stop_event.is_set():
+                try:
+                    batches.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def take_buffer():
+            # wait buffer released by consumer, but check what consumer is not stopped
+            while not stop_event.is_set():
+                try:
+                    buffer, copy_event = free_buffers.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if copy_event is not None:
+                    copy_event.synchronize()  # non blocking copy of previous batch from buffer is finished
+                return buffer
+            return None
+
+        def release(buffer):
+            return lambda copy_event=None: free_buffers.put((buffer, copy_event))
+
+        try:
+            n = 0
+            frame_batch, coords_batch = [], []
+            buffer = take_buffer()
+            if buffer is None:
+                return
+            img_buffer, mel_buffer = buffer
+            img_array, mel_array = img_buffer.numpy(), mel_buffer.numpy()
+            # frames are decoded again in loop if audio is longer than video
+            for i, (m, frame_to_save) in enumerate(zip(mels, loop_frames(frames, len(mels)))):
+                if stop_event.is_set():
+                    return
+                if is_cached:
+                    frame_to_save = frame_to_save.copy()  # frame is changed by paste of mouth
+                idx = i % len(face_det_results)
+
+                dets = face_det_results[idx]
+                coords = dets[0].get("bbox") if dets[0] is not None else (0, 0, 0, 0)
+                x1, y1, x2, y2 = map(int, coords)
+                x1 = max(x1, 0)
+                x2 = max(x2, 0)
+                y1 = max(y1, 0)
+                y2 = max(y2, 0)
+                if int(x2 - x1) == 0 and int(y2 - y1) == 0:
+                    # if empty face add as face full frame
+                    face = cv2.resize(frame_to_save, (img_size, img_size))
+                else:
+                    face = cv2.resize(frame_to_save[y1:y2, x1:x2], (img_size, img_size))
+
+                # masked face with zero lower half and reference face are channels of one image
+                img_array[n, :half, :, :3] = face[:half]
+                img_array[n, half:, :, :3] = 0
+                img_array[n, :, :, 3:] = face
+                mel_array[n, 0] = m
+                frame_batch.append(frame_to_save)
+                coords_batch.append((y1, y2, x1, x2))
+                n += 1
+
+                if n == len(img_array):
+                    if not put((img_buffer, mel_buffer, frame_batch, coords_batch, release(buffer))):
+                        return
+                    buffer = take_buffer()
+                    if buffer is None:
+                        return
+                    img_buffer, mel_buffer = buffer
+                    img_array, mel_array = img_buffer.numpy(), mel_buffer.numpy()
+                    n = 0
+                    frame_batch, coords_batch = [], []
+
+            if n > 0:
+                put((img_buffer[:n], mel_buffer[:n], frame_batch, coords_batch, release(buffer)))
+        except Exception as err:
+            put(err)
+        finally:
+            put(None)
 
     def _load(self, checkpoint_path, device):
         """Load mode by torch"""
@@ -215,6 +314,16 @@ class GenerateWave2Lip:
 
 
     def load_model(self, path, device):
+        """Get model Wav2Lip from model registry, model is loaded only first time"""
+        model_name = "emo2lip" if self.use_emotion else "wav2lip"
+        return model_registry.get(model_name, lambda: self._load_model(path, device), device, files=[path])
+
+    def preload_model(self, path, device):
+        """Load model Wav2Lip in background while faces are detected"""
+        model_name = "emo2lip" if self.use_emotion else "wav2lip"
+        return model_registry.preload(model_name, lambda: self._load_model(path, device), device, files=[path])
+
+    def _load_model(self, path, device):
         """Load model Wav2Lip"""
         wav2lip = Emo2Lip() if self.use_emotion else Wav2Lip()
         print("Load checkpoint from: {}".format(path))
@@ -229,10 +338,11 @@ class GenerateWave2Lip:
 
 
     def generate_video_from_chunks(self, gen, mel_chunks, batch_size, wav2lip_checkpoint, device, save_dir, fps=30,
-                                   video_name_without_format='wav2lip_video',video_format='.mp4'):
+                                   video_name_without_format='wav2lip_video',video_format='.mp4', audio=None, queue_size=2):
         """
         Generate a video from audio and face frames using a trained Wav2Lip model.
-        :param gen: Generator that produces (img_batch, mel_batch, frames, coords).
+        Stages are run in parallel with bounded queues: batches from generator -> model inference -> paste mouth -> encoder.
+        :param gen: Generator that produces (img_batch, mel_batch, frames, coords, release).
         :param mel_chunks: List of mel spectrogram chunks.
         :param batch_size: Batch size for processing.
         :param wav2lip_checkpoint: Path to the Wav2Lip model checkpoint.
@@ -241,76 +351,158 @@ class GenerateWave2Lip:
         :param fps: Frames per second for the resulting video.
         :param video_name_without_format: Video name.
         :param video_format: Format of the video, '.mp4' or '.avi'.
+        :param audio: Path to audio which is muxed into video in the same pass.
+        :param queue_size: Number of batches waiting between stages.
         :return: path to generated video or None.
         """
         video_path = None
+        out = None
+        use_cuda = 'cuda' in str(device) and torch.cuda.is_available()
+        stream = torch.cuda.Stream() if use_cuda else None
         # in order to find strange coord for mouth
-        coords_mouth = []
-        len_coords_mouth = 3  # find mean center between num coords mouth
-        max_distance_mouth = 20
-
-        for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, total=int(np.ceil(float(len(mel_chunks)) / batch_size)))):
-
-            # Load model only once and set record for first frame
-            if i == 0:
-                model = self.load_model(wav2lip_checkpoint, device)
-                print("Model loaded")
-
-                frame_h, frame_w = frames[0].shape[:-1]
-
-                if video_format == '.mp4':
-                    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                elif video_format == '.avi':
-                    fourcc = cv2.VideoWriter_fourcc(*'XVID')
+        mouth_state = {"coords_mouth": []}
+
+        paste_queue, encode_queue = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+        stop_event = threading.Event()
+        errors = []
+        counters = {name: StageCounter(name) for name in ("assemble", "inference", "paste", "encode")}
+        workers = []
+
+        def paste(item):
+            pred, done_event, start_event, frames, coords = item
+            if done_event is not None:
+                done_event.synchronize()  # wait non blocking copy from device
+                counters["inference"].add(len(frames), start_event.elapsed_time(done_event) / 1000)
+            start = time.time()
+            result = self.paste_mouth(pred.numpy(), frames, coords, mouth_state)
+            counters["paste"].add(len(frames), time.time() - start)
+            return result
+
+        def encode(frames):
+            start = time.time()
+            for f in frames:
+                out.write(f)
+            counters["encode"].add(len(frames), time.time() - start)
+
+        try:
+            gen_iter = iter(tqdm(gen, total=int(np.ceil(float(len(mel_chunks)) / batch_size)), desc="Wav2Lip batches"))
+            i = 0
+            while not stop_event.is_set():
+                start = time.time()
+                batch = next(gen_iter, None)
+                if batch is None:
+                    break
+                img_batch, mel_batch, frames, coords, release = batch
+                counters["assemble"].add(len(frames), time.time() - start)
+
+                # Load model only once and set record for first frame
+                if i == 0:
+                    model = self.load_model(wav2lip_checkpoint, device)
+                    print("Model loaded")
+
+                    frame_h, frame_w = frames[0].shape[:-1]
+
+                    if video_format not in ('.mp4', '.avi'):
+                        raise ValueError("Unsupported video format: {}".format(video_format))
+
+                    video_path = os.path.join(save_dir, video_name_without_format + video_format)
+                    out = VideoWriter(video_path, fps, frame_w, frame_h, audio=audio, total=len(mel_chunks), message="Mouth animation")
+                    workers = [
+                        threading.Thread(target=run_stage, args=(paste, paste_queue, encode_queue, stop_event, errors), daemon=True),
+                        threading.Thread(target=run_stage, args=(encode, encode_queue, None, stop_event, errors), daemon=True)
+                    ]
+                    for worker in workers:
+                        worker.start()
+                i += 1
+
+                start = time.time()
+                with torch.cuda.stream(stream) if use_cuda else nullcontext():
+                    start_event = done_event = None
+                    if use_cuda:
+                        start_event = torch.cuda.Event(enable_timing=True)
+                        done_event = torch.cuda.Event(enable_timing=True)
+                        start_event.record(stream)
+                    # Prepare the batches for the model, uint8 images are normalized and transposed on device
+                    img_batch = img_batch.to(device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255.)
+                    mel_batch = mel_batch.to(device, non_blocking=True)
+                    if use_cuda:
+                        # pinned buffers are filled again by assemble thread only after this copy is finished
+                        copy_event = torch.cuda.Event()
+                        copy_event.record(stream)
+                        release(copy_event)
+
+                    # Predict lip sync
+                    with torch.no_grad():
+                        if self.use_emotion:
+                            emotion = self.emotion.unsqueeze(0).to(device).repeat(img_batch.shape[0], 1)
+                            pred = model(mel_batch, img_batch, emotion)
+                        else:
+                            pred = model(mel_batch, img_batch)
+                        # uint8 on device to copy less, paste stage waits the copy by event
+                        pred = pred.mul(255.).permute(0, 2, 3, 1).to(torch.uint8).to("cpu", non_blocking=use_cuda)
+                    if use_cuda:
+                        done_event.record(stream)
+                    else:
+                        release()  # model on cpu reads buffers synchronously
+                if not use_cuda:
+                    counters["inference"].add(len(frames), time.time() - start)
+                put_until_stopped(paste_queue, (pred, done_event, start_event, frames, coords), stop_event)
+        except BaseException:
+            stop_event.set()
+            raise
+        finally:
+            if hasattr(gen, "close"):
+                gen.close()  # stop assemble of batches
+            put_until_stopped(paste_queue, None, stop_event)
+            for worker in workers:
+                worker.join()
+            if out is not None:
+                if stop_event.is_set():
+                    out.abort()
                 else:
-                    raise ValueError("Unsupported video format: {}".format(video_format))
-
-                video_path = os.path.join(save_dir, video_name_without_format + video_format)
-                out = cv2.VideoWriter(video_path, fourcc, fps, (frame_w, frame_h))
+                    out.release()
 
-            # Prepare the batches for the model
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-
-            # Predict lip sync
-            with torch.no_grad():
-                if self.use_emotion:
-                    emotion = self.emotion.unsqueeze(0).to(device).repeat(img_batch.shape[0], 1)
-                    pred = model(mel_batch, img_batch, emotion)
-                else:
-                    pred = model(mel_batch, img_batch)
+        if errors:
+            raise errors[0]
+        print("Wav2Lip stages throughput: " + "; ".join(str(counter) for counter in counters.values()))
 
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+        return video_path
 
-            for p, f, c in zip(pred, frames, coords):
-                y1, y2, x1, x2 = c
-                if int(x2 - x1) == 0 and int(y2 - y1) == 0:
-                    # save clear frame
-                    out.write(f)
+    def paste_mouth(self, pred, frames, coords, mouth_state, len_coords_mouth=3, max_distance_mouth=20):
+        """
+        Paste generated mouth in frames
+        :param pred: uint8 generated faces (N, H, W, 3)
+        :param frames: original frames
+        :param coords: coords of faces
+        :param mouth_state: dict with last centers of mouth, it is changed between batches
+        :param len_coords_mouth: find mean center between num coords mouth
+        :param max_distance_mouth: max distance from previous centers to paste mouth
+        :return: frames
+        """
+        coords_mouth = mouth_state["coords_mouth"]
+        for p, f, c in zip(pred, frames, coords):
+            y1, y2, x1, x2 = c
+            if int(x2 - x1) == 0 and int(y2 - y1) == 0:
+                # save clear frame
+                continue
+            # save processed frame
+            center_current = np.array([(x1 + x2) / 2, (y1 + y2) / 2])  # Calculate the center of the current bounding box
+            p = cv2.resize(p, (int(x2 - x1), int(y2 - y1)))
+            # Check if the current bounding box is non-empty
+            if y1 != 0 and y2 != 1 and x1 != 0 and x2 != 1:
+                # If less than 5 coordinates are stored, add the new one
+                if len(coords_mouth) < len_coords_mouth:
+                    coords_mouth.append(center_current)
+                    f[y1:y2, x1:x2] = p
                 else:
-                    # save processed frame
-                    center_current = np.array([(x1 + x2) / 2, (y1 + y2) / 2])  # Calculate the center of the current bounding box
-                    p = cv2.resize(p.astype(np.uint8), (int(x2 - x1), int(y2 - y1)))
-                    # Check if the current bounding box is non-empty
-                    if y1 != 0 and y2 != 1 and x1 != 0 and x2 != 1:
-                        # If less than 5 coordinates are stored, add the new one
-                        if len(coords_mouth) < len_coords_mouth:
-                            coords_mouth.append(center_current)
-                            f[y1:y2, x1:x2] = p
-                        else:
-                            # Calculate distances between the current center and the centers stored in keep_coords
-                            distances = [self.face_recognition.calculate_distance(center_current, prev_center) for prev_center in coords_mouth]
-                            # If the current center is near any of the previous centers, update the frame
-                            # if any(distance < max_distance for distance in distances):
-                            if np.mean(distances) < max_distance_mouth:
-                                f[y1:y2, x1:x2] = p
-                            coords_mouth.pop(0)  # Remove the oldest center
-                            coords_mouth.append(center_current)  # Add the current center
-                    out.write(f)
-        else:
-            out.release()
-
-        return video_path
+                    # Calculate distances between the current center and the centers stored in keep_coords
+                    distances = [self.face_recognition.calculate_distance(center_current, prev_center) for prev_center in coords_mouth]
+                    # If the current center is near any of the previous centers, update the frame
+                    if np.mean(distances) < max_distance_mouth:
+                        f[y1:y2, x1:x2] = p
+                    coords_mouth.pop(0)  # Remove the oldest center
+                    coords_mouth.append(center_current)  # Add the current center
+        return frames
 
     @staticmethod
     def to_emotion_categorical(y, num_classes=6, dtype='float32'):
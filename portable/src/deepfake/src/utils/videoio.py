@@ -1,9 +1,8 @@
-import shutil
 import uuid
-import time
 
 import os
-import subprocess
+import queue
+import threading
 
 import cv2
 import random
@@ -11,6 +10,201 @@ from tqdm import tqdm
 import numpy as np
 from PIL import Image
 
+from backend.ffmpeg import VideoWriter, run_ffmpeg, probe_media, get_encoder_args
+
+
+class VideoReader:
+    """
+    Decode video frame by frame in background thread without saving frames on disk.
+    Decoded frames are kept in bounded queue, so memory does not depend on video length.
+    Reader can be iterated many times, each iteration decode video again from start.
+    """
+    def __init__(self, video: str, rotate: int = 0, crop: list = None, resize_factor: int = 1, limit: int = None, queue_size: int = 32, cache_key: str = None,
+                 start: float = 0, end: float = None):
+        """
+        Initialization
+        :param video: path to video
+        :param rotate: number of 90-degree rotations
+        :param crop: list with cropping coordinates [y1, y2, x1, x2]
+        :param resize_factor: factor by which the frame should be resized
+        :param limit: max number of frames
+        :param queue_size: max number of decoded frames waiting for processing
+        :param cache_key: key of video content to cache results of frames processing
+        :param start: start of trim in seconds
+        :param end: end of trim in seconds, None or end not greater than start is end of video
+        """
+        self.video = video
+        self.cache_key = cache_key
+        self.rotate = rotate
+        self.crop = crop
+        self.resize_factor = resize_factor
+        self.queue_size = queue_size
+
+        video_stream = cv2.VideoCapture(video)
+        self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+        self.start_frame, end_frame = get_trim_frames(video_stream, start, end)
+        video_stream.release()
+        self.start_time = self.start_frame / self.fps if self.fps else 0
+        self.frame_count = end_frame - self.start_frame
+        if limit is not None:
+            self.frame_count = min(self.frame_count, limit)
+        self.limit = self.frame_count
+
+    def __len__(self):
+        return self.frame_count
+
+    def _decode(self, frames_queue, stop_event):
+        video_stream = cv2.VideoCapture(self.video)
+        count = 0
+        try:
+            seek_frame(video_stream, self.start_frame)
+            while not stop_event.is_set():
+                if count >= self.limit:
+                    break
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                frame = transform_frame(frame, self.rotate, self.crop, self.resize_factor)
+                # wait free place in queue, but check what consumer is not stopped
+                while not stop_event.is_set():
+                    try:
+                        frames_queue.put(frame, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                count += 1
+        except Exception as err:
+            frames_queue.put(err)
+        finally:
+            video_stream.release()
+            frames_queue.put(None)
+
+    def __iter__(self):
+        frames_queue = queue.Queue(maxsize=self.queue_size)
+        stop_event = threading.Event()
+        decoder = threading.Thread(target=self._decode, args=(frames_queue, stop_event), daemon=True)
+        decoder.start()
+        try:
+            while True:
+                frame = frames_queue.get()
+                if frame is None:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        finally:
+            # generator can be closed before end of video
+            stop_event.set()
+            while decoder.is_alive():
+                try:
+                    frames_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+def iter_frames(frames):
+    """
+    Iterate frames from VideoReader, list of frames or list of image paths
+    :param frames: frames source
+    :return: generator of frames
+    """
+    for frame in frames:
+        yield cv2.imread(frame) if isinstance(frame, str) else frame
+
+
+def loop_frames(frames, count: int):
+    """
+    Iterate frames in loop from start, if count is more than number of frames
+    :param frames: frames source which can be iterated many times
+    :param count: number of frames to get
+    :return: generator of frames
+    """
+    i = 0
+    while i < count:
+        is_empty = True
+        for frame in iter_frames(frames):
+            is_empty = False
+            yield frame
+            i += 1
+            if i >= count:
+                return
+        if is_empty:
+            return
+
+
+def trim_range(start: float = 0, end: float = None) -> tuple:
+    """
+    Trim range in seconds, end not greater than start means video without trim
+    :param start: start in seconds
+    :param end: end in seconds or None
+    :return: start and end, end is None for end of video
+    """
+    start = float(start or 0)
+    if end is not None and float(end) <= start:
+        return 0, None
+    return start, None if end is None else float(end)
+
+
+def get_trim_frames(video_stream, start: float = 0, end: float = None) -> tuple:
+    """
+    Frame range of trim in seconds
+    :param video_stream: cv2.VideoCapture
+    :param start: start in seconds
+    :param end: end in seconds or None
+    :return: first frame and frame after last
+    """
+    fps = video_stream.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+    start, end = trim_range(start, end)
+    if not fps:
+        return 0, frame_count
+    start_frame = min(int(round(start * fps)), frame_count)
+    end_frame = frame_count if end is None else min(int(round(end * fps)), frame_count)
+    return start_frame, max(end_frame, start_frame)
+
+
+def seek_frame(video_stream, frame_number: int):
+    """
+    Seek to exact frame without intermediate file.
+    Decoder seeks to nearest keyframe before frame and decodes frames up to it,
+    if container can not be seeked, frames are grabbed and dropped from start without decode of image.
+    :param video_stream: cv2.VideoCapture
+    :param frame_number: frame which will be read next
+    :return: None
+    """
+    if frame_number <= 0:
+        return
+    if video_stream.set(cv2.CAP_PROP_POS_FRAMES, frame_number) and int(video_stream.get(cv2.CAP_PROP_POS_FRAMES)) == frame_number:
+        return
+    video_stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for _ in range(frame_number):
+        if not video_stream.grab():
+            break
+
+
+def transform_frame(frame, rotate: int = 0, crop: list = None, resize_factor: int = 1):
+    """
+    Apply resizing, rotation, and cropping for frame
+    :param frame: frame
+    :param rotate: number of 90-degree rotations
+    :param crop: list with cropping coordinates [y1, y2, x1, x2]
+    :param resize_factor: factor by which the frame should be resized
+    :return: frame
+    """
+    if resize_factor > 1:
+        frame = cv2.resize(frame, (int(frame.shape[1] // resize_factor), int(frame.shape[0] // resize_factor)))
+
+    for _ in range(rotate):
+        frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+
+    if crop is not None:
+        y1, y2, x1, x2 = crop
+        x2 = x2 if x2 != -1 else frame.shape[1]
+        y2 = y2 if y2 != -1 else frame.shape[0]
+        frame = frame[y1:y2, x1:x2]
+
+    return frame
+
 
 def load_video_to_cv2(input_path):
     video_stream = cv2.VideoCapture(input_path)
@@ -25,60 +219,71 @@ def load_video_to_cv2(input_path):
     return full_frames
 
 
-def save_video_with_audio(video, audio, save_path):
+def save_video_with_audio(video, audio, save_path, audio_start=0):
+    """
+    Mux audio into video. Video encoded in h264 already is copied without second encode.
+    :param video: path to video
+    :param audio: path to audio or media with audio
+    :param save_path: save directory
+    :param audio_start: start of audio in seconds, if video was trimmed
+    :return: file name
+    """
     file_name = str(uuid.uuid4()) + '.mp4'
     save_file = os.path.join(save_path, file_name)
-    if os.path.exists(audio):
+    info = probe_media(video)
+    if info["video_codec"] == "h264":
+        video_args = ["-c:v", "copy"]
+    else:
+        video_args = ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"] + get_encoder_args()
+    if audio is not None and os.path.isfile(audio):
         # If there is an audio file, include it in the ffmpeg command
-        cmd = r'ffmpeg -y -i "%s" -i "%s" -c:v libx264 -c:a aac -crf 23 -preset medium -movflags +faststart -shortest "%s"' % (video, audio, save_file)
+        cmd = ["-i", video, "-ss", audio_start, "-i", audio, "-map", "0:v", "-map", "1:a?"] + video_args + ["-c:a", "aac", "-shortest"]
     else:
         # If there is no audio file, omit the audio input and codec options
-        cmd = r'ffmpeg -y -i "%s" -c:v libx264 -crf 23 -preset medium -movflags +faststart "%s"' % (video, save_file)
-    if os.environ.get('DEBUG', 'False') == 'True':
-        # not silence run
-        os.system(cmd)
-    else:
-        # silence run
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cmd = ["-i", video] + video_args
+    run_ffmpeg(cmd + ["-movflags", "+faststart", save_file], duration=info["duration"], message="Save video")
     return file_name
 
 
-def save_video_from_frames(frame_names, save_path, fps, alternative_save_path=None):
-    # frames has to have name from 0
+def save_video_from_frames(frame_names, save_path, fps, alternative_save_path=None, audio=None, audio_start=0):
+    """
+    Encode image sequence to video
+    :param frame_names: pattern of frame names, frames has to have name from 0
+    :param save_path: directory of frames
+    :param fps: frames per second
+    :param alternative_save_path: directory of result, by default directory of frames
+    :param audio: path to audio or media which audio will be muxed in the same pass
+    :param audio_start: start of audio in seconds, if video was trimmed
+    :return: file name
+    """
     frame_path = os.path.join(save_path, frame_names)
     file_name = str(uuid.uuid4())+'.mp4'
     if alternative_save_path:
         save_file = os.path.join(alternative_save_path, file_name)
     else:
         save_file = os.path.join(save_path, file_name)
-    cmd = f'ffmpeg -framerate {fps} -i {frame_path} -c:v libx264 -vf "pad=ceil(iw/2)*2:ceil(ih/2)*2" -pix_fmt yuv420p {save_file}'
-    if os.environ.get('DEBUG', 'False') == 'True':
-        # not silence run
-        os.system(cmd)
-    else:
-        # silence run
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cmd = ["-framerate", fps, "-i", frame_path]
+    if audio is not None and os.path.isfile(audio):
+        cmd += ["-ss", audio_start, "-i", audio, "-map", "0:v", "-map", "1:a?", "-c:a", "aac", "-shortest"]
+    cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"] + get_encoder_args()
+    run_ffmpeg(cmd + ["-movflags", "+faststart", save_file], message="Save video")
     return file_name
 
 
 def video_to_frames(video_path, output_folder, start_seconds=0, end_seconds=None, extract_nth_frame=1, reduce_size=1):
-    start_hms = seconds_to_hms(start_seconds)
+    start_seconds, end_seconds = trim_range(start_seconds, end_seconds)
+    # input seek is frame accurate as frames are decoded, timestamps start from zero after seek
+    cmd = ["-ss", seconds_to_hms(start_seconds)]
     if end_seconds is not None:
-        select_cmd = f"select=between(t\\,{start_seconds}\\,{end_seconds})*not(mod(n\\,{extract_nth_frame}))"
-    else:
-        select_cmd = f"select=not(mod(n\\,{extract_nth_frame}))"
+        cmd += ["-t", end_seconds - start_seconds]
+    select_cmd = f"select=not(mod(n\\,{extract_nth_frame}))"
     # Add the scale filter to reduce frame size by a factor
     vf_cmd = f"{select_cmd},scale=iw/{int(reduce_size)}:ih/{int(reduce_size)}" if reduce_size > 1 else select_cmd
-    cmd = f'ffmpeg -ss {start_hms} -i "{video_path}" -vf "{vf_cmd}" -vsync vfr "{output_folder}/%d.png"'
-    if os.environ.get('DEBUG', 'False') == 'True':
-        # not silence run
-        os.system(cmd)
-    else:
-        # silence run
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cmd += ["-i", video_path, "-vf", vf_cmd, "-vsync", "vfr", os.path.join(output_folder, "%d.png")]
+    run_ffmpeg(cmd, message="Extract frames")
 
 
-def extract_audio_from_video(video_path, save_path):
+def extract_audio_from_video(video_path, save_path, start=0, end=None):
     # Check if the file is a GIF
     try:
         with Image.open(video_path) as img:
@@ -91,13 +296,10 @@ def extract_audio_from_video(video_path, save_path):
     # If not a GIF, proceed with audio extraction
     file_name = str(uuid.uuid4()) + '.wav'
     save_file = os.path.join(save_path, file_name)
-    cmd = f'ffmpeg -i "{video_path}" -q:a 0 -map a? "{save_file}" -y'
-    if os.environ.get('DEBUG', 'False') == 'True':
-        # not silence run
-        os.system(cmd)
-    else:
-        # silence run
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start, end = trim_range(start, end)
+    cmd = ["-ss", start] if end is None else ["-ss", start, "-t", end - start]
+    # video without audio stream has not output, in this case file is not created
+    run_ffmpeg(cmd + ["-i", video_path, "-map", "a?", save_file], message="Extract audio", check=False)
     return file_name
 
 
@@ -107,24 +309,6 @@ def seconds_to_hms(seconds):
     return "{:02}:{:02}:{:02}.{:03}".format(int(hours), int(minutes), int(seconds), int((seconds % 1) * 1000))
 
 
-def cut_start_video(video, video_start, video_end):
-    if video_start == video_end:
-        return video
-    time.sleep(5)
-    hms_start_format = seconds_to_hms(video_start)
-    hms_end_format = seconds_to_hms(video_end)
-    print(f"Video will start from {hms_start_format} and end at {hms_end_format}")
-    new_video = f"{video}_cut.mp4"
-    cmd = f"ffmpeg -y -ss {hms_start_format} -to {hms_end_format} -i {video} -c copy {new_video}"
-    if os.environ.get('DEBUG', 'False') == 'True':
-        # not silence run
-        os.system(cmd)
-    else:
-        # silence run
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return new_video
-
-
 def check_media_type(file_path):
     # Initialize a VideoCapture object
     cap = cv2.VideoCapture(file_path)
@@ -175,7 +359,7 @@ def get_first_frame(file_path, source_current_time: float = 0):
     return None
 
 
-def save_frames(video: str, output_dir: str, rotate: int, crop: list, resize_factor: int):
+def save_frames(video: str, output_dir: str, rotate: int, crop: list, resize_factor: int, start: float = 0, end: float = None):
     """
     Extract frames from a video, apply resizing, rotation, and cropping, and save them to an output directory.
 
@@ -184,6 +368,8 @@ def save_frames(video: str, output_dir: str, rotate: int, crop: list, resize_fac
     :param rotate: number of 90-degree rotations
     :param crop: list with cropping coordinates [y1, y2, x1, x2]
     :param resize_factor: factor by which the frame should be resized
+    :param start: start of trim in seconds
+    :param end: end of trim in seconds
     :return: fps of the video, path to the directory containing frames
     """
     print("Start reading video")
@@ -191,195 +377,60 @@ def save_frames(video: str, output_dir: str, rotate: int, crop: list, resize_fac
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    video_stream = cv2.VideoCapture(video)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
+    reader = VideoReader(video, rotate=rotate, crop=crop, resize_factor=resize_factor, start=start, end=end)
     frame_count = 0
-
-    try:
-        while True:
-            still_reading, frame = video_stream.read()
-
-            if not still_reading:
-                break
-
-            if resize_factor > 1:
-                frame = cv2.resize(frame, (int(frame.shape[1] // resize_factor), int(frame.shape[0] // resize_factor)))
-
-            for _ in range(rotate):
-                frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
-
-            y1, y2, x1, x2 = crop
-            x2 = x2 if x2 != -1 else frame.shape[1]
-            y2 = y2 if y2 != -1 else frame.shape[0]
-
-            frame = frame[y1:y2, x1:x2]
-
-            # Save the frame to the output directory
-            frame_filename = os.path.join(output_dir, f'frame{frame_count:04}.png')
-            cv2.imwrite(frame_filename, frame)
-
-            frame_count += 1
-
-    finally:
-        video_stream.release()
+    for frame in reader:
+        # Save the frame to the output directory
+        frame_filename = os.path.join(output_dir, f'frame{frame_count:04}.png')
+        cv2.imwrite(frame_filename, frame)
+        frame_count += 1
 
     print(f"Number of frames saved: {frame_count}")
 
-    return fps, output_dir
-
-
-
-def encrypted(video_path: str, save_dir: str, fn: int = 0):
-
-    name = str(os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
-    media_type = check_media_type(video_path)
-
-    if media_type == "animated":
-        # Video objects for src
-        src = cv2.VideoCapture(video_path)
-        src_w = int(src.get(3))
-        src_h = int(src.get(4))
-        src_fps = src.get(cv2.CAP_PROP_FPS)
-        src_frame_cnt = src.get(cv2.CAP_PROP_FRAME_COUNT)
-
-        # Load a dummy image to get the shape attributes
-        sec_frame_original = np.zeros((src_h, src_w, 3), dtype=np.uint8)
-
-        if not os.path.exists(os.path.join(save_dir, 'enc')):
-            os.mkdir(os.path.join(save_dir, 'enc'))
-
-        # Create a progress bar
-        pbar = tqdm(total=int(src_frame_cnt), unit='frames')
-
-        while True:
-            ret, src_frame = src.read()
-
-            if ret == False:
-                break
-
-            # Create a copy of the dummy frame
-            sec_frame = sec_frame_original.copy()
-
-            # Put the text onto the dummy frame
-            font_scale = int(max(src_w, src_h) // 600)
-            font_thickness = int(font_scale // 0.5)
-
-            # Define text position
-            text_x = src_w // 4
-            text_y = src_h // 2
-
-            # Get the region where the text will be placed
-            text_size = cv2.getTextSize(name, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)[0]
-            region = src_frame[text_y - text_size[1]:text_y, text_x:text_x + text_size[0]]
-
-            # Compute the mean color of the region
-            mean_color = cv2.mean(region)[:3]
-
-            # Compute the contrasting color
-            contrast_color = tuple([255 - int(x) for x in mean_color])
-
-            # Adjusting the coordinates to correctly position the text
-            height, width = src_frame.shape[:2]
-
-            # Get the size of the text
-            (text_width, text_height), baseline = cv2.getTextSize(name, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)
-
-            # Center positions
-            center_x = width // 2
-            center_y = height // 2
-
-            # Define potential positions with padding along the edges (adjust as necessary)
-            positions = [
-                (0, text_height),
-                (0, center_y + text_height // 2),
-                (center_x - text_width // 2, text_height),
-                (width - text_width, text_height),
-                (0, height - baseline),
-                (width - text_width, height - baseline),
-                (center_x - text_width // 2, height - baseline),
-                (width - text_width, center_y + text_height // 2),
-                (int(width * 0.25) - text_width // 2, text_height),
-                (int(width * 0.75) - text_width // 2, text_height),
-                (int(width * 0.25) - text_width // 2, height - baseline),
-                (int(width * 0.75) - text_width // 2, height - baseline),
-                None, None, None
-            ]
-
-            # In each call to the method, select one random positions from the list
-            selected_positions = random.sample(positions, 1)
-
-            # Put text at the selected positions
-            for pos in selected_positions:
-                if pos is not None:
-                    cv2.putText(sec_frame, name, pos, cv2.FONT_HERSHEY_SIMPLEX, font_scale, contrast_color, font_thickness, cv2.LINE_AA)
-
-            # Encryption for LSB 3 bits
-            encrypted_img = (src_frame & 0b11111000) | (sec_frame >> 6 & 0b00000111)
-
-            fn = fn + 1
-            cv2.imwrite(os.path.join(save_dir, "enc", "{}.png".format(fn)), encrypted_img)
-
-            pbar.update(1)
-
-        pbar.close()
-        src.release()
-
-        # Delete encrypted video if already exists
-        file_name = str(uuid.uuid4())+'.mp4'
-        file_path = os.path.join(save_dir, file_name)
-
-        # Save the video using ffmpeg as a lossless video; frame rate is kept the same
-        cmd = f"ffmpeg -framerate {src_fps} -i {os.path.join(save_dir, 'enc', '%d.png')} -c:v copy {file_path}"
-        if os.environ.get('DEBUG', 'False') == 'True':
-            # not silence run
-            os.system(cmd)
-        else:
-            # silence run
-            subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        # Delete the temporary image sequence folder
-        shutil.rmtree(os.path.join(save_dir, 'enc'))
+    return reader.fps, output_dir
 
-    else:
-        # If the media is an image
-        src_frame = cv2.imread(video_path)
-        src_h, src_w = src_frame.shape[:2]
 
-        # Load a dummy image to get the shape attributes
-        sec_frame_original = np.zeros((src_h, src_w, 3), dtype=np.uint8)
+def get_watermark_text():
+    return str(os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
 
-        # Create a copy of the dummy frame
-        sec_frame = sec_frame_original.copy()
 
-        # Put the text onto the dummy frame
-        font_scale = int(max(src_w, src_h) // 500)
+class Watermark:
+    """
+    Hidden text in low 3 bits of frames as stage of pipeline before encoder.
+    Glyph masks of text in all positions are rendered once for each resolution,
+    then frames get watermark in place without decode, images on disk and encode of video again.
+    """
+    def __init__(self, text: str = None, scale_divider: int = 600, with_empty: bool = True):
+        """
+        Initialization
+        :param text: watermark text
+        :param scale_divider: font scale is max side of frame divided by this value
+        :param with_empty: some frames are without text
+        """
+        self.text = text or get_watermark_text()
+        self.scale_divider = scale_divider
+        self.with_empty = with_empty
+        self.glyphs = {}  # (height, width): (glyph masks, region of contrast color)
+
+    def _get_glyphs(self, height: int, width: int):
+        if (height, width) not in self.glyphs:
+            self.glyphs[(height, width)] = self._render_glyphs(height, width)
+        return self.glyphs[(height, width)]
+
+    def _render_glyphs(self, height: int, width: int):
+        font_scale = int(max(width, height) // self.scale_divider)
         font_thickness = int(font_scale // 0.5)
 
-        # Define text position
-        text_x = src_w // 4
-        text_y = src_h // 2
-
-        # Get the region where the text will be placed
-        text_size = cv2.getTextSize(name, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)[0]
-        region = src_frame[text_y - text_size[1]:text_y, text_x:text_x + text_size[0]]
+        # Get the region where the text would be placed in center, its mean color is used to get contrast color
+        text_x = width // 4
+        text_y = height // 2
+        text_size = cv2.getTextSize(self.text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)[0]
+        region = (text_y - text_size[1], text_y, text_x, text_x + text_size[0])
 
-        # Compute the mean color of the region
-        mean_color = cv2.mean(region)[:3]
-
-        # Compute the contrasting color
-        contrast_color = tuple([255 - int(x) for x in mean_color])
-
-        # Adjusting the coordinates to correctly position the text
-        height, width = src_frame.shape[:2]
-
-        # Get the size of the text
-        (text_width, text_height), baseline = cv2.getTextSize(name, cv2.FONT_HERSHEY_SIMPLEX, font_scale,
-                                                              font_thickness)
-
-        # Center positions
+        (text_width, text_height), baseline = cv2.getTextSize(self.text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)
         center_x = width // 2
         center_y = height // 2
-
-        # Define potential positions with padding along the edges (adjust as necessary)
+        # Define potential positions with padding along the edges
         positions = [
             (0, text_height),
             (0, center_y + text_height // 2),
@@ -395,15 +446,78 @@ def encrypted(video_path: str, save_dir: str, fn: int = 0):
             (int(width * 0.75) - text_width // 2, height - baseline),
         ]
 
-        # In each call to the method, select one random positions from the list
-        selected_positions = random.sample(positions, 1)
-
-        # Put text at the selected positions
-        for pos in selected_positions:
-            cv2.putText(sec_frame, name, pos, cv2.FONT_HERSHEY_SIMPLEX, font_scale, contrast_color, font_thickness, cv2.LINE_AA)
+        glyphs = []
+        for pos in positions:
+            # antialiased text in white is alpha of text in any color
+            alpha = np.zeros((height, width), dtype=np.uint8)
+            cv2.putText(alpha, self.text, pos, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, font_thickness, cv2.LINE_AA)
+            ys, xs = np.nonzero(alpha)
+            if len(ys) == 0:
+                glyphs.append(None)
+                continue
+            y1, y2, x1, x2 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+            glyphs.append((y1, y2, x1, x2, alpha[y1:y2, x1:x2, None].astype(np.uint16)))
+        if self.with_empty:
+            glyphs += [None, None, None]
+        return glyphs, region
+
+    def apply(self, frames):
+        """
+        Put watermark in place, each frame gets text in one random position
+        :param frames: uint8 frame (H, W, 3) or batch of frames (N, H, W, 3)
+        :return: frames
+        """
+        batch = frames if frames.ndim == 4 else frames[None]
+        glyphs, (y1, y2, x1, x2) = self._get_glyphs(batch.shape[1], batch.shape[2])
+
+        # Compute the mean color of the region before low bits are cleared
+        region = batch[:, y1:y2, x1:x2]
+        if region.size > 0:
+            mean_colors = region.reshape(len(batch), -1, 3).mean(axis=1)
+        else:
+            mean_colors = np.zeros((len(batch), 3))
 
         # Encryption for LSB 3 bits
-        encrypted_img = (src_frame & 0b11111000) | (sec_frame >> 6 & 0b00000111)
+        np.bitwise_and(batch, 0b11111000, out=batch)
+        for frame, mean_color in zip(batch, mean_colors):
+            glyph = random.choice(glyphs)
+            if glyph is None:
+                continue
+            gy1, gy2, gx1, gx2, alpha = glyph
+            # Compute the contrasting color
+            contrast_color = np.array([255 - int(x) for x in mean_color], dtype=np.uint16)
+            sec_frame = (alpha * contrast_color // 255).astype(np.uint8)
+            frame[gy1:gy2, gx1:gx2] |= sec_frame >> 6 & 0b00000111
+        return frames
+
+
+def encrypted(video_path: str, save_dir: str):
+    """
+    Put watermark to saved media, pipelines with encoder of frames use Watermark stage instead
+    :param video_path: path to video or image
+    :param save_dir: save directory
+    :return: file name
+    """
+    media_type = check_media_type(video_path)
+
+    if media_type == "animated":
+        frames = VideoReader(video_path)
+        watermark = Watermark()
+        file_name = str(uuid.uuid4())+'.mp4'
+        file_path = os.path.join(save_dir, file_name)
+        # Encode frames with audio of source video in one pass, frame rate is kept the same
+        out = None
+        for frame in tqdm(frames, total=len(frames), unit='frames'):
+            if out is None:
+                out = VideoWriter(file_path, frames.fps, frame.shape[1], frame.shape[0], audio=video_path, total=len(frames), message="Watermark video")
+            out.write(watermark.apply(frame))
+        if out is None:
+            raise ValueError(f"Could not read the video file {video_path}")
+        out.release()
+    else:
+        # If the media is an image
+        src_frame = cv2.imread(video_path)
+        encrypted_img = Watermark(scale_divider=500, with_empty=False).apply(src_frame)
 
         # Save the encrypted image
         file_name = str(uuid.uuid4()) + '.png'
@@ -6,6 +6,7 @@ import torch
 import shutil
 import requests
 import subprocess
+import numpy as np
 from tqdm import tqdm
 from time import strftime
 from argparse import Namespace
@@ -23,14 +24,12 @@ from cog import Input
 from backend.folders import TMP_FOLDER, DEEPFAKE_MODEL_FOLDER
 from backend.download import download_model, unzip, check_download_size, get_nested_url, is_connected
 from backend.config import get_deepfake_config
-from deepfake.src.utils.segment import SegmentAnything
-from deepfake.src.utils.videoio import (
-    cut_start_video, check_media_type, save_video_from_frames,
-    extract_audio_from_video, save_video_with_audio
-)
+from backend.mask_store import MaskStore
+from deepfake.src.utils.segment import SegmentAnything, segment_video
+from deepfake.src.utils.videoio import trim_range, check_media_type, save_video_from_frames
 from diffusers.src.utils.mediaio import (
     save_video_frames_cv2, save_image_frame_cv2, vram_limit_device_resolution_diffusion, resize_and_save_image,
-    save_empty_mask, get_new_dimensions, resize_and_save_video, vram_limit_device_resolution_only_ebsynth
+    get_new_dimensions, resize_and_save_video, vram_limit_device_resolution_only_ebsynth
 )
 from diffusers.src.utils.ebsynth import Ebsynth
 
@@ -78,8 +77,7 @@ class Video2Video:
         source_frame_folder_path = os.path.join(cfg.work_dir, source_frame_folder_name)  # original frames folder
         os.makedirs(source_frame_folder_path, exist_ok=True)
 
-        mask_save_path = os.path.join(cfg.work_dir, "masks")  # mask folder
-        os.makedirs(mask_save_path, exist_ok=True)
+        mask_save_path = os.path.join(cfg.work_dir, "masks.wmask")  # masks of all objects in one file
 
         cfg.first_dir = os.path.join(cfg.work_dir, "first_key")
         os.makedirs(cfg.first_dir, exist_ok=True)
@@ -217,13 +215,9 @@ class Video2Video:
         if predictor is None:
             predictor = segmentation.init_vit(sam_vit_checkpoint, vit_model_type, "cuda")  # TODO or small for CPU?
 
-        # cut video
-        if source_type == "video":
-            source = cut_start_video(source, source_start, source_end)
-            # get audio from video target
-            audio_file_name = extract_audio_from_video(source, cfg.work_dir)
-        else:
-            audio_file_name = None
+        # video is trimmed by decoder, audio from video target is muxed in result from the same start
+        audio_source = source if source_type == "video" else None
+        audio_start, _ = trim_range(source_start, source_end)
 
         remove_keys = []
         for key in masks.keys():
@@ -254,8 +248,8 @@ class Video2Video:
             fps, num_frames, width, height = save_image_frame_cv2(source, frame_save_path, '%04d.png', vram_limit_device_resolution_diffusion, "cuda")
         elif source_media_type == "animated":
             default_width, default_height = get_new_dimensions(source, vram_limit_device_resolution_diffusion, "cuda")
-            fps, num_frames, width, height = save_video_frames_cv2(source, frame_save_path, '%04d.png', vram_limit_device_resolution_diffusion, "cuda")
-            save_video_frames_cv2(source, source_frame_folder_path, '%04d.png', vram_limit_device_resolution_diffusion, "cuda")
+            fps, num_frames, width, height = save_video_frames_cv2(source, frame_save_path, '%04d.png', vram_limit_device_resolution_diffusion, "cuda", start=source_start, end=source_end)
+            save_video_frames_cv2(source, source_frame_folder_path, '%04d.png', vram_limit_device_resolution_diffusion, "cuda", start=source_start, end=source_end)
         else:
             raise Exception("Source is not detected as image or video")
 
@@ -268,69 +262,47 @@ class Video2Video:
 
         # Extract the background data and remove it from the original dictionary
         background_mask = masks.pop('background', None)
+        # background is inverted union of dilated masks of objects, so it is full frame without objects
+        mask_keys = list(masks.keys()) + (["background"] if background_mask else [])
+        mask_store = MaskStore.create(
+            mask_save_path, frame_files, mask_keys, width, height, kernel_sizes={key: thickness_mask for key in mask_keys},
+            inverted=["background"]
+        )
         if background_mask:
-            # Create the directory if it doesn't exist
-            mask_key_save_path = os.path.join(mask_save_path, "mask_background")
-            os.makedirs(mask_key_save_path, exist_ok=True)
-            # Generate and save black images
-            for i in range(num_frames):
-                if i == num_frames:
-                    break
-                save_empty_mask(i + 1, width, height, mask_key_save_path, '%04d.png')
-            background_mask["frame_files_path"] = mask_key_save_path
+            for frame_file in frame_files[:num_frames]:
+                mask_store.write("background", frame_file, np.zeros((height, width), dtype=bool))
 
         # get segmentation frames as maks and save
         segmentation.load_models(predictor=predictor, session=session)
 
+        objects = {}
         for key in masks.keys():
-            print(f"Processing ID: {key}")
-            mask_key_save_path = os.path.join(mask_save_path, f"mask_{key}")
-            os.makedirs(mask_key_save_path, exist_ok=True)
-            start_time = masks[key]["start_time"]
-            end_time = masks[key]["end_time"]
-            start_frame = int(start_time * fps)
-            end_frame = int(end_time * fps) + 1
-            # list of frames of list of one frame
-            filter_frames_files = frame_files[start_frame:end_frame]
-            # set progress bar
-            progress_bar = tqdm(total=len(filter_frames_files), unit='it', unit_scale=True)
-            filter_frame_file_name = filter_frames_files[0]
-            filter_frame = cv2.imread(os.path.join(frame_save_path, filter_frame_file_name))  # read first frame file after filter
-            # get segment mask
-            segment_mask = segmentation.set_obj(point_list=masks[key]["point_list"], frame=filter_frame)
-            # save first frame as 0001
-            segmentation.save_black_mask(filter_frame_file_name, segment_mask, mask_key_save_path, kernel_size=thickness_mask, width=width, height=height)
-
-            # update background
-            if background_mask:
-                background_mask_frame_file_path = os.path.join(mask_save_path, "mask_background", filter_frame_file_name)
-                background_mask_frame = cv2.imread(background_mask_frame_file_path)
-                segmentation.save_white_background_mask(background_mask_frame_file_path, segment_mask, background_mask_frame, kernel_size=thickness_mask, width=width, height=height)
-
-            # update progress bar
+            start_frame = int(masks[key]["start_time"] * fps)
+            end_frame = int(masks[key]["end_time"] * fps) + 1
+            objects[key] = {"point_list": masks[key]["point_list"], "start_frame": start_frame, "end_frame": end_frame}
+
+        # each frame is encoded once for all objects, masks of all objects are saved in one pass
+        print(f"Processing IDs: {', '.join(objects.keys())}")
+        segment_frames = segment_video(
+            predictor, session, frame_files, lambda frame_file: cv2.imread(os.path.join(frame_save_path, frame_file)), objects,
+            segment_percentage=segment_percentage
+        )
+        # interval of frames with mask for each object
+        filter_frames_interval = {}
+        progress_bar = tqdm(total=len(frame_files), unit='it', unit_scale=True, desc="Segmentation")
+        for filter_frame_file_name, _, frame_masks in segment_frames:
+            for key, segment_mask in frame_masks.items():
+                mask_store.write(key, filter_frame_file_name, segment_mask)
+                # update background
+                if background_mask:
+                    mask_store.write("background", filter_frame_file_name, segment_mask, union=True)
+                # update infor about start and end mask frame
+                filter_frames_interval.setdefault(key, [filter_frame_file_name, filter_frame_file_name])[1] = filter_frame_file_name
             progress_bar.update(1)
-            # update interval frame
-            start_filter_frame = filter_frame_file_name
-            end_filter_frame = filter_frame_file_name
-
-            if len(filter_frames_files) > 1:
-                for filter_frame_file_name in filter_frames_files[1:]:
-                    filter_frame = cv2.imread(os.path.join(frame_save_path, filter_frame_file_name))  # read frame file after filter
-                    segment_mask = segmentation.draw_mask_frames(frame=filter_frame)
-                    if segment_mask is None:
-                        print(key, "Encountered None mask. Breaking the loop.")
-                        break
-                    # update infor about end mask frame
-                    end_filter_frame = filter_frame_file_name
-                    # save frames after 0002
-                    segmentation.save_black_mask(filter_frame_file_name, segment_mask, mask_key_save_path, kernel_size=thickness_mask, width=width, height=height)
-                    # update background
-                    if background_mask:
-                        background_mask_frame_file_path = os.path.join(mask_save_path, "mask_background", filter_frame_file_name)
-                        background_mask_frame = cv2.imread(background_mask_frame_file_path)
-                        segmentation.save_white_background_mask(background_mask_frame_file_path, segment_mask, background_mask_frame, kernel_size=thickness_mask, width=width, height=height)
-
-                    progress_bar.update(1)
+        # close progress bar for masks
+        progress_bar.close()
+
+        for start_filter_frame, end_filter_frame in filter_frames_interval.values():
             # update interval list frames by start and last frame, and next after last frame
             if end_filter_frame != frame_files[-1]:
                 if start_filter_frame != frame_files[0]:
@@ -339,10 +311,6 @@ class Video2Video:
                     frame_files_with_interval += [start_filter_frame, end_filter_frame, frame_files[frame_files.index(end_filter_frame) + 1]]
             else:
                 frame_files_with_interval += [start_filter_frame, end_filter_frame]
-            # set new key
-            masks[key]["frame_files_path"] = mask_key_save_path
-            # close progress bar for key
-            progress_bar.close()
 
         del segmentation, predictor, session  # remove
         torch.cuda.empty_cache()
@@ -358,13 +326,11 @@ class Video2Video:
         render(
             cfg=cfg, args=args, masks=masks, frame_files_with_interval=frame_files_with_interval, sd_model_path=sd_model_path,
             controlnet_model_path=controlnet_model_path, vae_model_path=vae_model_path, gmflow_model_path=gmflow_model_path,
-            frame_path=frame_save_path, mask_path=mask_save_path
+            frame_path=frame_save_path, mask_store=mask_store
         )
+        mask_store.close()
 
         if source_media_type == "static":
-            # remove only tmp folder
-            for f in os.listdir(TMP_FOLDER):
-                os.remove(os.path.join(TMP_FOLDER, f))
             if width != default_width or height != default_height:  # if ratio was changed
                 # return changed image with restore size
                 changed_frame = cv2.imread(os.path.join(cfg.key_subdir, frame_files[0]))
@@ -458,10 +424,8 @@ class Video2Video:
         # remove first frame
         os.remove(os.path.join(output_frame_folder_path, output_names % 1))
         # get saved file as merge frames to video
-        save_name = save_video_from_frames(frame_names=output_names, save_path=output_frame_folder_path, fps=fps, alternative_save_path=cfg.work_dir)
-        # combine audio and video
-        if os.path.exists(os.path.join(cfg.work_dir, str(audio_file_name))):
-            save_name = save_video_with_audio(os.path.join(cfg.work_dir, save_name), os.path.join(cfg.work_dir, str(audio_file_name)), cfg.work_dir)
+        # get saved file as merge frames to video with audio in one pass
+        save_name = save_video_from_frames(frame_names=output_names, save_path=output_frame_folder_path, fps=fps, alternative_save_path=cfg.work_dir, audio=audio_source, audio_start=audio_start)
         # remove files
         for f in os.listdir(cfg.work_dir):
             if save_name == f:
@@ -472,9 +436,6 @@ class Video2Video:
                 elif os.path.isdir(os.path.join(cfg.work_dir, f)):
                     shutil.rmtree(os.path.join(cfg.work_dir, f))
 
-        for f in os.listdir(TMP_FOLDER):
-            os.remove(os.path.join(TMP_FOLDER, f))
-
         # restore aspect ratio for video
         if width != default_width or height != default_height:  # if ratio was changed
             save_name = resize_and_save_video(save_name, cfg.work_dir, default_width, default_height)
@@ -499,12 +460,12 @@ class Video2Video:
         # cut video and save frames
         source_media_type = check_media_type(source)
         if source_media_type == "animated":
-            source = cut_start_video(source, source_start, source_end)
-            # get audio from video target
-            audio_file_name = extract_audio_from_video(source, work_dir)
+            # video is trimmed by decoder, audio from video target is muxed in result from the same start
+            audio_source = source
+            audio_start, _ = trim_range(source_start, source_end)
             # get resolution
             default_width, default_height = get_new_dimensions(source, vram_limit_device_resolution_only_ebsynth, "cuda")
-            fps, num_frames, width, height = save_video_frames_cv2(source, source_frame_folder_path, '%04d.png', vram_limit_device_resolution_only_ebsynth, "cuda")
+            fps, num_frames, width, height = save_video_frames_cv2(source, source_frame_folder_path, '%04d.png', vram_limit_device_resolution_only_ebsynth, "cuda", start=source_start, end=source_end)
         else:
             raise Exception("Source is not detected as video")
 
@@ -642,10 +603,8 @@ class Video2Video:
         # remove first frame
         os.remove(os.path.join(output_frame_folder_path, output_names % 1))
         # get saved file as merge frames to video
-        save_name = save_video_from_frames(frame_names=output_names, save_path=output_frame_folder_path, fps=fps, alternative_save_path=work_dir)
-        # combine audio and video
-        if os.path.exists(os.path.join(work_dir, str(audio_file_name))):
-            save_name = save_video_with_audio(os.path.join(work_dir, save_name), os.path.join(work_dir, str(audio_file_name)), work_dir)
+        # get saved file as merge frames to video with audio in one pass
+        save_name = save_video_from_frames(frame_names=output_names, save_path=output_frame_folder_path, fps=fps, alternative_save_path=work_dir, audio=audio_source, audio_start=audio_start)
         # remove files
         for f in os.listdir(work_dir):
             if save_name == f:
@@ -656,9 +615,6 @@ class Video2Video:
                 elif os.path.isdir(os.path.join(work_dir, f)):
                     shutil.rmtree(os.path.join(work_dir, f))
 
-        for f in os.listdir(TMP_FOLDER):
-            os.remove(os.path.join(TMP_FOLDER, f))
-
         # restore aspect ratio for video
         if width != default_width or height != default_height:  # if ratio was changed
             save_name = resize_and_save_video(save_name, work_dir, default_width, default_height)
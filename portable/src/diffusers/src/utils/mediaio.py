@@ -3,7 +3,9 @@ import cv2
 import uuid
 import torch
 import numpy as np
-import subprocess
+
+from backend.ffmpeg import run_ffmpeg, get_encoder_args
+from deepfake.src.utils.videoio import get_trim_frames, seek_frame
 
 
 def save_empty_mask(num_frame, width, height, mask_save_path, filename_pattern):
@@ -12,9 +14,12 @@ def save_empty_mask(num_frame, width, height, mask_save_path, filename_pattern):
     cv2.imwrite(save_path, white_mask)
 
 
-def save_video_frames_cv2(video_path, frame_save_path, filename_pattern, resolution_vram_func=None, device="cuda"):
+def save_video_frames_cv2(video_path, frame_save_path, filename_pattern, resolution_vram_func=None, device="cuda", start=0, end=None):
     os.makedirs(frame_save_path, exist_ok=True)
     video_stream = cv2.VideoCapture(video_path)
+    # video is trimmed by decoder from start to end in seconds
+    start_frame, end_frame = get_trim_frames(video_stream, start, end)
+    seek_frame(video_stream, start_frame)
     width = int(video_stream.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video_stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
     if width > height:
@@ -26,7 +31,7 @@ def save_video_frames_cv2(video_path, frame_save_path, filename_pattern, resolut
     fps = video_stream.get(cv2.CAP_PROP_FPS)
 
     num_frame = 1
-    while True:
+    while num_frame <= end_frame - start_frame:
         success, frame = video_stream.read()
         if not success:
             break  # exit the loop if no more frames are available
@@ -133,13 +138,8 @@ def resize_and_save_image(image_path, output_path, width, height):
 
 def resize_and_save_video(input_video_path, save_folder, new_width, new_height):
     output_video_path = os.path.join(save_folder, str(uuid.uuid4()) + ".mp4")
-    cmd = f'ffmpeg -i {input_video_path} -vf scale={new_width}:{new_height} -c:a copy {output_video_path}'
-    if os.environ.get('DEBUG', 'False') == 'True':
-        # not silence run
-        os.system(cmd)
-    else:
-        # silence run
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cmd = ["-i", input_video_path, "-vf", f"scale={new_width}:{new_height}", "-pix_fmt", "yuv420p"] + get_encoder_args()
+    run_ffmpeg(cmd + ["-c:a", "copy", "-movflags", "+faststart", output_video_path], message="Resize video")
     return output_video_path
 
 
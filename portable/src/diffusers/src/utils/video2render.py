@@ -56,7 +56,7 @@ def numpy2tensor(img):
 
 
 def render(cfg: RenderConfig, args, masks, frame_files_with_interval, sd_model_path, controlnet_model_path, vae_model_path,
-           gmflow_model_path, frame_path, mask_path):
+           gmflow_model_path, frame_path, mask_store):
     # Load models
     if cfg.control_type == 'hed':
         detector = HEDdetector()
@@ -131,8 +131,7 @@ def render(cfg: RenderConfig, args, masks, frame_files_with_interval, sd_model_p
 
     for mask_id in masks.keys():
         # for each mask
-        mask_files_path = masks[mask_id]["frame_files_path"]
-        mask_files_path = sorted(os.listdir(mask_files_path))
+        mask_files_path = mask_store.frames(mask_id)
         common_mask_files = sorted(list(set(mask_files_path) & set(frame_files_with_interval)))
 
         prompt = masks[mask_id]["prompt"]
@@ -205,10 +204,8 @@ def render(cfg: RenderConfig, args, masks, frame_files_with_interval, sd_model_p
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             img = HWC3(frame)
 
-            # load mask
-            inpaint_mask_frame = cv2.imread(os.path.join(mask_path, f"mask_{mask_id}", common_frame_name), cv2.IMREAD_GRAYSCALE)
-            # Binarize the image
-            _, binary_mask = cv2.threshold(inpaint_mask_frame, 128, 1, cv2.THRESH_BINARY)
+            # load mask, it is dilated on read
+            binary_mask = mask_store.read(mask_id, common_frame_name).astype(np.uint8)
             # Resize to desired shape
             resized_mask = cv2.resize(binary_mask, (shape[2], shape[1]))
             # Convert to tensor and adjust dimensions
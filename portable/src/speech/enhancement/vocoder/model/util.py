@@ -1,8 +1,9 @@
 from speech.enhancement.vocoder.config import Config
 import torch
-import librosa
 import numpy as np
 
+from backend.mel import get_mel_basis
+
 
 def tr_normalize(S):
     if Config.allow_clipping_in_normalization:
@@ -112,14 +113,7 @@ def load_checkpoint(checkpoint_path, device):
 
 
 def build_mel_basis():
-    return librosa.filters.mel(
-        Config.sample_rate,
-        Config.n_fft,
-        htk=True,
-        n_mels=Config.num_mels,
-        fmin=0,
-        fmax=int(Config.sample_rate // 2),
-    )
+    return get_mel_basis(Config.sample_rate, Config.n_fft, Config.num_mels, fmin=0, fmax=int(Config.sample_rate // 2), htk=True)
 
 
 def linear_to_mel(spectogram):
@@ -3,13 +3,14 @@ import sys
 import uuid
 import torch
 from time import time
-import subprocess
 
 root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.join(root_path, "backend"))
 
 from backend.translator import get_translate
 from backend.general_utils import download_ntlk
+from backend.model_registry import model_registry
+from backend.ffmpeg import run_ffmpeg
 
 sys.path.pop(0)
 
@@ -175,14 +176,13 @@ class VoiceCloneTranslate:
                 f.write(f"file '{trim_wav_path}'\n")
 
         # Use ffmpeg to concatenate the .wav files
-        subprocess.run([
-            "ffmpeg",
+        run_ffmpeg([
             "-f", "concat",
             "-safe", "0",
             "-i", os.path.join(audio_folder, "merged_files.txt"),
             "-c", "copy",
             output_file_path
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ], message="Merge audio")
 
         # Optionally, remove the temporary merged_files.txt file
         os.remove(merged_files)
@@ -241,14 +241,9 @@ class AudioSeparatorVoice:
         # If not a GIF, proceed with audio extraction
         file_name = str(uuid.uuid4()) + '.wav'
         save_file = os.path.join(save_path, file_name)
-        cmd = f'ffmpeg -i "{video_path}" -q:a 0 -map a "{save_file}" -y'
-        if os.environ.get('DEBUG', 'False') == 'True':
-            # not silence run
-            os.system(cmd)
-        else:
-            # silence run
-            subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return file_name
+        # video without audio stream has not output, in this case None is returned
+        run_ffmpeg(["-i", video_path, "-map", "a", save_file], message="Extract audio", check=False)
+        return file_name if os.path.isfile(save_file) else None
 
 
 class SpeechEnhancement:
@@ -288,7 +283,10 @@ class SpeechEnhancement:
         model_vocoder_path = load_speech_enhancement_vocoder()
         model_fixer_path = load_speech_enhancement_fixer()
 
-        voicefixer = VoiceFixer(model_voicefixer_path=model_fixer_path, model_vocoder_path=model_vocoder_path)
+        voicefixer = model_registry.get(
+            "voicefixer", lambda: VoiceFixer(model_voicefixer_path=model_fixer_path, model_vocoder_path=model_vocoder_path),
+            device, files=[model_fixer_path, model_vocoder_path]
+        )
         print("Start speech enhancement")
         voicefixer.restore(input=source, output=output_file, cuda=use_cuda)
 
@@ -299,11 +297,6 @@ class SpeechEnhancement:
         # If not a GIF, proceed with audio extraction
         file_name = str(uuid.uuid4()) + '.wav'
         save_file = os.path.join(save_path, file_name)
-        cmd = f'ffmpeg -i "{video_path}" -q:a 0 -map a "{save_file}" -y'
-        if os.environ.get('DEBUG', 'False') == 'True':
-            # not silence run
-            os.system(cmd)
-        else:
-            # silence run
-            subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return file_name
+        # video without audio stream has not output, in this case None is returned
+        run_ffmpeg(["-i", video_path, "-map", "a", save_file], message="Extract audio", check=False)
+        return file_name if os.path.isfile(save_file) else None
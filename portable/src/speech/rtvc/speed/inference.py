@@ -1,7 +1,8 @@
 import os
-import subprocess
 from parselmouth.praat import run_file
 
+from backend.ffmpeg import run_ffmpeg
+
 
 class AudioSpeedProcessor:
     high_lim_speed_factor = 1.5
@@ -44,12 +45,6 @@ class AudioSpeedProcessor:
 
         # Adjust speed using ffmpeg
         out_file = os.path.join(path_syn, f"{name_syn}_{speed_factor}{suffix_syn}")
-        cmd = f"ffmpeg -i {synthesized_audio} -filter:a atempo={speed_factor} {out_file}"
-        if os.environ.get('DEBUG', 'False') == 'True':
-            # not silence run
-            os.system(cmd)
-        else:
-            # silence run
-            subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run_ffmpeg(["-i", synthesized_audio, "-filter:a", f"atempo={speed_factor}", out_file], message="Change speed")
         print(f"Finished! The path of out_file is {out_file}")
         return out_file
\ No newline at end of file
@@ -5,6 +5,8 @@ from scipy import signal
 from scipy.io import wavfile
 import soundfile as sf
 
+from backend.mel import get_mel_basis, get_inv_mel_basis
+
 
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
@@ -156,13 +158,12 @@ def _linear_to_mel(spectogram, hparams, _mel_basis = None):
 
 def _mel_to_linear(mel_spectrogram, hparams, _inv_mel_basis = None):
     if _inv_mel_basis is None:
-        _inv_mel_basis = np.linalg.pinv(_build_mel_basis(hparams))
+        _inv_mel_basis = get_inv_mel_basis(hparams.sample_rate, hparams.n_fft, hparams.num_mels, hparams.fmin, hparams.fmax)
     return np.maximum(1e-10, np.dot(_inv_mel_basis, mel_spectrogram))
 
 def _build_mel_basis(hparams):
     assert hparams.fmax <= hparams.sample_rate // 2
-    return librosa.filters.mel(hparams.sample_rate, hparams.n_fft, n_mels=hparams.num_mels,
-                               fmin=hparams.fmin, fmax=hparams.fmax)
+    return get_mel_basis(hparams.sample_rate, hparams.n_fft, hparams.num_mels, hparams.fmin, hparams.fmax)
 
 def _amp_to_db(x, hparams):
     min_level = np.exp(hparams.min_level_db / 20 * np.log(10))
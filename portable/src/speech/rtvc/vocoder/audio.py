@@ -10,6 +10,7 @@ root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.join(root_path, "backend"))
 
 import speech.rtvc.vocoder.hparams as hp
+from backend.mel import get_mel_basis
 
 sys.path.pop(0)
 
@@ -54,7 +55,7 @@ def linear_to_mel(spectrogram, mel_basis = None):
 
 
 def build_mel_basis():
-    return librosa.filters.mel(hp.sample_rate, hp.n_fft, n_mels=hp.num_mels, fmin=hp.fmin)
+    return get_mel_basis(hp.sample_rate, hp.n_fft, hp.num_mels, hp.fmin)
 
 
 def normalize(S):
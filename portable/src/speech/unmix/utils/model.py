@@ -2,22 +2,36 @@ import os
 import uuid
 import torch
 import librosa
-import subprocess
 import soundfile as sf
-from openunmix import predict
+from openunmix import predict, utils
+
+from backend.model_registry import model_registry
+from backend.ffmpeg import run_ffmpeg
 
 
 class AudioSeparator:
+    @staticmethod
+    def load_separator(target: str, device: str):
+        """
+        Load Open-Unmix separator in model registry to use again in next jobs
+        :param target: vocals or other target of model
+        :param device: cuda or cpu
+        :return: separator
+        """
+        def loader():
+            separator = utils.load_separator(
+                model_str_or_path="umxl", targets=[target], niter=1, residual=True, wiener_win_len=300,
+                device=device, pretrained=True
+            )
+            separator.freeze()
+            return separator.to(device)
+
+        return model_registry.get(f"unmix_{target}", loader, device)
+
     @staticmethod
     def _convert_to_wav(audio_path, output_path):
         wav_audio_path = os.path.join(output_path, str(uuid.uuid4()) + ".wav")
-        cmd = f"ffmpeg -i {audio_path} {wav_audio_path}"
-        if os.environ.get('DEBUG', 'False') == 'True':
-            # not silence run
-            os.system(cmd)
-        else:
-            # silence run
-            subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run_ffmpeg(["-i", audio_path, wav_audio_path], message="Convert audio")
         return wav_audio_path
 
     def separate_audio(self, wav_audio_path, output_path, converted_wav=False, target_wav="vocals", device="cpu",
@@ -31,11 +45,13 @@ class AudioSeparator:
         audio_tensor = torch.tensor(audio).float()
 
         # Separate sources using Open-Unmix
+        target = target_wav if target_wav != "residual" else "vocals"  # I set this condition if I will add radios for target_wav as bass or dump
         estimates = predict.separate(
             audio_tensor,
             rate=rate,
-            targets=[target_wav if target_wav != "residual" else "vocals"],  # I set this condition if I will add radios for target_wav as bass or dump
+            targets=[target],
             residual=True,
+            separator=self.load_separator(target, device),
             device=device,
         )
 
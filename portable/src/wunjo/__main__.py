@@ -1,4 +1,8 @@
-from wunjo.app import main
+import multiprocessing
+
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # workers of jobs are spawned processes
+    # import inside, because spawned worker process import this module again
+    from wunjo.app import main
     main()
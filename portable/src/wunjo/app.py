@@ -2,38 +2,42 @@ import os
 import gc
 import sys
 import json
+import time
+import shutil
 
 import torch
 import subprocess
 import warnings
+from functools import lru_cache
 warnings.filterwarnings("ignore", category=DeprecationWarning)  # remove msg
 from werkzeug.utils import secure_filename
 
-from flask import Flask, render_template, request, send_from_directory, url_for, jsonify
+from flask import Flask, render_template, request, send_from_directory, url_for, jsonify, Response, stream_with_context
 from flask_cors import CORS, cross_origin
 from flaskwebgui import FlaskUI
 
-from deepfake.inference import AnimationMouthTalk, FaceSwap, Retouch, MediaEdit, GetSegment
+from deepfake.inference import GetSegment
 try:
-    from diffusers.inference import Video2Video, create_diffusion_instruction
+    from diffusers.inference import create_diffusion_instruction
     VIDEO2VIDEO_AVAILABLE = True
     diffusion_models = create_diffusion_instruction()
 except ImportError:
     VIDEO2VIDEO_AVAILABLE = False
     diffusion_models = {}
-from speech.interface import TextToSpeech, VoiceCloneTranslate, AudioSeparatorVoice, SpeechEnhancement
-from speech.tts_models import load_voice_models, voice_names, file_voice_config, file_custom_voice_config, custom_voice_names
-from speech.rtvc_models import load_rtvc, rtvc_models_config
-from backend.folders import (
-    MEDIA_FOLDER, TMP_FOLDER, SETTING_FOLDER, CUSTOM_VOICE_FOLDER, CONTENT_FOLDER, CONTENT_MEDIA_EDIT_FOLDER,
-    CONTENT_AUDIO_SEPARATOR_FOLDER, CONTENT_DIFFUSER_FOLDER, CONTENT_RETOUCH_FOLDER, CONTENT_FACE_SWAP_FOLDER,
-    CONTENT_ANIMATION_TALK_FOLDER, CONTENT_SPEECH_FOLDER, CONTENT_SPEECH_ENHANCEMENT_FOLDER, CONTENT_FACE_MOVE_FOLDER
+from speech.tts_models import voice_names, file_voice_config, custom_voice_names
+from backend.folders import MEDIA_FOLDER, TMP_FOLDER, SETTING_FOLDER, CONTENT_FOLDER, JOB_FOLDER
+from backend.model_registry import model_registry
+from backend.jobs import (
+    JobQueue, WorkerPool, get_worker_devices, JOB_DONE, JOB_FAILED, JOB_CANCELLED, JOB_QUEUED, JOB_RUNNING,
+    JOB_FINISHED_STATUSES
 )
+from backend.events import EventBus, JobEventRelay
+from backend.uploads import UploadManager, UploadError, UPLOAD_CHUNK_SIZE
 from backend.download import get_custom_browser
 from backend.translator import get_translate
 from backend.general_utils import (
     get_version_app, set_settings, current_time, is_ffmpeg_installed, get_folder_size,
-    format_dir_time, clean_text_by_language, check_tmp_file_uploaded, get_utils_config
+    format_dir_time, check_tmp_file_uploaded, get_utils_config
 )
 from backend.config import (
     inspect_face_animation_config, inspect_mouth_animation_config, inspect_face_swap_config, inspect_retouch_config,
@@ -47,25 +51,29 @@ app.config["CORS_HEADERS"] = "Content-Type"
 os.environ['DEBUG'] = 'False'  # str False or True
 app.config['DEBUG'] = os.environ.get('DEBUG', 'False') == 'True'
 app.config['SYNTHESIZE_STATUS'] = {"status_code": 200, "message": ""}
-app.config['SYNTHESIZE_RESULT'] = []
+app.config['JOBS_SINCE'] = time.time()  # show results of jobs created after start of app
 app.config['SEGMENT_ANYTHING_MASK_PREVIEW_RESULT'] = {}  # get segment result
-app.config['SEGMENT_ANYTHING_MODEL'] = {}  # load segment anything model to dynamically change
-app.config['RTVC_LOADED_MODELS'] = {}  # in order to not load model again if it was loaded in prev synthesize (faster)
-app.config['TTS_LOADED_MODELS'] = {}  # in order to not load model again if it was loaded in prev synthesize (faster)
 app.config['USER_LANGUAGE'] = "en"
 app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
+app.config['FOLDER_SIZE_JOBS'] = 0  # number of finished jobs when folder size was calculated
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024 * 1024  # Set the limit to 10GB (adjust as needed)
 
 logging.getLogger('werkzeug').disabled = True
 
 version_app = get_version_app()
 
+job_queue = JobQueue(os.path.join(JOB_FOLDER, "jobs.sqlite3"))
+worker_pool = None  # started in main
+event_bus = EventBus()  # console log and events of jobs for clients
+event_relay = None  # started in main
+upload_manager = UploadManager(TMP_FOLDER)  # resumable uploads of media to tmp folder
+
 
 def clear_cache():
-    # empty cache before big gpu models
-    del app.config['SEGMENT_ANYTHING_MODEL'], app.config['RTVC_LOADED_MODELS'], app.config['TTS_LOADED_MODELS']
+    # empty cache before big gpu models, models of jobs are cleared inside workers
+    model_registry.clear()  # segment anything model of web server
+    GetSegment.clear_cache()  # image embeddings of segment anything
     app.config['SEGMENT_ANYTHING_MASK_PREVIEW_RESULT'] = {}  # clear segment data
-    app.config['SEGMENT_ANYTHING_MODEL'], app.config['RTVC_LOADED_MODELS'], app.config['TTS_LOADED_MODELS'] = {}, {}, {}
     torch.cuda.empty_cache()
     gc.collect()
 
@@ -97,11 +105,17 @@ def split_input_deepfake(input_param):
     return None
 
 
+@lru_cache(maxsize=512)
+def get_cached_translate(text, lang):
+    # results of jobs are translated on each poll of frontend, so translation is not requested again
+    return get_translate(text=text, targetLang=lang)
+
+
 def get_print_translate(text):
     if os.environ.get('WUNJO_OFFLINE_MODE', 'False') == 'True':
         # Offline mode
         return text
-    return get_translate(text=text, targetLang=app.config['USER_LANGUAGE'])
+    return get_cached_translate(text, app.config['USER_LANGUAGE'])
 
 
 @app.route("/update_translation", methods=["POST"])
@@ -156,9 +170,15 @@ def get_vram():
 @app.route('/upload_tmp', methods=['POST'])
 @cross_origin()
 def upload_file_media():
-    if not os.path.exists(TMP_FOLDER):
-        os.makedirs(TMP_FOLDER)
-
+    if request.is_json:
+        # create resumable upload, body of file is sent to /upload_tmp/<upload_id>
+        req = request.get_json()
+        try:
+            return upload_manager.create(req.get("filename"), req.get("size", 0), req.get("sha256"))
+        except UploadError as err:
+            return jsonify({"status": str(err), **err.data}), err.status_code
+
+    # old clients send chunks as form and chunks are appended without offset
     if 'file' not in request.files:
         return {"status": 'No file uploaded'}
     chunk = request.files['file']
@@ -168,11 +188,39 @@ def upload_file_media():
 
     file_path = os.path.join(TMP_FOLDER, filename)
     with open(file_path, 'ab') as f:  # Open in append-binary mode to append chunks
-        f.write(chunk.read())  # Write the received chunk to the file
+        shutil.copyfileobj(chunk.stream, f, UPLOAD_CHUNK_SIZE)  # Write the received chunk to the file
 
     return {"status": 'Chunk uploaded successfully'}
 
 
+@app.route('/upload_tmp/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+@cross_origin()
+def upload_file_media_chunk(upload_id):
+    try:
+        if request.method == 'GET':
+            return upload_manager.status(upload_id)
+        if request.method == 'DELETE':
+            upload_manager.abort(upload_id)
+            return {"status": "aborted"}
+        # body of request is chunk of file from offset, it is streamed to disk
+        offset = request.args.get("offset", type=int)
+        if offset is None:
+            return {"status": "Offset is required"}, 400
+        return upload_manager.write(upload_id, offset, request.stream, request.content_length)
+    except UploadError as err:
+        return jsonify({"status": str(err), **err.data}), err.status_code
+
+
+@app.route('/upload_tmp/<upload_id>/commit', methods=['POST'])
+@cross_origin()
+def commit_file_media(upload_id):
+    req = request.get_json(silent=True) or {}
+    try:
+        return upload_manager.commit(upload_id, req.get("sha256"))
+    except UploadError as err:
+        return jsonify({"status": str(err), **err.data}), err.status_code
+
+
 @app.route('/open_folder', methods=["POST"])
 @cross_origin()
 def open_folder():
@@ -361,9 +409,6 @@ def create_segment_anything():
 
     app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
 
-    if not app.config['SEGMENT_ANYTHING_MODEL']:
-        app.config['SEGMENT_ANYTHING_MODEL'] = GetSegment.load_model()
-
     # get parameters
     request_list = request.get_json()
     source = request_list.get("source")
@@ -372,7 +417,9 @@ def create_segment_anything():
     obj_id = request_list.get("obj_id", 1)
 
     # call get segment anything
-    segment_models = app.config['SEGMENT_ANYTHING_MODEL']
+    # model is loaded only first time and kept in model registry
+    device = "cuda" if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else "cpu"
+    segment_models = model_registry.get("segment_anything", GetSegment.load_model, device)
     predictor = segment_models.get("predictor")
     session = segment_models.get("session")
     if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, source)):
@@ -381,7 +428,8 @@ def create_segment_anything():
         app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 200}
     result_filename = GetSegment.get_segment_mask_file(
-        predictor=predictor, session=session, source=os.path.join(TMP_FOLDER, source), point_list=point_list
+        predictor=predictor, session=session, source=os.path.join(TMP_FOLDER, source), point_list=point_list,
+        model_type=segment_models.get("model_type"), obj_id=obj_id
     )
 
     # Set new data to send in frontend
@@ -406,81 +454,84 @@ def get_segment_anything():
     }
 
 
+def get_processor():
+    return "cuda" if 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else "cpu"
+
+
+def submit_job(task: str, params: dict, mode: str, request_mode: str = "deepfake", **meta):
+    """
+    Put job in queue, worker will run it when will be free
+    :param task: name of task in wunjo.tasks
+    :param params: request parameters
+    :param mode: translated name of mode for frontend
+    :param request_mode: deepfake or speech
+    :return: response with job id
+    """
+    request_date = format_dir_time(current_time())
+    meta = {"mode": mode, "request_mode": request_mode, "request_date": request_date, **meta}
+    job_id = job_queue.submit(task, params, device=get_processor(), meta=meta)
+    event_bus.publish("job", job_id=job_id, status=JOB_QUEUED, task=task)
+    print(f"Job is added in queue {job_id}")
+    return {"status": 200, "job_id": job_id}
+
+
+def get_media_url(file_path: str):
+    save_folder_name = os.path.basename(CONTENT_FOLDER)
+    result_filename = f"/{save_folder_name}/" + file_path.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
+    return url_for("media_file", filename=result_filename)
+
+
+def get_job_results(job: dict) -> list:
+    """Convert finished job in rows of results for frontend"""
+    meta = job["meta"]
+    general = {"mode": meta.get("mode"), "request_mode": meta.get("request_mode"), "request_date": meta.get("request_date"), "job_id": job["id"]}
+    if meta.get("voice"):
+        general["voice"] = meta["voice"]
+    if job["status"] != JOB_DONE:
+        information = "Cancelled" if job["status"] == JOB_CANCELLED else "Error"
+        return [{**general, "response_url": "", "request_information": get_print_translate(information)}]
+
+    results = []
+    for result in job["result"] or []:
+        result = {**general, **result}
+        result["response_url"] = get_media_url(result.pop("response_path"))
+        if result.get("request_information") is None:
+            result["request_information"] = get_print_translate("Successfully")
+        if meta.get("request_mode") == "speech" and result.get("voice"):
+            result["voice"] = get_print_translate(result["voice"])
+        results += [result]
+    return results
+
+
 @app.route("/synthesize_video_merge/", methods=["POST"])
 @cross_origin()
 def synthesize_video_merge():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     # get parameters
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print("Please wait... Processing is started")
-
-    if not os.path.exists(CONTENT_MEDIA_EDIT_FOLDER):
-        os.makedirs(CONTENT_MEDIA_EDIT_FOLDER)
-
-    source_folder = request_list.get("source_folder")
-    audio_name = request_list.get("audio_name")
-    audio_path = os.path.join(TMP_FOLDER, audio_name) if audio_name else None
-    fps = request_list.get("fps", 30)
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
-
-    try:
-        result = MediaEdit.main_merge_frames(
-            output=CONTENT_MEDIA_EDIT_FOLDER, source_folder=source_folder,
-            audio_path=audio_path, fps=fps
-        )
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Image to video"), "request_mode": "deepfake", "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    result_filename = f"/{save_folder_name}/" + result.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    url = url_for("media_file", filename=result_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Image to video"), "request_mode": "deepfake", "response_url": url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Merge frames to video completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # Update disk space size
-    app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
-
-    return {"status": 200}
+    params = {
+        "source_folder": request_list.get("source_folder"),
+        "audio_name": request_list.get("audio_name"),
+        "fps": request_list.get("fps", 30)
+    }
+    return submit_job("merge_frames", params, mode=get_print_translate("Image to video"))
 
 
 @app.route("/synthesize_media_editor/", methods=["POST"])
 @cross_origin()
 def synthesize_media_editor():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     # get parameters
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print("Please wait... Processing is started")
 
-    source = request_list.get("source")
     gfpgan = request_list.get("gfpgan", False)
     animesgan = request_list.get("animesgan", False)
     realesrgan = request_list.get("realesrgan", False)
@@ -493,13 +544,6 @@ def synthesize_media_editor():
     # Find the first non-False option
     enhancer = next((enhancer_option for enhancer_option in enhancer_options if enhancer_option), False)
     audio_separator = next((separator_option for separator_option in separator_options if separator_option), False)
-    is_get_frames = request_list.get("get_frames", False)
-    media_start = request_list.get("media_start", 0)
-    media_end = request_list.get("media_end", 0)
-    media_type = request_list.get("media_type", "img")
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
 
     if enhancer and not audio_separator and not speech_enhancement:
         request_mode = "deepfake"
@@ -512,86 +556,29 @@ def synthesize_media_editor():
         request_mode = "deepfake"
         mode_msg = get_print_translate("Video to images")
 
-    if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, source)):
-        # check what file is uploaded in tmp
-        print("File is too big... ")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 200}
-
-    try:
-        if not audio_separator and not speech_enhancement and media_type in ["img", "video"]:
-            # media edit video or image
-            if not os.path.exists(CONTENT_MEDIA_EDIT_FOLDER):
-                os.makedirs(CONTENT_MEDIA_EDIT_FOLDER)
-
-            result_path = MediaEdit.main_video_work(
-                output=CONTENT_MEDIA_EDIT_FOLDER, source=os.path.join(TMP_FOLDER, source),
-                enhancer=enhancer, is_get_frames=is_get_frames,
-                media_start=media_start, media_end=media_end
-            )
-        elif audio_separator and media_type in ["audio", "video"]:
-            # audio separate from video or audio
-            if not os.path.exists(CONTENT_AUDIO_SEPARATOR_FOLDER):
-                os.makedirs(CONTENT_AUDIO_SEPARATOR_FOLDER)
-
-            dir_time = current_time()
-            result_path = AudioSeparatorVoice.get_audio_separator(
-                source=os.path.join(TMP_FOLDER, source), output_path=os.path.join(CONTENT_AUDIO_SEPARATOR_FOLDER, dir_time), file_type=media_type,
-                converted_wav=True, target=audio_separator, trim_silence=False, resample=False, use_gpu=os.environ.get('WUNJO_TORCH_DEVICE', 'cuda') == 'cuda'
-            )
-        elif speech_enhancement and media_type in ["audio", "video"]:
-            # speech enhancement from video or audio
-            if not os.path.exists(CONTENT_SPEECH_ENHANCEMENT_FOLDER):
-                os.makedirs(CONTENT_SPEECH_ENHANCEMENT_FOLDER)
-
-            dir_time = current_time()
-            result_path = SpeechEnhancement().get_speech_enhancement(
-                source=os.path.join(TMP_FOLDER, source), output_path=os.path.join(CONTENT_SPEECH_ENHANCEMENT_FOLDER, dir_time),
-                use_gpu=os.environ.get('WUNJO_TORCH_DEVICE', 'cuda') == 'cuda', file_type=media_type
-            )
-        else:
-            raise Exception("Not recognition options for media content editor")
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": mode_msg, "voice": mode_msg, "request_mode": request_mode, "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    result_filename = f"/{save_folder_name}/" + result_path.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    url = url_for("media_file", filename=result_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": mode_msg, "voice": mode_msg, "request_mode": request_mode, "response_url": url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Edit media completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # Update disk space size
-    app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
-    # empty cache
-    torch.cuda.empty_cache()
-    # empty loop cache from animation if not clear yet
-    gc.collect()
-
-    return {"status": 200}
+    params = {
+        "source": request_list.get("source"),
+        "enhancer": enhancer,
+        "audio_separator": audio_separator,
+        "speech_enhancement": speech_enhancement,
+        "is_get_frames": request_list.get("get_frames", False),
+        "media_start": request_list.get("media_start", 0),
+        "media_end": request_list.get("media_end", 0),
+        "media_type": request_list.get("media_type", "img")
+    }
+    return submit_job("media_editor", params, mode=mode_msg, request_mode=request_mode, voice=mode_msg)
 
 
 @app.route("/synthesize_only_ebsynth/", methods=["POST"])
 @cross_origin()
 def synthesize_only_ebsynth():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     # has to work only with GPU
-    current_processor = os.environ.get('WUNJO_TORCH_DEVICE', "cpu")
-    if current_processor == "cpu":
+    if get_processor() == "cpu":
         print("You need to use GPU for this function")
         return {"status": 400}
 
@@ -602,66 +589,28 @@ def synthesize_only_ebsynth():
 
     # get parameters
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print("Please wait... Processing is started")
-
-    source = request_list.get("source")
-    source_start = float(request_list.get("source_start", 0))
-    source_end = float(request_list.get("source_end", 0))
-    masks = request_list.get("masks", {})
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
+    params = {
+        "source": request_list.get("source"),
+        "source_start": float(request_list.get("source_start", 0)),
+        "source_end": float(request_list.get("source_end", 0)),
+        "masks": request_list.get("masks", {})
+    }
 
     clear_cache()  # clear empty, because will be better load segment models again and after empty cache
 
-    if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, source)):
-        # check what file is uploaded in tmp
-        print("File is too big... ")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 200}
-
-    try:
-        ebsynth_result = Video2Video.only_ebsynth_video_render(
-            source=os.path.join(TMP_FOLDER, source), output_folder=CONTENT_DIFFUSER_FOLDER, source_start=source_start,
-            source_end=source_end, masks=masks
-        )
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Style transfer"), "request_mode": "deepfake", "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    diffusion_result_filename = f"/{save_folder_name}/" + ebsynth_result.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    diffusion_url = url_for("media_file", filename=diffusion_result_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Style transfer"), "request_mode": "deepfake", "response_url": diffusion_url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Only ebsynth synthesis completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # empty cache
-    torch.cuda.empty_cache()
+    return submit_job("only_ebsynth", params, mode=get_print_translate("Style transfer"))
 
-    return {"status": 200}
 
 @app.route("/synthesize_diffuser/", methods=["POST"])
 @cross_origin()
 def synthesize_diffuser():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     # has to work only with GPU
-    current_processor = os.environ.get('WUNJO_TORCH_DEVICE', "cpu")
-    if current_processor == "cpu":
+    if get_processor() == "cpu":
         print("You need to use GPU for this function")
         return {"status": 400}
 
@@ -672,472 +621,180 @@ def synthesize_diffuser():
 
     # get parameters
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print("Please wait... Processing is started")
-
-    if not os.path.exists(CONTENT_DIFFUSER_FOLDER):
-        os.makedirs(CONTENT_DIFFUSER_FOLDER)
-
-    source = request_list.get("source")
-    source_start = float(request_list.get("source_start", 0))
-    source_end = float(request_list.get("source_end", 0))
-    source_type = request_list.get("source_type", "video")
-    masks = request_list.get("masks", {})
-    interval_generation = int(request_list.get("interval_generation", 10))
-    controlnet = request_list.get("controlnet", "canny")
-    loose_cfattn = request_list.get("preprocessor_loose_cfattn", False)
-    freeu = request_list.get("preprocessor_freeu", False)
-    preprocessor = [loose_cfattn, freeu]
-    segment_percentage = int(request_list.get("segment_percentage", 25))
-    thickness_mask = int(request_list.get("thickness_mask", 10))
-    sd_model_name = request_list.get("sd_model_name", None)
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
+    params = {
+        "source": request_list.get("source"),
+        "source_start": float(request_list.get("source_start", 0)),
+        "source_end": float(request_list.get("source_end", 0)),
+        "source_type": request_list.get("source_type", "video"),
+        "masks": request_list.get("masks", {}),
+        "interval_generation": int(request_list.get("interval_generation", 10)),
+        "controlnet": request_list.get("controlnet", "canny"),
+        "preprocessor_loose_cfattn": request_list.get("preprocessor_loose_cfattn", False),
+        "preprocessor_freeu": request_list.get("preprocessor_freeu", False),
+        "segment_percentage": int(request_list.get("segment_percentage", 25)),
+        "thickness_mask": int(request_list.get("thickness_mask", 10)),
+        "sd_model_name": request_list.get("sd_model_name", None)
+    }
 
     clear_cache()  # clear empty, because will be better load segment models again and after empty cache
 
-    if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, source)):
-        # check what file is uploaded in tmp
-        print("File is too big... ")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 200}
-
-    try:
-        diffusion_result = Video2Video.main_video_render(
-            source=os.path.join(TMP_FOLDER, source), output_folder=CONTENT_DIFFUSER_FOLDER, source_start=source_start, sd_model_name=sd_model_name,
-            source_end=source_end, source_type=source_type, masks=masks, interval=interval_generation, thickness_mask=thickness_mask,
-            control_type=controlnet, translation=preprocessor, predictor=None, session=None, segment_percentage=segment_percentage
-        )
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Diffusion"), "request_mode": "deepfake", "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    diffusion_result_filename = f"/{save_folder_name}/" + diffusion_result.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    diffusion_url = url_for("media_file", filename=diffusion_result_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Diffusion"), "request_mode": "deepfake", "response_url": diffusion_url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Diffusion synthesis completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # empty cache
-    torch.cuda.empty_cache()
-
-    return {"status": 200}
+    return submit_job("diffuser", params, mode=get_print_translate("Diffusion"))
 
 
 @app.route("/synthesize_retouch/", methods=["POST"])
 @cross_origin()
 def synthesize_retouch():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     # get parameters
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print("Please wait... Processing is started")
-
-    if not os.path.exists(CONTENT_RETOUCH_FOLDER):
-        os.makedirs(CONTENT_RETOUCH_FOLDER)
+    params = {
+        "source": request_list.get("source"),
+        "source_start": float(request_list.get("source_start", 0)),
+        "source_end": float(request_list.get("source_end", 0)),
+        "source_type": request_list.get("source_type", "img"),
+        "masks": request_list.get("masks", {}),
+        "model_type": request_list.get("model_type", "retouch_object"),
+        "mask_text": request_list.get("mask_text", False),
+        "mask_color": request_list.get("mask_color", None),
+        "blur": int(request_list.get("blur", 1)),
+        "upscale": request_list.get("upscale", False),
+        "segment_percentage": int(request_list.get("segment_percentage", 25)),
+        "delay_mask": int(request_list.get("delay_mask", 0))
+    }
 
-    source = request_list.get("source")
-    source_start = float(request_list.get("source_start", 0))
-    source_end = float(request_list.get("source_end", 0))
-    source_type = request_list.get("source_type", "img")
-    masks = request_list.get("masks", {})
-    model_type = request_list.get("model_type", "retouch_object")
-    mask_text = request_list.get("mask_text", False)
-    mask_color = request_list.get("mask_color", None)
-    blur = int(request_list.get("blur", 1))
-    upscale = request_list.get("upscale", False)
-    segment_percentage = int(request_list.get("segment_percentage", 25))
-    delay_mask = int(request_list.get("delay_mask", 0))
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
     # clear empty, because will be better load segment models again and after empty cache, else not empty full
     clear_cache()
 
-    if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, source)):
-        # check what file is uploaded in tmp
-        print("File is too big... ")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 200}
-
-    try:
-        retouch_result = Retouch.main_retouch(
-            output=CONTENT_RETOUCH_FOLDER, source=os.path.join(TMP_FOLDER, source), source_start=source_start,
-            masks=masks, retouch_model_type=model_type, source_end=source_end, source_type=source_type, mask_text=mask_text,
-            predictor=None, session=None, mask_color=mask_color, blur=blur, upscale=upscale, segment_percentage=segment_percentage, delay_mask=delay_mask
-        )
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Content clean-up"), "request_mode": "deepfake", "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    retouch_result_filename = f"/{save_folder_name}/" + retouch_result.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    retouch_url = url_for("media_file", filename=retouch_result_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Content clean-up"), "request_mode": "deepfake", "response_url": retouch_url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Retouch synthesis completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # Update disk space size
-    app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
-    # empty cache
-    torch.cuda.empty_cache()
-
-    return {"status": 200}
+    return submit_job("retouch", params, mode=get_print_translate("Content clean-up"))
 
 
 @app.route("/synthesize_face_swap/", methods=["POST"])
 @cross_origin()
 def synthesize_face_swap():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     # get parameters
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print("Please wait... Processing is started")
-
-    if not os.path.exists(CONTENT_FACE_SWAP_FOLDER):
-        os.makedirs(CONTENT_FACE_SWAP_FOLDER)
-
-    target_content = request_list.get("target_content")
-    face_target_fields = request_list.get("face_target_fields")
-    source_face_fields = request_list.get("face_source_fields")
-    source_content = request_list.get("source_content")
-    type_file_source = request_list.get("type_file_source")
-    video_start_target = request_list.get("video_start_target", 0)
-    video_end_target = request_list.get("video_end_target", 0)
-    video_current_time_source = request_list.get("video_current_time_source", 0)
-    video_end_source = request_list.get("video_end_source", 0)
-    multiface = request_list.get("multiface", False)
-    similarface = request_list.get("similarface", False)
-    similar_coeff = float(request_list.get("similar_coeff", 0.95))
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
+    params = {
+        "target_content": request_list.get("target_content"),
+        "face_target_fields": request_list.get("face_target_fields"),
+        "face_source_fields": request_list.get("face_source_fields"),
+        "source_content": request_list.get("source_content"),
+        "type_file_source": request_list.get("type_file_source"),
+        "video_start_target": request_list.get("video_start_target", 0),
+        "video_end_target": request_list.get("video_end_target", 0),
+        "video_current_time_source": request_list.get("video_current_time_source", 0),
+        "video_end_source": request_list.get("video_end_source", 0),
+        "multiface": request_list.get("multiface", False),
+        "similarface": request_list.get("similarface", False),
+        "similar_coeff": float(request_list.get("similar_coeff", 0.95)),
+        "keyframe_interval": int(request_list.get("keyframe_interval", 1))  # detect faces each n frame, 1 is each frame
+    }
 
     clear_cache()  # clear empty
 
-    if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, target_content)) or not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, source_content)):
-        # check what file is uploaded in tmp
-        print("File is too big... ")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 200}
-
-    try:
-        face_swap_result = FaceSwap.main_faceswap(
-            deepfake_dir=CONTENT_FACE_SWAP_FOLDER,
-            target=os.path.join(TMP_FOLDER, target_content),
-            target_face_fields=face_target_fields,
-            source=os.path.join(TMP_FOLDER, source_content),
-            source_face_fields=source_face_fields,
-            type_file_source=type_file_source,
-            target_video_start=video_start_target,
-            target_video_end=video_end_target,
-            source_current_time=video_current_time_source,
-            source_video_end=video_end_source,
-            multiface=multiface,
-            similarface=similarface,
-            similar_coeff=similar_coeff
-        )
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Face swap"), "request_mode": "deepfake", "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    face_swap_result_filename = f"/{save_folder_name}/" + face_swap_result.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    face_swap_url = url_for("media_file", filename=face_swap_result_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": get_print_translate("Face swap"), "request_mode": "deepfake", "response_url": face_swap_url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Face swap synthesis completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # Update disk space size
-    app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
-    # empty cache
-    torch.cuda.empty_cache()
-    # empty loop cache from animation if not clear yet
-    gc.collect()
-
-    return {"status": 200}
+    return submit_job("face_swap", params, mode=get_print_translate("Face swap"))
 
 
 @app.route("/synthesize_mouth_talk/", methods=["POST"])
 @cross_origin()
 def synthesize_mouth_talk():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     # Check ffmpeg
     is_ffmpeg = is_ffmpeg_installed()
     if not is_ffmpeg:
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
         return {"status": 400}
 
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print(get_print_translate("Please wait... Processing is started"))
-
-    if not os.path.exists(CONTENT_ANIMATION_TALK_FOLDER):
-        os.makedirs(CONTENT_ANIMATION_TALK_FOLDER)
-
-    face_fields = request_list.get("face_fields")
-    source_image = os.path.join(TMP_FOLDER, request_list.get("source_media"))
-    driven_audio = os.path.join(TMP_FOLDER, request_list.get("driven_audio"))
-    media_start = request_list.get("media_start", 0)
-    media_end = request_list.get("media_end", 0)
-    emotion_label = request_list.get("emotion_label", None)
-    similar_coeff = float(request_list.get("similar_coeff", 0.95))
-
-    request_time = current_time()
-    request_date = format_dir_time(request_time)
+    params = {
+        "face_fields": request_list.get("face_fields"),
+        "source_media": request_list.get("source_media"),
+        "driven_audio": request_list.get("driven_audio"),
+        "media_start": request_list.get("media_start", 0),
+        "media_end": request_list.get("media_end", 0),
+        "emotion_label": request_list.get("emotion_label", None),
+        "similar_coeff": float(request_list.get("similar_coeff", 0.95)),
+        "keyframe_interval": int(request_list.get("keyframe_interval", 1))  # detect faces each n frame, 1 is each frame
+    }
 
     clear_cache()  # clear empty
 
-    if not check_tmp_file_uploaded(source_image) or not check_tmp_file_uploaded(driven_audio):
-        # check what file is uploaded in tmp
-        print("File is too big... ")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 200}
-
-    mode_msg = get_print_translate("Lip in sync")
+    return submit_job("mouth_talk", params, mode=get_print_translate("Lip in sync"))
 
-    try:
-        animation_talk_result = AnimationMouthTalk.main_video_deepfake(
-            deepfake_dir=CONTENT_ANIMATION_TALK_FOLDER,
-            source=source_image,
-            audio=driven_audio,
-            face_fields=face_fields,
-            video_start=float(media_start),
-            video_end=float(media_end),
-            emotion_label=emotion_label,
-            similar_coeff=similar_coeff
-        )
-
-        torch.cuda.empty_cache()
-    except Exception as err:
-        app.config['SYNTHESIZE_RESULT'] += [{"mode": mode_msg, "request_mode": "deepfake", "response_url": "", "request_date": request_date, "request_information": get_print_translate("Error")}]
-        print(f"Error ... {err}")
-        app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-        return {"status": 400}
-
-    save_folder_name = os.path.basename(CONTENT_FOLDER)
-    animation_talk_filename = f"/{save_folder_name}/" + animation_talk_result.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-    animation_talk_url = url_for("media_file", filename=animation_talk_filename)
-
-    app.config['SYNTHESIZE_RESULT'] += [{"mode": mode_msg, "request_mode": "deepfake", "response_url": animation_talk_url, "request_date": request_date, "request_information": get_print_translate("Successfully")}]
-
-    print("Deepfake synthesis completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # Update disk space size
-    app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
-    # empty cache
-    torch.cuda.empty_cache()
-    # empty loop cache from animation if not clear yet
-    gc.collect()
-
-    return {"status": 200}
 
 @app.route("/synthesize_result/", methods=["GET"])
 @cross_origin()
 def get_synthesize_result():
-    general_results = app.config['SYNTHESIZE_RESULT']
+    # only jobs of this app session, as before results are kept until restart
+    general_results = []
+    for job in job_queue.finished_jobs(since=app.config['JOBS_SINCE']):
+        general_results += get_job_results(job)
     return {
         "response_code": 0,
         "response": general_results
     }
 
+
 @app.route("/synthesize_speech/", methods=["POST"])
 @cross_origin()
 def synthesize_speech():
-    # check what it is not repeat button click
-    if app.config['SYNTHESIZE_STATUS'].get("status_code") != 200:
-        print("The process is already running... ")
-        return {"status": 400}
-
     request_list = request.get_json()
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
-    print(get_print_translate("Please wait... Processing is started"))
+    mode_msg = get_print_translate("Text to speech")
+    return submit_job("speech", {"request_list": request_list}, mode=mode_msg, request_mode="speech", voice=mode_msg)
 
-    dir_time = current_time()
-    request_date = format_dir_time(dir_time)
 
-    for request_json in request_list:
-        text = request_json["text"]
-        model_type = request_json["voice"]
+@app.route("/job_status/<job_id>", methods=["GET"])
+@cross_origin()
+def get_job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {"status": 404}
+    response = {
+        "status": 200, "job_id": job["id"], "task": job["task"], "job_status": job["status"],
+        "progress": job["progress"], "message": job["message"], "device": job["device"], "worker": job["worker"]
+    }
+    if job["status"] == JOB_FAILED:
+        response["error"] = job["error"]
+    if job["status"] in JOB_FINISHED_STATUSES:
+        response["results"] = get_job_results(job)
+    return response
 
-        options = {
-            "rate": float(request_json.get("rate", 1.0)),
-            "pitch": float(request_json.get("pitch", 1.0)),
-            "volume": float(request_json.get("volume", 0.0))
-        }
 
-        auto_translation = request_json.get("auto_translation", False)
-        lang_translation = request_json.get("lang_translation")
-        rtvc_models_lang = lang_translation  # try to use user lang for rtvc models
-
-        use_voice_clone_on_audio = request_json.get("use_voice_clone_on_audio", False)
-        rtvc_audio_clone_voice = request_json.get("rtvc_audio_clone_voice", "")
-
-        if not rtvc_audio_clone_voice:
-            use_voice_clone_on_audio = False
-
-        # rtvc doesn't have models by user lang, set english models
-        if rtvc_models_config.get(lang_translation) is None:
-            rtvc_models_lang = "en"
-
-        # init only one time the models for voice clone if it is needs
-        if (auto_translation or rtvc_audio_clone_voice) and app.config['RTVC_LOADED_MODELS'].get(rtvc_models_lang) is None:
-            # Check ffmpeg
-            is_ffmpeg = is_ffmpeg_installed()
-            if not is_ffmpeg:
-                app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-                return {"status": 400}
-            # init models
-            encoder, synthesizer, signature, vocoder = load_rtvc(rtvc_models_lang)
-            app.config['RTVC_LOADED_MODELS'][rtvc_models_lang] = {"encoder": encoder, "synthesizer": synthesizer, "signature": signature, "vocoder": vocoder}
-
-        if model_type:
-            app.config['TTS_LOADED_MODELS'] = load_voice_models(model_type, app.config['TTS_LOADED_MODELS'])
-
-        for model in model_type:
-            # if set auto translate, when get clear translation for source of models to clear synthesis audio
-            # get tacotron2 lang from engine
-            tacotron2_lang = app.config['TTS_LOADED_MODELS'][model].engine.charset
-            if auto_translation:
-                print("User use auto translation. Translate text before TTS.")
-                tts_text = get_translate(text=text, targetLang=tacotron2_lang)
-            else:
-                tts_text = text
-
-            response_code, results = TextToSpeech.get_synthesized_audio(tts_text, model, app.config['TTS_LOADED_MODELS'], os.path.join(CONTENT_SPEECH_FOLDER, dir_time), **options)
-
-            if response_code == 0:
-                for result in results:
-                    filename = result.pop("filename")
-
-                    # translated audio if user choose lang not equal for model and set auto translation
-                    # or text has not tacotron lang fonts
-                    # (1) remove clean_text_by_language if I will want to delete multilanguage
-                    if (tacotron2_lang != lang_translation and auto_translation) or clean_text_by_language(text, tacotron2_lang) != clean_text_by_language(text, None, True):
-                        # voice clone on tts audio result
-                        # init models if not defined
-                        if app.config['RTVC_LOADED_MODELS'].get(rtvc_models_lang) is None:
-                            encoder, synthesizer, signature, vocoder = load_rtvc(rtvc_models_lang)
-                            app.config['RTVC_LOADED_MODELS'][rtvc_models_lang] = {"encoder": encoder, "synthesizer": synthesizer, "signature": signature, "vocoder": vocoder}
-                        # get models
-                        encoder = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["encoder"]
-                        synthesizer = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["synthesizer"]
-                        signature = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["signature"]
-                        vocoder = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["vocoder"]
-
-                        # text translated inside get_synthesized_audio
-                        response_code, clone_result = VoiceCloneTranslate.get_synthesized_audio(
-                            audio_file=filename, encoder=encoder, synthesizer=synthesizer, signature=signature,
-                            vocoder=vocoder, text=text, src_lang=lang_translation, need_translate=auto_translation,
-                            save_folder=os.path.join(CONTENT_SPEECH_FOLDER, dir_time), tts_model_name=model, converted_wav=False
-                        )
-
-                        if response_code == 0:
-                            result = clone_result
-                            # get new filename
-                            filename = result.pop("filename")
-                        else:
-                            print("Error...during clone synthesized voice")
-
-                    result["file_name"] = os.path.basename(filename)
-                    save_folder_name = os.path.basename(CONTENT_FOLDER)
-                    filename = f"/{save_folder_name}/" + filename.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-                    print("Synthesized file: ", filename)
-                    result.pop("response_audio")
-                    result["response_url"] = url_for("media_file", filename=filename)
-                    result["response_code"] = response_code
-                    result["request_date"] = request_date
-                    result["request_information"] = text
-                    result["request_mode"] = "speech"
-                    result["voice"] = get_print_translate(result.get("voice"))
-                    # Add result in frontend
-                    app.config['SYNTHESIZE_RESULT'] += [result]
-
-        # here use for voice cloning of audio file without tts
-        if use_voice_clone_on_audio:
-            encoder = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["encoder"]
-            synthesizer = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["synthesizer"]
-            signature = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["signature"]
-            vocoder = app.config['RTVC_LOADED_MODELS'][rtvc_models_lang]["vocoder"]
-            rtvc_audio_clone_path = os.path.join(TMP_FOLDER, rtvc_audio_clone_voice)
-
-            response_code, result = VoiceCloneTranslate.get_synthesized_audio(
-                audio_file=rtvc_audio_clone_path, encoder=encoder, synthesizer=synthesizer, signature=signature, vocoder=vocoder,
-                text=text, src_lang=lang_translation, need_translate=auto_translation, save_folder= os.path.join(CONTENT_SPEECH_FOLDER, dir_time)
-            )
-            if response_code == 0:
-                filename = result.pop("filename")
-                result["file_name"] = os.path.basename(filename)
-                save_folder_name = os.path.basename(CONTENT_FOLDER)
-                filename = f"/{save_folder_name}/" + filename.replace("\\", "/").split(f"/{save_folder_name}/")[-1]
-                print("Synthesized file: ", filename)
-                result.pop("response_audio")
-                result["response_url"] = url_for("media_file", filename=filename)
-                result["response_code"] = response_code
-                result["request_date"] = request_date
-                result["request_information"] = text
-                result["request_mode"] = "speech"
-                result["voice"] = get_print_translate(result.get("voice"))
-                # Add result in frontend
-                app.config['SYNTHESIZE_RESULT'] += [result]
-
-    # remove subfiles
-    try:
-        result_filenames = []
-        for result in app.config['SYNTHESIZE_RESULT']:
-            if result.get("file_name"):
-                result_filenames += [result["file_name"]]
-        current_result_folder = os.path.join(CONTENT_SPEECH_FOLDER, dir_time)
-        for f in os.listdir(current_result_folder):
-            if f not in result_filenames:
-                os.remove(os.path.join(current_result_folder, f))
-    except Exception as err:
-        print("Some error during remove files for speech synthesis")
+@app.route("/job_result/<job_id>", methods=["GET"])
+@cross_origin()
+def get_job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {"status": 404}
+    if job["status"] not in JOB_FINISHED_STATUSES:
+        return {"status": 300, "job_status": job["status"]}
+    return {"status": 200, "job_status": job["status"], "response": get_job_results(job)}
 
-    app.config['RTVC_LOADED_MODELS'] = {}  # remove RTVC models
-    print("Text to speech synthesis completed successfully!")
-    app.config['SYNTHESIZE_STATUS'] = {"status_code": 200}
-    # Update disk space size
-    app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
-    # empty cache
-    torch.cuda.empty_cache()
 
-    return {"status": 200}
+@app.route("/job_cancel/<job_id>", methods=["POST"])
+@cross_origin()
+def cancel_job(job_id):
+    if job_queue.cancel(job_id):
+        print(f"Job {job_id} will be cancelled")
+        return {"status": 200}
+    return {"status": 400}
+
+
+@app.route("/jobs/", methods=["GET"])
+@cross_origin()
+def get_jobs():
+    jobs = [
+        {"job_id": job["id"], "task": job["task"], "job_status": job["status"], "progress": job["progress"], "message": job["message"], **job["meta"]}
+        for job in job_queue.jobs(since=app.config['JOBS_SINCE'])
+    ]
+    workers = worker_pool.status() if worker_pool is not None else []
+    return {"response_code": 0, "response": jobs, "workers": workers}
 
 
 """FEATURE MODELS"""
@@ -1146,13 +803,20 @@ def synthesize_speech():
 @app.route("/synthesize_process/", methods=["GET"])
 @cross_origin()
 def get_synthesize_status():
-    status = app.config['SYNTHESIZE_STATUS']
+    # jobs do not block each other, busy status only for segmentation and training which run inside web server
+    status = dict(app.config['SYNTHESIZE_STATUS'])
+    status["jobs"] = {"queued": job_queue.count(JOB_QUEUED), "running": job_queue.count(JOB_RUNNING)}
     return status
 
 
 @app.route("/system_resources_status/", methods=["GET"])
 @cross_origin()
 def get_system_resources_status():
+    # update disk space size only if new jobs were finished
+    finished_jobs = len(job_queue.finished_jobs())
+    if finished_jobs != app.config['FOLDER_SIZE_JOBS']:
+        app.config['FOLDER_SIZE_RESULT'] = {"drive": get_folder_size(CONTENT_FOLDER)}
+        app.config['FOLDER_SIZE_JOBS'] = finished_jobs
     status = app.config['FOLDER_SIZE_RESULT']
     return jsonify(status)
 
@@ -1223,26 +887,43 @@ def change_processor():
 
 
 if not app.config['DEBUG']:
-    from time import time
-    from io import StringIO
+    from io import TextIOBase
+    from collections import deque
 
 
     if sys.platform == 'darwin':
         print("http://127.0.0.1:8000")
 
-    class TimestampedIO(StringIO):
-        def __init__(self):
-            super().__init__()
-            self.logs = []
+    # lines which are not shown in console of frontend
+    replace_phrases = [
+        "* Debug mode: off", "* Serving Flask app 'wunjo.app'",
+        "WARNING:waitress.queue:Task queue depth is 1", "WARNING:waitress.queue:Task queue depth is 2",
+        "WARNING:waitress.queue:Task queue depth is 3", "WARNING:waitress.queue:Task queue depth is 4"
+    ]
 
-        def write(self, msg):
-            timestamped_msg = (time(), msg)
-            self.logs.append(timestamped_msg)
-            super().write(msg)
+    class TimestampedIO(TextIOBase):
+        """Console stream which keeps only last writes and sends them to event bus as log events"""
+        def __init__(self, logs: deque, stream_name: str):
+            super().__init__()
+            self.logs = logs  # shared by stdout and stderr, so writes are already in order of time
+            self.stream_name = stream_name
 
+        def writable(self):
+            return True
 
-    console_stdout = TimestampedIO()
-    console_stderr = TimestampedIO()
+        def write(self, msg):
+            if isinstance(msg, bytes):
+                msg = msg.decode('utf-8', errors='ignore')
+            timestamp = time.time()
+            self.logs.append((timestamp, msg))
+            if msg.strip() and not any(phrase in msg for phrase in replace_phrases):
+                event_bus.publish("log", text=msg, stream=self.stream_name, time=timestamp)
+            return len(msg)
+
+
+    console_logs = deque(maxlen=1000)
+    console_stdout = TimestampedIO(console_logs, "stdout")
+    console_stderr = TimestampedIO(console_logs, "stderr")
     sys.stdout = console_stdout  # prints
     sys.stderr = console_stderr  # errors and warnings
 
@@ -1251,21 +932,9 @@ if not app.config['DEBUG']:
     def console_log():
         max_len_logs = 30
 
-        replace_phrases = [
-            "* Debug mode: off", "* Serving Flask app 'wunjo.app'",
-            "WARNING:waitress.queue:Task queue depth is 1", "WARNING:waitress.queue:Task queue depth is 2",
-            "WARNING:waitress.queue:Task queue depth is 3", "WARNING:waitress.queue:Task queue depth is 4"
-        ]
-
-        combined_logs = console_stdout.logs + console_stderr.logs
-        combined_logs.sort(key=lambda x: x[0])  # Sort by timestamp
-
-        # Covert bytes log
-        combined_logs = [(log[0], log[1].decode('utf-8')) if isinstance(log[1], bytes) else log for log in combined_logs]
-
-        # Filter out unwanted phrases and extract log messages
+        # Filter out unwanted phrases and extract log messages, only last writes are kept
         filtered_logs = [
-            log[1] for log in combined_logs
+            log[1] for log in list(console_logs)
             if not any(phrase in log[1] for phrase in replace_phrases)
         ]
 
@@ -1280,6 +949,23 @@ else:
         return jsonify(logs)
 
 
+@app.route('/events', methods=['GET'])
+@cross_origin()
+def get_events():
+    """
+    Server-Sent Events of console log, progress and status of jobs.
+    Client continues from Last-Event-ID header after reconnect or from last_id argument, types filter events.
+    """
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_id", "0")
+    last_id = int(last_id) if str(last_id).isdigit() else 0
+    types = request.args.get("types")
+    event_types = tuple(types.split(",")) if types else None
+    return Response(
+        stream_with_context(event_bus.stream(last_id, event_types)), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.route('/console_log_print', methods=['POST'])
 def console_log_print():
     resp = request.get_json()
@@ -1298,10 +984,9 @@ def common_training_route():
         print("The process is already running... ")
         return {"status": 400}
 
+    app.config['SYNTHESIZE_STATUS'] = {"status_code": 300}
+
     try:
-        # clear keep models
-        app.config['RTVC_LOADED_MODELS'] = {}
-        app.config['TTS_LOADED_MODELS'] = {}
         # get params and send
         print("Sending parameters to route... ")
         param = request.get_json()
@@ -1329,6 +1014,18 @@ def media_file(filename):
     return send_from_directory(MEDIA_FOLDER, filename, as_attachment=False)
 
 
+def start_workers():
+    global worker_pool, event_relay
+    worker_pool = WorkerPool(job_queue, get_worker_devices(), "wunjo.tasks")
+    worker_pool.start()
+    # progress and status of jobs from workers are sent to clients by event bus
+    # logs of workers are written in console of web server, in debug mode workers print in the same terminal
+    log_streams = None if app.config['DEBUG'] else {"stdout": sys.stdout, "stderr": sys.stderr}
+    event_relay = JobEventRelay(job_queue, event_bus, log_streams=log_streams)
+    event_relay.start()
+    upload_manager.clean()  # uploads which were not finished in previous runs
+
+
 def main():
     # Get current settings
     settings = set_settings()
@@ -1337,6 +1034,8 @@ def main():
         os.environ['WUNJO_OFFLINE_MODE'] = 'True'
     else:
         os.environ['WUNJO_OFFLINE_MODE'] = 'False'
+    # Start workers for jobs
+    start_workers()
     # Init app
     if not app.config['DEBUG'] and sys.platform != 'darwin':
         # Set browser
@@ -27,8 +27,59 @@ function updateConsoleLog() {
 // Update console log initially
 updateConsoleLog();
 
-// Update console log every 5 seconds
-consoleBackendLogSetInterval = setInterval(updateConsoleLog, 1000); // It is ok if check each one second?
+// Console log lines and progress of jobs are pushed by server, polling is only for browsers without EventSource
+const consoleMaxLines = 30;
+let consoleLines = [];
+let consoleBackendLogSetInterval = null;
+
+function renderConsoleLines() {
+  const nonEmptyData = consoleLines.slice().reverse().map(line => line.replace("\r", "").trimEnd()).filter(line => line.trim() !== "");
+  const consoleElement = document.getElementById("console-log");
+  if (consoleElement) {
+    consoleElement.innerText = nonEmptyData.join("\n");
+  }
+}
+
+function pushConsoleLine(text) {
+  if (text.startsWith("\r") && consoleLines.length > 0 && consoleLines[consoleLines.length - 1].startsWith("\r") && !consoleLines[consoleLines.length - 1].endsWith("\n")) {
+    // progress bar is updated in place until it is finished by new line
+    consoleLines[consoleLines.length - 1] = text;
+  } else {
+    consoleLines.push(text);
+  }
+  consoleLines = consoleLines.slice(-consoleMaxLines);
+  renderConsoleLines();
+}
+
+// finished jobs are shown in console, error of job is also shown if worker was stopped without log
+document.addEventListener("wunjo-job", (event) => {
+  const job = event.detail;
+  const task = job.task ? job.task.replace(/_/g, " ") : "job";
+  if (job.status === "failed") {
+    pushConsoleLine(`Job ${task} failed: ${job.error || "unknown error"}`);
+  } else if (job.status === "cancelled") {
+    pushConsoleLine(`Job ${task} cancelled`);
+  } else if (job.status === "done") {
+    pushConsoleLine(`Job ${task} finished`);
+  }
+});
+
+if (window.EventSource) {
+  const backendEvents = new EventSource("/events?types=log,progress,job");
+  backendEvents.addEventListener("log", (event) => {
+    pushConsoleLine(JSON.parse(event.data).text);
+  });
+  backendEvents.addEventListener("progress", (event) => {
+    // event with job_id, stage, progress, frame, total, fps and eta for other scripts
+    document.dispatchEvent(new CustomEvent("wunjo-progress", { detail: JSON.parse(event.data) }));
+  });
+  backendEvents.addEventListener("job", (event) => {
+    // event with job_id and status for other scripts
+    document.dispatchEvent(new CustomEvent("wunjo-job", { detail: JSON.parse(event.data) }));
+  });
+} else {
+  consoleBackendLogSetInterval = setInterval(updateConsoleLog, 1000);
+}
 /// CONSOLE UPDATE LOGICAL ///
 
 /// INFORMATION USER ABOUT MISTAKE ///
@@ -1011,40 +1011,84 @@ function closeTutorial() {
 // CLOSE INTROJS //
 
 // UPLOAD FILE TO TMP //
-function uploadFile(file, mediaName="blob") {
-  const CHUNK_SIZE = 10 * 1024 * 1024; // Set the chunk size to 50MB (adjust as needed)
-  const fileSize = file.size;
-  let start = 0;
+const UPLOAD_HASH_MAX_SIZE = 64 * 1024 * 1024; // hash only small files in browser to find already uploaded content
 
-  function uploadChunk() {
-    const chunk = file.slice(start, start + CHUNK_SIZE);
-    const formData = new FormData();
+async function getFileHash(file) {
+  if (file.size > UPLOAD_HASH_MAX_SIZE || !window.crypto || !window.crypto.subtle) {
+    return null;
+  }
+  const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest)).map((b) => b.toString(16).padStart(2, '0')).join('');
+}
 
-    // Append the chunk with the specific filename (mediaName)
-    formData.append('file', chunk, mediaName);
+async function uploadFile(file, mediaName="blob") {
+  // resumable upload: chunk is sent with offset, after error upload continues from offset received by server
+  const CHUNK_SIZE = 10 * 1024 * 1024; // Set the chunk size to 10MB (adjust as needed)
+  const MAX_RETRIES = 5;
+  const sha256 = await getFileHash(file);
+
+  let response = await fetch('/upload_tmp', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({filename: mediaName, size: file.size, sha256: sha256}),
+  });
+  let upload = await response.json();
+  if (!response.ok) {
+    console.error('Upload failed', upload.status);
+    return;
+  }
+  if (upload.status === 'committed') {
+    console.log('File is already uploaded');
+    return;
+  }
 
-    fetch('/upload_tmp', {
-      method: 'POST',
-      body: formData,
-    })
-    .then((response) => {
-      if (response.ok) {
-        start += CHUNK_SIZE;
-        if (start < fileSize) {
-          uploadChunk(); // Upload the next chunk
-        } else {
-          console.log('File uploaded successfully');
-        }
+  let offset = upload.offset;
+  let retries = 0;
+  while (true) {
+    try {
+      if (offset < file.size) {
+        response = await fetch(`/upload_tmp/${upload.upload_id}?offset=${offset}`, {
+          method: 'PUT',
+          headers: {'Content-Type': 'application/octet-stream'},
+          body: file.slice(offset, offset + CHUNK_SIZE),
+        });
       } else {
-        console.error('Upload failed');
+        response = await fetch(`/upload_tmp/${upload.upload_id}/commit`, {
+          method: 'POST',
+          headers: {'Content-Type': 'application/json'},
+          body: JSON.stringify({sha256: sha256}),
+        });
       }
-    })
-    .catch((error) => {
+      const result = await response.json();
+      if (response.ok && result.status === 'committed') {
+        console.log('File uploaded successfully');
+        return;
+      }
+      if (response.ok || result.offset !== undefined) {
+        // next chunk or continue from offset of server
+        offset = result.offset;
+        retries = response.ok ? 0 : retries + 1;
+      } else {
+        retries += 1;
+      }
+    } catch (error) {
       console.error('Error:', error);
-    });
+      retries += 1;
+      try {
+        const status = await (await fetch(`/upload_tmp/${upload.upload_id}`)).json();
+        if (status.offset !== undefined) {
+          offset = status.offset;
+        }
+      } catch (statusError) {}
+    }
+    if (retries > MAX_RETRIES) {
+      console.error('Upload failed');
+      return;
+    }
+    if (retries > 0) {
+      await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+    }
   }
-
-  uploadChunk();
 }
 // UPLOAD FILE TO TMP //
 
@@ -0,0 +1,367 @@
+import os
+import gc
+
+import torch
+
+from deepfake.inference import AnimationMouthTalk, FaceSwap, Retouch, MediaEdit
+try:
+    from diffusers.inference import Video2Video
+    VIDEO2VIDEO_AVAILABLE = True
+except ImportError:
+    VIDEO2VIDEO_AVAILABLE = False
+from speech.interface import TextToSpeech, VoiceCloneTranslate, AudioSeparatorVoice, SpeechEnhancement
+from speech.tts_models import load_voice_models
+from speech.rtvc_models import load_rtvc, rtvc_models_config
+from backend.folders import (
+    TMP_FOLDER, CONTENT_MEDIA_EDIT_FOLDER, CONTENT_AUDIO_SEPARATOR_FOLDER, CONTENT_DIFFUSER_FOLDER,
+    CONTENT_RETOUCH_FOLDER, CONTENT_FACE_SWAP_FOLDER, CONTENT_ANIMATION_TALK_FOLDER, CONTENT_SPEECH_FOLDER,
+    CONTENT_SPEECH_ENHANCEMENT_FOLDER
+)
+from backend.translator import get_translate
+from backend.general_utils import (
+    current_time, clean_text_by_language, check_tmp_file_uploaded, remove_tmp_files, make_unique_dir, is_ffmpeg_installed
+)
+from backend.jobs import report_progress
+from backend.model_registry import model_registry
+
+
+# Tasks of job queue are run inside worker process with parameters of request and
+# return list of results with response_path to file, which web server convert to url.
+# Models loaded in this worker process are kept in model registry, in order to not load model again if it was loaded
+# in prev job (faster).
+
+
+def clear_cache():
+    # empty cache before big gpu models which are not in model registry
+    model_registry.clear()
+    torch.cuda.empty_cache()
+    gc.collect()
+
+
+def get_device():
+    return "cuda" if torch.cuda.is_available() and 'cpu' not in os.environ.get('WUNJO_TORCH_DEVICE', 'cpu') else "cpu"
+
+
+def wait_tmp_files(file_names: list):
+    for file_name in file_names:
+        if not check_tmp_file_uploaded(os.path.join(TMP_FOLDER, file_name)):
+            # check what file is uploaded in tmp
+            raise Exception(f"File {file_name} is not uploaded")
+
+
+def merge_frames_task(params: dict):
+    audio_name = params.get("audio_name")
+    audio_path = os.path.join(TMP_FOLDER, audio_name) if audio_name else None
+
+    result = MediaEdit.main_merge_frames(
+        output=CONTENT_MEDIA_EDIT_FOLDER, source_folder=params.get("source_folder"),
+        audio_path=audio_path, fps=params.get("fps", 30)
+    )
+    remove_tmp_files([audio_name])
+    print("Merge frames to video completed successfully!")
+    return [{"response_path": result}]
+
+
+def media_editor_task(params: dict):
+    source = params.get("source")
+    enhancer = params.get("enhancer", False)
+    audio_separator = params.get("audio_separator", False)
+    speech_enhancement = params.get("speech_enhancement", False)
+    media_type = params.get("media_type", "img")
+    use_gpu = os.environ.get('WUNJO_TORCH_DEVICE', 'cuda') == 'cuda'
+
+    wait_tmp_files([source])
+
+    if not audio_separator and not speech_enhancement and media_type in ["img", "video"]:
+        # media edit video or image
+        result_path = MediaEdit.main_video_work(
+            output=CONTENT_MEDIA_EDIT_FOLDER, source=os.path.join(TMP_FOLDER, source),
+            enhancer=enhancer, is_get_frames=params.get("is_get_frames", False),
+            media_start=params.get("media_start", 0), media_end=params.get("media_end", 0)
+        )
+    elif audio_separator and media_type in ["audio", "video"]:
+        # audio separate from video or audio
+        result_path = AudioSeparatorVoice.get_audio_separator(
+            source=os.path.join(TMP_FOLDER, source), output_path=os.path.join(CONTENT_AUDIO_SEPARATOR_FOLDER, current_time()),
+            file_type=media_type, converted_wav=True, target=audio_separator, trim_silence=False, resample=False, use_gpu=use_gpu
+        )
+    elif speech_enhancement and media_type in ["audio", "video"]:
+        # speech enhancement from video or audio
+        result_path = SpeechEnhancement().get_speech_enhancement(
+            source=os.path.join(TMP_FOLDER, source), output_path=os.path.join(CONTENT_SPEECH_ENHANCEMENT_FOLDER, current_time()),
+            use_gpu=use_gpu, file_type=media_type
+        )
+    else:
+        raise Exception("Not recognition options for media content editor")
+
+    remove_tmp_files([source])
+    print("Edit media completed successfully!")
+    # empty cache
+    torch.cuda.empty_cache()
+    gc.collect()
+    return [{"response_path": result_path}]
+
+
+def only_ebsynth_task(params: dict):
+    if not VIDEO2VIDEO_AVAILABLE:
+        raise Exception("In this app version is not module diffusion")
+
+    source = params.get("source")
+    masks = params.get("masks", {})
+    clear_cache()
+    wait_tmp_files([source])
+
+    ebsynth_result = Video2Video.only_ebsynth_video_render(
+        source=os.path.join(TMP_FOLDER, source), output_folder=CONTENT_DIFFUSER_FOLDER,
+        source_start=float(params.get("source_start", 0)), source_end=float(params.get("source_end", 0)), masks=masks
+    )
+
+    remove_tmp_files([source] + [mask.get("img_name") for mask in masks.values()])
+    print("Only ebsynth synthesis completed successfully!")
+    torch.cuda.empty_cache()
+    return [{"response_path": ebsynth_result}]
+
+
+def diffuser_task(params: dict):
+    if not VIDEO2VIDEO_AVAILABLE:
+        raise Exception("In this app version is not module diffusion")
+
+    source = params.get("source")
+    clear_cache()
+    wait_tmp_files([source])
+
+    diffusion_result = Video2Video.main_video_render(
+        source=os.path.join(TMP_FOLDER, source), output_folder=CONTENT_DIFFUSER_FOLDER,
+        source_start=float(params.get("source_start", 0)), sd_model_name=params.get("sd_model_name", None),
+        source_end=float(params.get("source_end", 0)), source_type=params.get("source_type", "video"),
+        masks=params.get("masks", {}), interval=int(params.get("interval_generation", 10)),
+        thickness_mask=int(params.get("thickness_mask", 10)), control_type=params.get("controlnet", "canny"),
+        translation=[params.get("preprocessor_loose_cfattn", False), params.get("preprocessor_freeu", False)],
+        predictor=None, session=None, segment_percentage=int(params.get("segment_percentage", 25))
+    )
+
+    remove_tmp_files([source])
+    print("Diffusion synthesis completed successfully!")
+    torch.cuda.empty_cache()
+    return [{"response_path": diffusion_result}]
+
+
+def retouch_task(params: dict):
+    source = params.get("source")
+    wait_tmp_files([source])
+
+    retouch_result = Retouch.main_retouch(
+        output=CONTENT_RETOUCH_FOLDER, source=os.path.join(TMP_FOLDER, source),
+        source_start=float(params.get("source_start", 0)), masks=params.get("masks", {}),
+        retouch_model_type=params.get("model_type", "retouch_object"), source_end=float(params.get("source_end", 0)),
+        source_type=params.get("source_type", "img"), mask_text=params.get("mask_text", False), predictor=None,
+        session=None, mask_color=params.get("mask_color", None), blur=int(params.get("blur", 1)),
+        upscale=params.get("upscale", False), segment_percentage=int(params.get("segment_percentage", 25)),
+        delay_mask=int(params.get("delay_mask", 0))
+    )
+
+    remove_tmp_files([source])
+    print("Retouch synthesis completed successfully!")
+    torch.cuda.empty_cache()
+    return [{"response_path": retouch_result}]
+
+
+def face_swap_task(params: dict):
+    target_content = params.get("target_content")
+    source_content = params.get("source_content")
+    wait_tmp_files([target_content, source_content])
+
+    face_swap_result = FaceSwap.main_faceswap(
+        deepfake_dir=CONTENT_FACE_SWAP_FOLDER,
+        target=os.path.join(TMP_FOLDER, target_content),
+        target_face_fields=params.get("face_target_fields"),
+        source=os.path.join(TMP_FOLDER, source_content),
+        source_face_fields=params.get("face_source_fields"),
+        type_file_source=params.get("type_file_source"),
+        target_video_start=params.get("video_start_target", 0),
+        target_video_end=params.get("video_end_target", 0),
+        source_current_time=params.get("video_current_time_source", 0),
+        source_video_end=params.get("video_end_source", 0),
+        multiface=params.get("multiface", False),
+        similarface=params.get("similarface", False),
+        similar_coeff=float(params.get("similar_coeff", 0.95)),
+        keyframe_interval=int(params.get("keyframe_interval", 1))
+    )
+
+    remove_tmp_files([target_content, source_content])
+    print("Face swap synthesis completed successfully!")
+    torch.cuda.empty_cache()
+    gc.collect()
+    return [{"response_path": face_swap_result}]
+
+
+def mouth_talk_task(params: dict):
+    source_media = params.get("source_media")
+    driven_audio = params.get("driven_audio")
+    wait_tmp_files([source_media, driven_audio])
+
+    animation_talk_result = AnimationMouthTalk.main_video_deepfake(
+        deepfake_dir=CONTENT_ANIMATION_TALK_FOLDER,
+        source=os.path.join(TMP_FOLDER, source_media),
+        audio=os.path.join(TMP_FOLDER, driven_audio),
+        face_fields=params.get("face_fields"),
+        video_start=float(params.get("media_start", 0)),
+        video_end=float(params.get("media_end", 0)),
+        emotion_label=params.get("emotion_label", None),
+        similar_coeff=float(params.get("similar_coeff", 0.95)),
+        keyframe_interval=int(params.get("keyframe_interval", 1))
+    )
+    if animation_talk_result is None:
+        raise Exception("Mouth animation is not created")
+
+    remove_tmp_files([source_media, driven_audio])
+    print("Deepfake synthesis completed successfully!")
+    torch.cuda.empty_cache()
+    gc.collect()
+    return [{"response_path": animation_talk_result}]
+
+
+def _load_rtvc_models(rtvc_models_lang: str):
+    encoder, synthesizer, signature, vocoder = load_rtvc(rtvc_models_lang)
+    return {"encoder": encoder, "synthesizer": synthesizer, "signature": signature, "vocoder": vocoder}
+
+
+def _get_rtvc_models(rtvc_models_lang: str):
+    # init only one time the models for voice clone if it is needs
+    return model_registry.get(f"rtvc_{rtvc_models_lang}", lambda: _load_rtvc_models(rtvc_models_lang), get_device())
+
+
+def _get_tts_models(model_type: list):
+    # each voice is a separate model in registry, models of not used voices can be removed by memory budget
+    return {
+        voice_name: model_registry.get(f"tts_{voice_name}", lambda name=voice_name: load_voice_models([name], {})[name], get_device())
+        for voice_name in model_type
+    }
+
+
+def _speech_result(result: dict, filename: str, text: str, response_code: int):
+    result.pop("response_audio", None)
+    result["file_name"] = os.path.basename(filename)
+    result["response_path"] = filename
+    result["response_code"] = response_code
+    result["request_information"] = text
+    result["request_mode"] = "speech"
+    print("Synthesized file: ", filename)
+    return result
+
+
+def speech_task(params: dict):
+    save_folder = make_unique_dir(CONTENT_SPEECH_FOLDER, current_time())
+    speech_results = []
+
+    request_list = params.get("request_list", [])
+    for num, request_json in enumerate(request_list):
+        report_progress(num / len(request_list), "Text to speech")
+        text = request_json["text"]
+        model_type = request_json["voice"]
+
+        options = {
+            "rate": float(request_json.get("rate", 1.0)),
+            "pitch": float(request_json.get("pitch", 1.0)),
+            "volume": float(request_json.get("volume", 0.0))
+        }
+
+        auto_translation = request_json.get("auto_translation", False)
+        lang_translation = request_json.get("lang_translation")
+        rtvc_models_lang = lang_translation  # try to use user lang for rtvc models
+
+        use_voice_clone_on_audio = request_json.get("use_voice_clone_on_audio", False)
+        rtvc_audio_clone_voice = request_json.get("rtvc_audio_clone_voice", "")
+
+        if not rtvc_audio_clone_voice:
+            use_voice_clone_on_audio = False
+
+        # rtvc doesn't have models by user lang, set english models
+        if rtvc_models_config.get(lang_translation) is None:
+            rtvc_models_lang = "en"
+
+        if auto_translation or rtvc_audio_clone_voice:
+            if not is_ffmpeg_installed():
+                raise Exception("Ffmpeg is not installed")
+            _get_rtvc_models(rtvc_models_lang)
+
+        tts_models = _get_tts_models(model_type) if model_type else {}
+
+        for model in model_type:
+            # if set auto translate, when get clear translation for source of models to clear synthesis audio
+            # get tacotron2 lang from engine
+            tacotron2_lang = tts_models[model].engine.charset
+            if auto_translation:
+                print("User use auto translation. Translate text before TTS.")
+                tts_text = get_translate(text=text, targetLang=tacotron2_lang)
+            else:
+                tts_text = text
+
+            response_code, results = TextToSpeech.get_synthesized_audio(tts_text, model, tts_models, save_folder, **options)
+
+            if response_code == 0:
+                for result in results:
+                    filename = result.pop("filename")
+
+                    # translated audio if user choose lang not equal for model and set auto translation
+                    # or text has not tacotron lang fonts
+                    # (1) remove clean_text_by_language if I will want to delete multilanguage
+                    if (tacotron2_lang != lang_translation and auto_translation) or clean_text_by_language(text, tacotron2_lang) != clean_text_by_language(text, None, True):
+                        # voice clone on tts audio result
+                        rtvc_models = _get_rtvc_models(rtvc_models_lang)
+                        # text translated inside get_synthesized_audio
+                        response_code, clone_result = VoiceCloneTranslate.get_synthesized_audio(
+                            audio_file=filename, encoder=rtvc_models["encoder"], synthesizer=rtvc_models["synthesizer"],
+                            signature=rtvc_models["signature"], vocoder=rtvc_models["vocoder"], text=text,
+                            src_lang=lang_translation, need_translate=auto_translation, save_folder=save_folder,
+                            tts_model_name=model, converted_wav=False
+                        )
+
+                        if response_code == 0:
+                            result = clone_result
+                            # get new filename
+                            filename = result.pop("filename")
+                        else:
+                            print("Error...during clone synthesized voice")
+
+                    speech_results += [_speech_result(result, filename, text, response_code)]
+
+        # here use for voice cloning of audio file without tts
+        if use_voice_clone_on_audio:
+            rtvc_models = _get_rtvc_models(rtvc_models_lang)
+            rtvc_audio_clone_path = os.path.join(TMP_FOLDER, rtvc_audio_clone_voice)
+
+            response_code, result = VoiceCloneTranslate.get_synthesized_audio(
+                audio_file=rtvc_audio_clone_path, encoder=rtvc_models["encoder"], synthesizer=rtvc_models["synthesizer"],
+                signature=rtvc_models["signature"], vocoder=rtvc_models["vocoder"], text=text, src_lang=lang_translation,
+                need_translate=auto_translation, save_folder=save_folder
+            )
+            if response_code == 0:
+                filename = result.pop("filename")
+                speech_results += [_speech_result(result, filename, text, response_code)]
+            remove_tmp_files([rtvc_audio_clone_voice])
+
+    # remove subfiles
+    try:
+        result_filenames = [result["file_name"] for result in speech_results]
+        for f in os.listdir(save_folder):
+            if f not in result_filenames:
+                os.remove(os.path.join(save_folder, f))
+    except Exception as err:
+        print("Some error during remove files for speech synthesis")
+
+    print("Text to speech synthesis completed successfully!")
+    torch.cuda.empty_cache()
+    return speech_results
+
+
+JOB_TASKS = {
+    "merge_frames": merge_frames_task,
+    "media_editor": media_editor_task,
+    "only_ebsynth": only_ebsynth_task,
+    "diffuser": diffuser_task,
+    "retouch": retouch_task,
+    "face_swap": face_swap_task,
+    "mouth_talk": mouth_talk_task,
+    "speech": speech_task,
+}